@@ -1,6 +1,6 @@
 import logging
 from holland.core.command import Command, option
-from holland.core.plugin import load_first_entrypoint
+from holland.core.plugin import load_first_entrypoint, PluginLoadError
 from holland.core.spool import spool
 
 LOGGER = logging.getLogger(__name__)
@@ -46,6 +46,11 @@ class Restore(Command):
             return 1
         config = backup.config
         plugin_name = config.get('holland:backup', {}).get('plugin')
-        plugin = load_first_entrypoint('holland.restore', plugin_name)(backup)
-        plugin.dispatch([plugin_name]  + list(restore_options))
-        return 1
+        try:
+            plugin = load_first_entrypoint('holland.restore',
+                                           plugin_name)(backup)
+        except PluginLoadError, exc:
+            logging.error("Restoring %s backups is not supported: %s",
+                          plugin_name, exc)
+            return 1
+        return plugin.dispatch([plugin_name]  + list(restore_options))
@@ -102,6 +102,16 @@ class BackupRunner(object):
         spool_entry.config.merge(config)
         spool_entry.validate_config()
 
+        # deduplicated backups keep everything beside their chunk store
+        if spool_entry.config['holland:backup']['stripe'] and \
+            not spool_entry.config['holland:backup']['dedup'] and \
+            len(self.spool.paths) > 1:
+            try:
+                spool_entry.add_stripes(self.spool.paths)
+            except OSError, exc:
+                spool_entry.purge()
+                raise BackupError("Failed to create backup stripes: %s" % exc)
+
         if dry_run:
             # always purge the spool
             self.register_cb('post-backup',
@@ -118,6 +128,7 @@ class BackupRunner(object):
 
         try:
             estimated_size = self.check_available_space(plugin, spool_entry, dry_run)
+            self.record_size_history(spool_entry, estimated_size)
             LOG.info("Starting backup[%s] via plugin %s",
                      spool_entry.name,
                      spool_entry.config['holland:backup']['plugin'])
@@ -140,7 +151,7 @@ class BackupRunner(object):
                      format_bytes(estimated_size))
 
             spool_entry.config['holland:backup']['on-disk-size'] = final_size
-            spool_entry.flush()
+            spool_entry.flush(sync=True)
 
         start_time = spool_entry.config['holland:backup']['start-time']
         stop_time = spool_entry.config['holland:backup']['stop-time']
@@ -162,25 +173,45 @@ class BackupRunner(object):
         else:
             self.apply_cb('after-backup', spool_entry)
 
-    def free_required_space(self, name, required_bytes, dry_run=False):
+    def free_required_space(self, name, required_bytes, dry_run=False,
+                            target_path=None):
         """Attempt to free at least ``required_bytes`` of old backups from a backupset
 
         :param name: name of the backupset to free space from
         :param required_bytes: integer number of bytes required for the backupset path
         :param dry_run: if true, this will only generate log messages but won't actually free space
+        :param target_path: path space is required on.  Only backups on the
+                            same filesystem are considered for purging.
+                            Defaults to the backupset path on the primary
+                            spool directory.
         :returns: bool; True if freed or False otherwise
         """
         LOG.info("Insufficient disk space for adjusted estimated backup size: %s",
                  format_bytes(required_bytes))
         LOG.info("purge-on-demand is enabled. Discovering old backups to purge.")
-        available_bytes = disk_free(os.path.join(self.spool.path, name))
+        target_path = target_path or os.path.join(self.spool.path, name)
+        target_dev = os.stat(target_path).st_dev
+        available_bytes = disk_free(target_path)
         to_purge = {}
+        seen = {}
+        backupset = self.spool.find_backupset(name)
         for backup in self.spool.list_backups(name):
-            backup_size = directory_size(backup.path)
-            LOG.info("Found backup '%s': %s",
-                     backup.path, format_bytes(backup_size))
-            available_bytes += backup_size
-            to_purge[backup] = backup_size
+            if backup.name in seen:
+                continue
+            # backups depending on this one are useless without it
+            chain = [backup] + backupset.dependents(backup)
+            for member in chain:
+                seen[member.name] = True
+            if [member for member in chain
+                if member.path == target_path or
+                   os.stat(member.path).st_dev != target_dev]:
+                continue
+            for member in chain:
+                backup_size = directory_size(member.path)
+                LOG.info("Found backup '%s': %s",
+                         member.path, format_bytes(backup_size))
+                available_bytes += backup_size
+                to_purge[member] = backup_size
             if available_bytes > required_bytes:
                 break
         else:
@@ -203,12 +234,35 @@ class BackupRunner(object):
                 LOG.info("Purging: %s", backup.path)
                 backup.purge()
         LOG.info("%s now has %s of available space",
-                 os.path.join(self.spool.path, name),
-                 format_bytes(disk_free(os.path.join(self.spool.path, name))))
+                 target_path,
+                 format_bytes(disk_free(target_path)))
         return True
 
+    def record_size_history(self, spool_entry, estimated_size):
+        """Store the estimated size of a new backup along with the ratio of
+        actual to estimated size seen in previous backups of the same
+        backupset.  Plugins use these to preallocate their output files.
+        """
+        config = spool_entry.config['holland:backup']
+        backupset = self.spool.find_backupset(spool_entry.backupset)
+        if backupset:
+            factor = backupset.historic_size_factor()
+        else:
+            factor = 0.0
+        config['estimated-size'] = estimated_size
+        config['historic-size-factor'] = factor
+        if factor:
+            LOG.info("Previous backups used %.2f%% of their estimated size",
+                     factor*100.0)
+        spool_entry.flush()
+
     def check_available_space(self, plugin, spool_entry, dry_run=False):
         available_bytes = disk_free(spool_entry.path)
+        devices = [os.stat(spool_entry.path).st_dev]
+        for path in spool_entry.config['holland:backup']['stripe-paths']:
+            if os.stat(path).st_dev not in devices:
+                devices.append(os.stat(path).st_dev)
+                available_bytes += disk_free(path)
 
         estimated_bytes_required = plugin.estimate_backup_size()
         LOG.info("Estimated Backup Size: %s",
@@ -227,12 +281,13 @@ class BackupRunner(object):
             if not (config['purge-on-demand'] and 
                     self.free_required_space(spool_entry.backupset,
                                          adjusted_bytes_required,
-                                         dry_run)):
+                                         dry_run,
+                                         target_path=spool_entry.path)):
                 msg = ("Insufficient Disk Space. %s required, "
                        "but only %s available on %s") % (
                        format_bytes(adjusted_bytes_required),
                        format_bytes(available_bytes),
-                       self.spool.path)
+                       os.path.dirname(spool_entry.path))
                 LOG.error(msg)
                 if not dry_run:
                     raise BackupError(msg)
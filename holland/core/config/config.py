@@ -16,7 +16,7 @@ CONFIGSPEC = """
 [holland]
 tmpdir              = string(default=None)
 plugin-dirs         = coerced_list(default=list('/usr/share/holland/plugins'))
-backup-directory    = string(default=/var/spool/holland)
+backup-directory    = coerced_list(default=list('/var/spool/holland'))
 backupsets          = coerced_list(default=list())
 umask               = octal(default='007')
 path                = string(default=None)
@@ -0,0 +1,399 @@
+"""
+Content-defined chunk deduplication for the spool
+
+Streams written through a ChunkStore are cut into variable sized chunks at
+content-defined boundaries.  Each distinct chunk is stored once, zlib
+compressed, under the backupset's ``.chunks`` directory and the stream
+itself is reduced to a recipe listing its chunks in order.  Identical data
+written by later backups only adds lines to their recipes.
+
+Chunk boundaries are chosen at line endings: a line ends a chunk when the
+crc32 of its contents, taken modulo the target average chunk size, is less
+than the line's length.  So each line ends a chunk with probability
+proportional to its length.  This keeps the expected chunk size
+independent of line length while letting zlib do the hashing in C.  SQL
+dumps and most binary data contain plenty of line endings.  Very long
+lines are cut at the maximum chunk size.
+"""
+
+import os
+import errno
+import time
+import zlib
+import logging
+import tempfile
+import threading
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+LOG = logging.getLogger(__name__)
+
+#: name of the chunk directory kept in each backupset directory
+CHUNK_DIR = '.chunks'
+
+#: suffix of the recipe written in place of each deduplicated stream
+RECIPE_SUFFIX = '.recipe'
+
+RECIPE_HEADER = '# holland chunk recipe v1'
+
+class Chunker(object):
+    """
+    Split a stream of data into content-defined chunks
+    """
+    def __init__(self, min_size=64*1024, avg_size=1024*1024,
+                 max_size=8*1024*1024):
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self._pieces = []
+        self._size = 0
+        self._partial = ''
+
+    def _take(self):
+        chunk = ''.join(self._pieces)
+        self._pieces = []
+        self._size = 0
+        return chunk
+
+    def feed(self, data):
+        """Add data to the chunker and return a list of completed chunks"""
+        chunks = []
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            line += '\n'
+            if self._size and self._size + len(line) > self.max_size:
+                chunks.append(self._take())
+            self._pieces.append(line)
+            self._size += len(line)
+            if self._size >= self.max_size:
+                chunks.append(self._take())
+            elif self._size >= self.min_size and \
+                (zlib.crc32(line) & 0xffffffffL) % self.avg_size < len(line):
+                chunks.append(self._take())
+        while self._size + len(self._partial) >= self.max_size:
+            needed = self.max_size - self._size
+            self._pieces.append(self._partial[:needed])
+            self._size += needed
+            self._partial = self._partial[needed:]
+            chunks.append(self._take())
+        return chunks
+
+    def finish(self):
+        """Return any remaining data as a final chunk or None"""
+        if self._partial:
+            self._pieces.append(self._partial)
+            self._size += len(self._partial)
+            self._partial = ''
+        if not self._size:
+            return None
+        return self._take()
+
+class ChunkStore(object):
+    """
+    A directory of zlib compressed chunks named by their sha1 digest
+    """
+    def __init__(self, path, level=1, durability=None):
+        self.path = path
+        self.level = level
+        self.durability = durability
+        self._lock = threading.Lock()
+        self.stats = {
+            'logical-bytes' : 0,
+            'new-bytes'     : 0,
+            'stored-bytes'  : 0,
+            'chunks'        : 0,
+            'new-chunks'    : 0,
+        }
+
+    def for_backup(cls, backup_path, level=1, durability=None):
+        """Return the chunk store shared by the backupset backup_path
+        belongs to"""
+        return cls(os.path.join(os.path.dirname(backup_path), CHUNK_DIR),
+                   level=level, durability=durability)
+    for_backup = classmethod(for_backup)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def put(self, data):
+        """Store a chunk if it is not already present and return its
+        digest"""
+        digest = sha1(data).hexdigest()
+        path = self.chunk_path(digest)
+        stored = 0
+        if os.path.exists(path):
+            try:
+                # refresh mtime so a concurrent purge leaves it alone
+                os.utime(path, None)
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                stored = self._write(path, data)
+        else:
+            stored = self._write(path, data)
+        self._lock.acquire()
+        try:
+            self.stats['logical-bytes'] += len(data)
+            self.stats['chunks'] += 1
+            if stored:
+                self.stats['new-bytes'] += len(data)
+                self.stats['stored-bytes'] += stored
+                self.stats['new-chunks'] += 1
+        finally:
+            self._lock.release()
+        return digest
+
+    def _write(self, path, data):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        payload = zlib.compress(data, self.level)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=dirname)
+        try:
+            try:
+                os.write(fd, payload)
+                if self.durability == 'strict':
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return len(payload)
+
+    def get(self, digest):
+        """Return the contents of a chunk"""
+        fileobj = open(self.chunk_path(digest), 'rb')
+        try:
+            data = zlib.decompress(fileobj.read())
+        finally:
+            fileobj.close()
+        if sha1(data).hexdigest() != digest:
+            raise IOError("Chunk %s is corrupt" % digest)
+        return data
+
+    def open_output(self, path, durability=None):
+        """Open a deduplicated output stream in place of path
+
+        This is the interface used by holland.lib.compression.open_stream
+        """
+        return ChunkedOutput(path, self, durability=durability)
+
+    def dedup_ratio(self):
+        """Ratio of logical bytes written to bytes of new chunks
+
+        Returns 1.0 if nothing was written and infinity if every chunk
+        was already present in the store.
+        """
+        if not self.stats['logical-bytes']:
+            return 1.0
+        if not self.stats['new-bytes']:
+            return float('inf')
+        return float(self.stats['logical-bytes']) / self.stats['new-bytes']
+
+    def record_metrics(self, config):
+        """Record dedup statistics in the [holland:metrics] section of a
+        backup config"""
+        metrics = config.setdefault('holland:metrics', {})
+        for key, value in self.stats.items():
+            metrics['dedup-' + key] = value
+        metrics['dedup-ratio'] = '%.2f' % self.dedup_ratio()
+
+    def collect_garbage(self, recipes, grace_period=3600):
+        """
+        Remove chunks that are not referenced by any of ``recipes``
+
+        Chunks modified within grace_period seconds are kept so chunks
+        written or reused by a backup still in progress are not removed.
+
+        :returns: (number of chunks removed, bytes freed)
+        """
+        refcount = {}
+        for recipe in recipes:
+            try:
+                for digest, size in read_recipe(recipe):
+                    refcount[digest] = refcount.get(digest, 0) + 1
+            except IOError, exc:
+                LOG.warning("Skipping unreadable recipe %s: %s", recipe, exc)
+                # be conservative: never collect when the reference set
+                # is incomplete
+                return 0, 0
+        removed = 0
+        freed = 0
+        cutoff = time.time() - grace_period
+        if not os.path.exists(self.path):
+            return 0, 0
+        for prefix in os.listdir(self.path):
+            chunk_dir = os.path.join(self.path, prefix)
+            if not os.path.isdir(chunk_dir):
+                continue
+            for digest in os.listdir(chunk_dir):
+                if digest in refcount or digest.startswith('.tmp'):
+                    continue
+                path = os.path.join(chunk_dir, digest)
+                try:
+                    info = os.stat(path)
+                    if info.st_mtime > cutoff:
+                        continue
+                    os.unlink(path)
+                except OSError, exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+                    continue
+                removed += 1
+                freed += info.st_size
+        LOG.info("Removed %d unreferenced chunks (%d bytes) from %s",
+                 removed, freed, self.path)
+        return removed, freed
+
+class ChunkedOutput(object):
+    """
+    File-like object that deduplicates everything written to it into a
+    ChunkStore and writes <path>.recipe
+
+    Data may be written with write() or by handing fileno() to a child
+    process.  A background thread reads it from a pipe, chunks it and
+    appends each chunk to the recipe as it is stored.
+    """
+    def __init__(self, path, store, durability=None, chunker=None):
+        self.name = path + RECIPE_SUFFIX
+        self.store = store
+        self.durability = durability
+        self.chunker = chunker or Chunker()
+        self.error = None
+        self.closed = False
+        self.recipe = open(self.name, 'w')
+        print >>self.recipe, RECIPE_HEADER
+        self.recipe.flush()
+        self._rfd, self.fd = os.pipe()
+        try:
+            import fcntl
+            for fd in (self._rfd, self.fd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        except ImportError:
+            pass
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def _add(self, chunk):
+        digest = self.store.put(chunk)
+        print >>self.recipe, "%s %d" % (digest, len(chunk))
+        self.recipe.flush()
+
+    def _run(self):
+        try:
+            try:
+                while True:
+                    data = os.read(self._rfd, 1024*1024)
+                    if not data:
+                        break
+                    for chunk in self.chunker.feed(data):
+                        self._add(chunk)
+                chunk = self.chunker.finish()
+                if chunk is not None:
+                    self._add(chunk)
+            except (IOError, OSError, zlib.error), exc:
+                LOG.error("Failed to deduplicate %s: %s", self.name, exc)
+                self.error = exc
+        finally:
+            os.close(self._rfd)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        os.close(self.fd)
+        self._thread.join()
+        try:
+            self.recipe.flush()
+            if self.durability == 'strict':
+                os.fsync(self.recipe.fileno())
+        finally:
+            self.recipe.close()
+        if self.error is not None:
+            raise IOError(errno.EIO, "Failed to write %s: %s" %
+                                       (self.name, self.error))
+
+def read_recipe(path):
+    """
+    Read a chunk recipe
+
+    :returns: list of (digest, size) tuples in stream order
+    """
+    result = []
+    fileobj = open(path, 'r')
+    try:
+        for line in fileobj:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                digest, size = line.split()
+                result.append((digest, int(size)))
+            except ValueError:
+                raise IOError("Invalid recipe line in %s: %r" % (path, line))
+    finally:
+        fileobj.close()
+    return result
+
+def reassemble(recipe_path, fileobj, store=None):
+    """
+    Write the stream described by a recipe to fileobj
+
+    :param recipe_path: path to a .recipe file inside a backup
+    :param fileobj: file-like object to write the stream to
+    :param store: ChunkStore holding the chunks.  Defaults to the store of
+                  the backupset the recipe belongs to.
+    :returns: number of bytes written
+    """
+    if store is None:
+        store = ChunkStore(find_chunk_dir(recipe_path))
+    total = 0
+    for digest, size in read_recipe(recipe_path):
+        data = store.get(digest)
+        if len(data) != size:
+            raise IOError("Chunk %s has size %d, expected %d" %
+                          (digest, len(data), size))
+        fileobj.write(data)
+        total += size
+    return total
+
+def find_chunk_dir(path):
+    """Find the chunk directory for a file somewhere inside a backup"""
+    path = os.path.abspath(path)
+    while path != os.path.dirname(path):
+        path = os.path.dirname(path)
+        candidate = os.path.join(path, CHUNK_DIR)
+        if os.path.isdir(candidate):
+            return candidate
+    raise IOError(errno.ENOENT, "No chunk directory found for %s" % path)
+
+def find_recipes(backupset_path):
+    """List all recipes of all backups in a backupset directory"""
+    recipes = []
+    for root, dirs, files in os.walk(backupset_path):
+        if CHUNK_DIR in dirs:
+            dirs.remove(CHUNK_DIR)
+        for name in files:
+            if name.endswith(RECIPE_SUFFIX):
+                recipes.append(os.path.join(root, name))
+    return recipes
@@ -10,6 +10,12 @@ import logging
 import itertools
 import shutil
 from holland.core.config import BaseConfig
+from holland.core.util.path import syncfs, fsync_dir, disk_free
+from holland.core.dedup import ChunkStore, find_recipes
+
+#: suffix for directories holding the part of a backup striped onto
+#: another spool root
+STRIPE_SUFFIX = '.stripe'
 
 LOGGER = logging.getLogger(__name__)
 
@@ -25,10 +31,29 @@ def timestamp_dir(when=None):
 class Spool(object):
     """
     A directory spool where backups are saved
+
+    A spool may span several root directories.  The first root is the
+    primary root which holds the newest/oldest symlinks for each backupset.
+    New backups are placed on whichever root currently offers the best
+    combination of free space and historical write throughput.
     """
     def __init__(self, path=None):
+        self.paths = []
         self.path = path or '/var/spool/holland'
 
+    def _get_path(self):
+        return self.paths[0]
+
+    def _set_path(self, value):
+        if isinstance(value, basestring):
+            value = [value]
+        if not value:
+            raise ValueError("At least one spool directory is required")
+        self.paths = [os.path.abspath(path) for path in value]
+
+    #: primary spool root.  Assigning a list sets all roots at once.
+    path = property(_get_path, _set_path)
+
     def find_backup(self, name):
         """
         Find a the specified backup, if it exists. If the backup does
@@ -57,7 +82,11 @@ class Spool(object):
         backupset = self.find_backupset(backupset_name)
         if not backupset:
             backupset = self.add_backupset(backupset_name)
-        return backupset.add_backup()
+        root = self.choose_root()
+        return backupset.add_backup(os.path.join(root, backupset_name))
+
+    def _backupset_paths(self, backupset_name):
+        return [os.path.join(root, backupset_name) for root in self.paths]
 
     def find_backupset(self, backupset_name):
         """
@@ -65,10 +94,11 @@ class Spool(object):
 
         If the backupset does not exist None is returned
         """
-        path = os.path.join(self.path, backupset_name)
-        if not os.path.exists(path):
-            return None
-        return Backupset(backupset_name, path)
+        paths = self._backupset_paths(backupset_name)
+        for path in paths:
+            if os.path.exists(path):
+                return Backupset(backupset_name, paths[0], paths)
+        return None
 
     def add_backupset(self, backupset_name):
         """
@@ -76,10 +106,27 @@ class Spool(object):
 
         If the backupset already exists an IOError is raised
         """
-        path = os.path.join(self.path, backupset_name)
-        if os.path.exists(path):
-            raise IOError("Backupset %s already exists" % backupset_name)
-        return Backupset(backupset_name, path)
+        paths = self._backupset_paths(backupset_name)
+        for path in paths:
+            if os.path.exists(path):
+                raise IOError("Backupset %s already exists" % backupset_name)
+        return Backupset(backupset_name, paths[0], paths)
+
+    def backupset_of(self, backup_path):
+        """
+        Return the Backupset a backup directory belongs to
+
+        If the backup is stored under one of this spool's roots the
+        backupset spans all roots, so backups placed on other roots are
+        seen as well.  Otherwise only the directory the backup is in is
+        used.
+        """
+        backupset_dir = os.path.dirname(os.path.abspath(backup_path))
+        name = os.path.basename(backupset_dir)
+        if os.path.dirname(backupset_dir) in self.paths:
+            paths = self._backupset_paths(name)
+            return Backupset(name, paths[0], paths)
+        return Backupset(name, backupset_dir)
 
     def list_backupsets(self, name=None, reverse=False):
         """
@@ -88,21 +135,23 @@ class Spool(object):
         If reverse is True, the results will be returned in descending lex
         order, ascending otherwise
         """
-        if not os.path.exists(self.path):
-            return []
-
-        backupsets= []
-        dirs = []
         if name:
-            if not os.path.exists(os.path.join(self.path, name)):
+            backupset = self.find_backupset(name)
+            if not backupset:
                 return []
-            dirs = [name]
-        else:
-            dirs = [backupset for backupset in os.listdir(self.path)
-                    if os.path.isdir(os.path.join(self.path, backupset))]
+            return [backupset]
+
+        names = {}
+        for root in self.paths:
+            if not os.path.exists(root):
+                continue
+            for backupset in os.listdir(root):
+                if os.path.isdir(os.path.join(root, backupset)):
+                    names[backupset] = True
 
-        backupsets = [Backupset(dir, os.path.join(self.path, dir)) \
-                      for dir in dirs]
+        backupsets = [Backupset(dir, os.path.join(self.path, dir),
+                                self._backupset_paths(dir))
+                      for dir in names]
 
         backupsets.sort()
 
@@ -116,14 +165,100 @@ class Spool(object):
             for backup in backupset.list_backups():
                 yield backup
 
+    def root_throughput(self, root, count=5):
+        """
+        Return the average write throughput in bytes per second of the last
+        ``count`` completed backups stored under ``root``
+
+        Returns None if there are no completed backups under ``root``
+        """
+        backups = []
+        if os.path.exists(root):
+            for name in os.listdir(root):
+                backupset = Backupset(name, os.path.join(root, name))
+                backups.extend(backupset.list_backups() or [])
+        backups.sort()
+        backups.reverse()
+        rates = []
+        for backup in backups:
+            config = backup.config['holland:backup']
+            elapsed = config['stop-time'] - config['start-time']
+            if config['on-disk-size'] > 0 and elapsed > 0:
+                rates.append(config['on-disk-size'] / elapsed)
+            if len(rates) >= count:
+                break
+        if not rates:
+            return None
+        return sum(rates) / len(rates)
+
+    def expected_throughput(self, root):
+        """
+        Return the write throughput a backup stored under ``root`` can
+        expect
+
+        This is root_throughput(root), or the best throughput seen on the
+        other roots of this spool if ``root`` has no history yet.  Returns
+        None if no root has any history.
+        """
+        rate = self.root_throughput(root)
+        if rate is None and root in self.paths:
+            known = [self.root_throughput(other) for other in self.paths
+                     if other != root]
+            known = [other for other in known if other]
+            if known:
+                rate = max(known)
+        return rate
+
+    def choose_root(self):
+        """
+        Choose the spool root a new backup should be written to
+
+        Roots are scored by their free space multiplied by the write
+        throughput previous backups achieved on them.  Roots without any
+        history are given the best throughput seen elsewhere so they will
+        be tried and measured.
+        """
+        if len(self.paths) == 1:
+            return self.path
+        throughput = {}
+        for root in self.paths:
+            throughput[root] = self.root_throughput(root)
+        known = [rate for rate in throughput.values() if rate]
+        default_rate = (known and max(known)) or 1.0
+        best_root, best_score = None, -1
+        for root in self.paths:
+            try:
+                free = disk_free(_existing_parent(root))
+            except OSError, exc:
+                LOGGER.warning("Skipping spool directory %s: %s", root, exc)
+                continue
+            rate = throughput[root] or default_rate
+            score = free * rate
+            LOGGER.debug("Spool directory %s: %d bytes free, %.0f bytes/s",
+                         root, free, rate)
+            if score > best_score:
+                best_root, best_score = root, score
+        if best_root is None:
+            return self.path
+        if best_root != self.path:
+            LOGGER.info("Placing backup on spool directory %s", best_root)
+        return best_root
+
     def __iter__(self):
         return iter(self.list_backupsets())
 
 
+def _existing_parent(path):
+    """Return path or the nearest parent of path that exists"""
+    while not os.path.exists(path) and path != os.path.dirname(path):
+        path = os.path.dirname(path)
+    return path
+
 class Backupset(object):
-    def __init__(self, name, path):
+    def __init__(self, name, path, paths=None):
         self.name = name
         self.path = path
+        self.paths = paths or [path]
 
     def find_backup(self, name):
         backups = self.list_backups(name)
@@ -131,46 +266,118 @@ class Backupset(object):
             return None
         return backups[0]
 
-    def add_backup(self):
+    def add_backup(self, path=None):
         """
         Create a new instance for this job
+
+        :param path: backupset directory to create the backup under.  This
+                     must be one of this backupset's paths and defaults to
+                     the primary path.
         """
+        path = path or self.path
         backup_name = timestamp_dir()
-        backup_path = os.path.join(self.path, backup_name)
+        for other in self.paths:
+            if os.path.exists(os.path.join(other, backup_name)):
+                raise OSError(errno.EEXIST, "Backup %s/%s already exists" %
+                              (self.name, backup_name))
+        backup_path = os.path.join(path, backup_name)
         backup = Backup(backup_path, self.name, backup_name)
         backup.prepare()
         return backup
 
     def purge(self, retention_count=0):
-        if retention_count < 0:
-            raise ValueError("Invalid retention count %s" % retention_count)
-        for backup in itertools.islice(self.list_backups(reverse=True), retention_count, None):
+        for backup in self.purge_list(retention_count):
             backup.purge()
             yield backup
 
+    def purge_list(self, retention_count=0):
+        """
+        Return the backups purge(retention_count) would remove, newest first
+
+        The newest ``retention_count`` backups are retained along with
+        every backup they depend on through their parent, so a full backup
+        is never removed while incremental backups taken against it are
+        retained.
+        """
+        if retention_count < 0:
+            raise ValueError("Invalid retention count %s" % retention_count)
+        backups = self.list_backups(reverse=True) or []
+        by_name = dict([(backup.name, backup) for backup in backups])
+        retained = {}
+        for backup in itertools.islice(backups, retention_count):
+            while backup is not None and backup.name not in retained:
+                retained[backup.name] = True
+                parent = backup.parent()
+                if parent and parent not in by_name:
+                    LOGGER.warning("Backup %s depends on %s which no longer "
+                                   "exists", backup.name, parent)
+                backup = by_name.get(parent)
+        return [backup for backup in backups if backup.name not in retained]
+
+    def dependents(self, backup):
+        """
+        Return the backups in this backupset that depend on ``backup``,
+        directly or through other backups, oldest first
+        """
+        names = { backup.name : True }
+        result = []
+        for other in self.list_backups() or []:
+            if other.parent() in names:
+                names[other.name] = True
+                result.append(other)
+        return result
+
+    def historic_size_factor(self, count=5):
+        """
+        Return the ratio of on-disk-size to estimated-size for the most
+        recent ``count`` completed backups in this backupset.
+
+        The largest ratio seen is returned so callers err on the side of
+        reserving too much space.  0 is returned if there is no usable
+        history.
+        """
+        factors = []
+        for backup in self.list_backups(reverse=True) or []:
+            config = backup.config['holland:backup']
+            if config['estimated-size'] > 0 and config['on-disk-size'] > 0:
+                factors.append(config['on-disk-size'] /
+                               config['estimated-size'])
+            if len(factors) >= count:
+                break
+        if not factors:
+            return 0.0
+        return max(factors)
+
     def list_backups(self, name=None, reverse=False):
         """
         Return list of backups for this backupset in order of their
         creation date.
         """
-        if not os.path.exists(self.path):
+        paths = [path for path in self.paths if os.path.exists(path)]
+        if not paths:
             return None
 
         name = (name or "").strip()
 
         backup_list = []
         if name:
-            path = os.path.join(self.path, name)
-            return [Backup(path, self.name, name) for x in range(1)
-                        if os.path.exists(path)]
+            for path in paths:
+                backup_path = os.path.join(path, name)
+                if os.path.exists(backup_path):
+                    return [Backup(backup_path, self.name, name)]
+            return []
 
-        dirs = [backup for backup in os.listdir(self.path)
-                   if os.path.isdir(os.path.join(self.path, backup))
-                    and backup not in ('oldest', 'newest')]
+        for path in paths:
+            dirs = [backup for backup in os.listdir(path)
+                       if os.path.isdir(os.path.join(path, backup))
+                        and not os.path.islink(os.path.join(path, backup))
+                        and not backup.endswith(STRIPE_SUFFIX)
+                        and not backup.startswith('.')
+                        and backup not in ('oldest', 'newest')]
 
-        backup_list = [Backup(os.path.join(self.path, dir),
-                              self.name,
-                              dir) for dir in dirs]
+            backup_list.extend([Backup(os.path.join(path, dir),
+                                       self.name,
+                                       dir) for dir in dirs])
 
         backup_list.sort()
         if reverse:
@@ -196,6 +403,8 @@ class Backupset(object):
                 raise
         if not backups:
             return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
         oldest_path = backups[0].path
         newest_path = backups[-1].path
         os.symlink(oldest_path, oldest_link)
@@ -219,10 +428,16 @@ failed-backup           = boolean(default=no)
 estimated-size          = float(default=0)
 on-disk-size            = float(default=0)
 estimated-size-factor   = float(default=1.0)
+historic-size-factor    = float(default=0)
 backups-to-keep         = integer(min=0, default=1)
 auto-purge-failures     = boolean(default=yes)
 purge-policy            = option(manual, before-backup, after-backup, default='after-backup')
 purge-on-demand         = boolean(default=no)
+durability              = option(none, batch, strict, default='none')
+stripe                  = boolean(default=no)
+stripe-paths            = force_list(default=list())
+dedup                   = boolean(default=no)
+parent                  = string(default=None)
 before-backup-command   = string(default=None)
 after-backup-command    = string(default=None)
 failed-backup-command   = string(default=None)
@@ -256,17 +471,43 @@ class Backup(object):
         self.config.reload()
         self.validate_config()
 
+    def parent(self):
+        """
+        Return the name of the backup this backup depends on, such as the
+        full backup an incremental backup was taken against, or None
+        """
+        return self.config['holland:backup']['parent'] or None
+
     def purge(self, data_only=False):
         """
         Purge this backup.
         """
         assert(os.path.realpath(self.path) != '/')
+        stripe_paths = list(self.config['holland:backup']['stripe-paths'])
         # purge the entire backup directory
-        try:
-            shutil.rmtree(self.path)
-        except OSError, exc:
-            if exc.errno != errno.ENOENT:
-                raise
+        for path in [self.path] + stripe_paths:
+            try:
+                shutil.rmtree(path)
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+        if self.config['holland:backup']['dedup']:
+            self.collect_chunks()
+
+    def chunk_store(self):
+        """
+        Return the ChunkStore shared by deduplicated backups in this
+        backup's backupset directory
+        """
+        return ChunkStore.for_backup(self.path)
+
+    def collect_chunks(self):
+        """
+        Remove chunks no longer referenced by any backup in this backup's
+        backupset directory
+        """
+        backupset_dir = os.path.dirname(self.path)
+        return self.chunk_store().collect_garbage(find_recipes(backupset_dir))
 
     def exists(self):
         """
@@ -282,13 +523,70 @@ class Backup(object):
         os.makedirs(self.path)
         LOGGER.info("Creating backup path %s", self.path)
 
-    def flush(self):
+    def add_stripes(self, roots):
+        """
+        Create a directory for this backup on each spool root in ``roots``
+        other than the one it lives on.
+
+        Plugins may spread the files of a large backup across these
+        directories, leaving a symlink to each file under this backup's
+        own path.  The directories are recorded as stripe-paths in
+        backup.conf and are removed when the backup is purged.
+
+        :returns: list of stripe directories
+        """
+        backupset_dir = os.path.dirname(self.path)
+        own_root = os.path.dirname(backupset_dir)
+        stripe_name = os.path.basename(self.path) + STRIPE_SUFFIX
+        stripe_paths = []
+        for root in roots:
+            if os.path.abspath(root) == own_root:
+                continue
+            path = os.path.join(root,
+                                os.path.basename(backupset_dir),
+                                stripe_name)
+            os.makedirs(path)
+            LOGGER.info("Creating backup stripe path %s", path)
+            stripe_paths.append(path)
+        self.config['holland:backup']['stripe-paths'] = stripe_paths
+        return stripe_paths
+
+    def flush(self, sync=False):
         """
         Flush this backup to disk.  Ensure the path to this backup is created
         and write the backup.conf to the backup directory.
+
+        If sync is True and durability is enabled for this backup, all
+        backup data is synced to disk before backup.conf is written and
+        backup.conf itself is synced afterwards.  The time spent syncing is
+        recorded as durability-sync-time in the [holland:metrics] section.
         """
+        durability = self.config['holland:backup']['durability']
+        sync = sync and durability != 'none'
+        if sync:
+            start = time.time()
+            paths = [self.path] + \
+                    list(self.config['holland:backup']['stripe-paths'])
+            if self.config['holland:backup']['dedup']:
+                paths.append(self.chunk_store().path)
+            for path in paths:
+                if os.path.exists(path):
+                    syncfs(path)
+            elapsed = time.time() - start
+            self.config.setdefault('holland:metrics', {})
+            self.config['holland:metrics']['durability-sync-time'] = elapsed
+            LOGGER.info("Synced backup data to disk in %.3f seconds",
+                        elapsed)
         LOGGER.debug("Writing out config to %s", self.config.filename)
         self.config.write()
+        if sync:
+            fd = os.open(self.config.filename, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            fsync_dir(self.path)
+            fsync_dir(os.path.dirname(self.path))
 
     def _formatted_config(self):
         from holland.core.util.fmt import format_bytes, format_datetime
@@ -38,6 +38,22 @@ def format_bytes(bytes, precision=2):
         ['B','KB','MB','GB','TB','PB','EB','ZB','YB'][int(exponent)]
     )
 
+def parse_bytes(units_string):
+    """Parse a size string such as 512M or 4G into an integer number of
+    bytes.  A plain number is taken as bytes.
+
+    Raises ValueError if units_string is not a valid size.
+    """
+    import re
+
+    match = re.match(r'^\s*(\d+(?:[.]\d+)?)\s*([bBkKmMgGtTpPeE]?)\s*$',
+                     str(units_string))
+    if not match:
+        raise ValueError("Invalid size %r" % units_string)
+    number, unit = match.groups()
+    exponent = "BKMGTPE".find((unit or 'B').upper())
+    return int(float(number) * 1024 ** exponent)
+
 def format_loglevel(str_level):
     """
     Coerces a string to an integer logging level which
@@ -10,8 +10,15 @@ import os
 import sys
 import stat
 import time
+import errno
 import logging
 
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
 LOG = logging.getLogger(__name__)
 
 def ensure_dir(dir_path):
@@ -157,3 +164,60 @@ def directory_size(path):
             except OSError, exc:
                 pass
     return result
+
+def _load_syncfs():
+    """Lookup syncfs(2) from libc or return None if it is unavailable"""
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+    func = getattr(libc, 'syncfs', None)
+    if func is not None:
+        func.argtypes = [ctypes.c_int]
+        func.restype = ctypes.c_int
+    return func
+
+def fsync_dir(path):
+    """
+    fsync a directory so that entries created or renamed in it are
+    durable
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def syncfs(path):
+    """
+    Flush all dirty data on the filesystem containing path to disk
+
+    Uses syncfs(2) where available so only a single filesystem is synced.
+    Otherwise each file under path is fsynced individually.
+    """
+    func = _load_syncfs()
+    if func is not None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if func(fd) == 0:
+                return
+            err = ctypes.get_errno()
+            LOG.debug("syncfs(%s) failed: %s", path, os.strerror(err))
+        finally:
+            os.close(fd)
+
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            except OSError, exc:
+                if exc.errno in (errno.ENOENT, errno.EACCES):
+                    continue
+                raise
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        fsync_dir(root)
@@ -0,0 +1,267 @@
+"""
+Wait on child processes, signals and files without sleep polling
+
+A Supervisor blocks in a single select() until something it watches
+changes:
+
+* a child process exits.  A thread per child blocks in waitpid() and
+  writes to a wakeup pipe when the child has been reaped.
+* a signal arrives.  While waiting in the main thread, the wakeup pipe is
+  registered with signal.set_wakeup_fd() so a signal delivered to any
+  thread wakes the waiter once its handler is due to run.
+* a directory changes.  Directories are watched with inotify, so files
+  such as a unix socket or an error log line appearing wake the waiter.
+
+Once a Supervisor watches a process, only the Supervisor may reap it:
+use wait_process() or the process' returncode rather than calling
+Popen.wait() or Popen.poll() from another thread.
+"""
+
+import os
+import time
+import fcntl
+import errno
+import select
+import signal
+import logging
+import threading
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Supervisor',
+]
+
+# inotify(7) events that indicate a directory entry was created or written
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+def _load_inotify():
+    """Lookup inotify_init1(2) and inotify_add_watch(2) from libc
+
+    :returns: (inotify_init1, inotify_add_watch) or None if unavailable
+    """
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+    init = getattr(libc, 'inotify_init1', None)
+    add_watch = getattr(libc, 'inotify_add_watch', None)
+    if init is None or add_watch is None:
+        return None
+    init.argtypes = [ctypes.c_int]
+    init.restype = ctypes.c_int
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    add_watch.restype = ctypes.c_int
+    return init, add_watch
+
+def _set_nonblocking(fd):
+    """Set O_NONBLOCK and FD_CLOEXEC on a file descriptor"""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _set_wakeup_fd(fd):
+    """Call signal.set_wakeup_fd() where possible
+
+    :returns: the previous wakeup fd, or None if it could not be set
+    """
+    try:
+        return signal.set_wakeup_fd(fd)
+    except (AttributeError, ValueError):
+        # python < 2.6, or not called from the main thread
+        return None
+
+def _drain(fd):
+    """Read everything currently available from a non-blocking fd"""
+    while True:
+        try:
+            if not os.read(fd, 4096):
+                return
+        except OSError, exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+class Supervisor(object):
+    """Wait for processes, signals and directory changes in one place
+
+    :param poll_interval: seconds between checks when a directory cannot
+                          be watched with inotify
+    """
+
+    def __init__(self, poll_interval=0.5):
+        self.poll_interval = poll_interval
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_nonblocking(self._wakeup_r)
+        _set_nonblocking(self._wakeup_w)
+        self._inotify = None
+        self._polling = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def wakeup(self):
+        """Wake up a wait() in progress
+
+        This only writes to a pipe, so it is safe to call from a signal
+        handler or another thread.
+        """
+        if self._closed:
+            return
+        try:
+            os.write(self._wakeup_w, '\0')
+        except OSError, exc:
+            # a full pipe will wake the waiter anyway
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def watch(self, process):
+        """Reap a subprocess.Popen instance from a background thread and
+        wake up wait() when it exits"""
+        def reap():
+            try:
+                try:
+                    process.wait()
+                except OSError, exc:
+                    LOG.debug("waitpid(%d) failed: %s", process.pid, exc)
+            finally:
+                self._lock.acquire()
+                try:
+                    self.wakeup()
+                finally:
+                    self._lock.release()
+        thread = threading.Thread(target=reap)
+        thread.setDaemon(True)
+        thread.start()
+
+    def watch_directory(self, path):
+        """Wake up wait() when entries in directory path are created or
+        written to
+
+        Falls back to checking every poll_interval seconds if inotify is
+        not available.
+
+        :returns: True if the directory is watched with inotify
+        """
+        if self._inotify is None:
+            funcs = _load_inotify()
+            fd = -1
+            if funcs is not None:
+                fd = funcs[0](IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                LOG.debug("inotify is not available. Checking %s every "
+                          "%.2fs", path, self.poll_interval)
+                self._polling = True
+                return False
+            self._inotify = (fd, funcs[1])
+        fd, add_watch = self._inotify
+        mask = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+        if add_watch(fd, path, mask) < 0:
+            err = ctypes.get_errno()
+            LOG.debug("inotify_add_watch(%s) failed: %s", path,
+                      os.strerror(err))
+            self._polling = True
+            return False
+        return True
+
+    def wait(self, until, timeout=None):
+        """Block until the callable until() returns a true value
+
+        until() is evaluated at the start and again each time a watched
+        process exits, a watched directory changes, a signal arrives or
+        wakeup() is called.
+
+        :returns: the value of until(), which is false if timeout seconds
+                  passed first
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        fds = [self._wakeup_r]
+        if self._inotify is not None:
+            fds.append(self._inotify[0])
+        previous = _set_wakeup_fd(self._wakeup_w)
+        try:
+            return self._wait(until, fds, deadline)
+        finally:
+            if previous is not None:
+                _set_wakeup_fd(previous)
+
+    def _wait(self, until, fds, deadline):
+        """Wait loop of wait()"""
+        while True:
+            result = until()
+            if result:
+                return result
+            delay = None
+            if deadline is not None:
+                delay = deadline - time.time()
+                if delay <= 0:
+                    return result
+            if self._polling:
+                if delay is None:
+                    delay = self.poll_interval
+                else:
+                    delay = min(delay, self.poll_interval)
+            try:
+                ready = select.select(fds, [], [], delay)[0]
+            except select.error, exc:
+                # a signal arrived; its handler has already run
+                if exc.args[0] != errno.EINTR:
+                    raise
+                continue
+            for fd in ready:
+                _drain(fd)
+
+    def wait_process(self, process, interrupted=None, signum=signal.SIGKILL):
+        """Wait for a watched process to exit
+
+        :param interrupted: callable checked on every wakeup.  When it
+                            returns true the process is sent signum and
+                            waited for.
+        :returns: the process' returncode
+        """
+        if interrupted is None:
+            self.wait(lambda: process.returncode is not None)
+            return process.returncode
+        self.wait(lambda: process.returncode is not None or interrupted())
+        if process.returncode is None:
+            LOG.info("Sending signal %d to process %d", signum, process.pid)
+            try:
+                os.kill(process.pid, signum)
+            except OSError, exc:
+                if exc.errno != errno.ESRCH:
+                    raise
+            self.wait(lambda: process.returncode is not None)
+        return process.returncode
+
+    def close(self):
+        """Release the pipe and inotify descriptors
+
+        Processes still running are no longer waited for.
+        """
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            for fd in (self._wakeup_r, self._wakeup_w):
+                os.close(fd)
+            if self._inotify is not None:
+                os.close(self._inotify[0])
+                self._inotify = None
+        finally:
+            self._lock.release()
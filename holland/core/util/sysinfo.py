@@ -0,0 +1,34 @@
+"""
+CPU and memory of the host a backup runs on
+
+Plugins size threads and buffers for the work they start from these
+values.
+"""
+
+import os
+
+def cpu_count():
+    """Number of online CPUs, or 1 if unknown"""
+    try:
+        return max(int(os.sysconf('SC_NPROCESSORS_ONLN')), 1)
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+def available_memory():
+    """Estimate the bytes of memory available without swapping
+
+    :returns: MemAvailable from /proc/meminfo, or MemFree + Cached on
+              older kernels, or None if unknown
+    """
+    info = {}
+    try:
+        for line in open('/proc/meminfo', 'r'):
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0])*1024
+    except (IOError, ValueError):
+        return None
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    if 'MemFree' in info:
+        return info['MemFree'] + info.get('Cached', 0)
+    return None
@@ -1,2 +1,3 @@
 from holland.backup.mysql_lvm.actions.mysql import *
 from holland.backup.mysql_lvm.actions.tar import *
+from holland.backup.mysql_lvm.actions.native import *
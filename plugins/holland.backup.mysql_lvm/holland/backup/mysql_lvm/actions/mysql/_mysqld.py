@@ -6,6 +6,8 @@ import logging
 from cStringIO import StringIO
 from subprocess import Popen, STDOUT, list2cmdline
 from holland.core.exceptions import BackupError
+from holland.core.util.fmt import parse_bytes
+from holland.core.util.sysinfo import cpu_count, available_memory
 from holland.lib.which import which, WhichError
 
 LOG = logging.getLogger(__name__)
@@ -27,9 +29,15 @@ def locate_mysqld_exe(config):
     raise BackupError("Failed to find mysqld binary")
 
 class MySQLServer(object):
-    def __init__(self, mysqld_exe, defaults_file):
+    """A mysqld process
+
+    If a holland.core.util.supervise.Supervisor is given, the process is
+    reaped by it and poll() and stop() only look at its result.
+    """
+    def __init__(self, mysqld_exe, defaults_file, supervisor=None):
         self.mysqld_exe = mysqld_exe
         self.defaults_file = defaults_file
+        self.supervisor = supervisor
         self.returncode = None
         self.process = None
 
@@ -48,18 +56,27 @@ class MySQLServer(object):
                              stdout=open('/dev/null', 'w'),
                              stderr=STDOUT,
                              close_fds=True)
+        if self.supervisor is not None:
+            self.supervisor.watch(self.process)
+
     def stop(self):
         LOG.info("Stopping %s", self.mysqld_exe)
         if self.process:
             #os.kill(self.process.pid, signal.SIGTERM)
             LOG.info("Waiting for MySQL to stop")
-            self.process.wait()
+            if self.supervisor is not None:
+                self.supervisor.wait_process(self.process)
+            else:
+                self.process.wait()
             LOG.info("%s stopped", self.mysqld_exe)
             self.returncode = self.process.returncode
             self.process = None
 
     def poll(self):
-        self.returncode = self.process.poll()
+        if self.supervisor is not None:
+            self.returncode = self.process.returncode
+        else:
+            self.returncode = self.process.poll()
         return self.returncode
 
     def kill(self, signum):
@@ -75,6 +92,126 @@ class MySQLServer(object):
         self.stop()
         self.start()
 
+class ErrorLogTail(object):
+    """Read what mysqld appends to its error log
+
+    Only text written after the tail was created is returned, so a log
+    left over from an earlier run is skipped.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.offset = os.path.getsize(path)
+        except OSError:
+            self.offset = 0
+        # text after the last newline read so far
+        self.partial = ''
+
+    def lines(self):
+        """List the complete lines written since the last call"""
+        try:
+            fileobj = open(self.path, 'r')
+        except IOError:
+            return []
+        try:
+            fileobj.seek(self.offset)
+            data = fileobj.read()
+        finally:
+            fileobj.close()
+        self.offset += len(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+class ErrorLogWatch(ErrorLogTail):
+    """Look for a message in what mysqld writes to its error log
+
+    Calling the watch returns True once the message has been seen.
+    """
+    def __init__(self, path, message='ready for connections'):
+        ErrorLogTail.__init__(self, path)
+        self.message = message
+        self.seen = False
+
+    def __call__(self):
+        if self.seen:
+            return True
+        for line in self.lines():
+            if self.message in line:
+                self.seen = True
+        return self.seen
+
+def size_recovery_config(config, memory=None, cpus=None):
+    """Size a bootstrap mysqld for InnoDB crash recovery
+
+    With innodb-buffer-pool-size = auto the buffer pool gets half of the
+    memory currently available (at least 128M), so redo can be applied
+    with few page evictions.  The InnoDB I/O threads are set from the CPU
+    count.
+    """
+    buffer_pool = config.get('innodb-buffer-pool-size') or 'auto'
+    if buffer_pool == 'auto':
+        if memory is None:
+            memory = available_memory()
+        buffer_pool = 128*1024**2
+        if memory:
+            buffer_pool = max(buffer_pool, memory // 2)
+    else:
+        try:
+            buffer_pool = parse_bytes(buffer_pool)
+        except ValueError, exc:
+            raise BackupError("Invalid innodb-buffer-pool-size: %s" % exc)
+    if cpus is None:
+        cpus = cpu_count()
+    config['innodb-buffer-pool-size'] = int(buffer_pool)
+    if buffer_pool >= 1024**3:
+        config['loose-innodb-buffer-pool-instances'] = \
+            max(1, min(cpus, 64, buffer_pool // 1024**3))
+    io_threads = min(max(cpus, 4), 64)
+    config['loose-innodb-read-io-threads'] = io_threads
+    config['loose-innodb-write-io-threads'] = io_threads
+    LOG.info("Sized InnoDB recovery: innodb-buffer-pool-size=%d "
+             "innodb-read-io-threads=%d innodb-write-io-threads=%d",
+             config['innodb-buffer-pool-size'], io_threads, io_threads)
+    return config
+
+def size_server_config(config, workers, tables=0):
+    """Size a bootstrap mysqld for ``workers`` concurrent mysqldump
+    connections
+
+    Each worker gets its own share of the InnoDB buffer pool, within half
+    of the memory currently available, but never less than the configured
+    innodb-buffer-pool-size.  The connection, table cache and open file
+    limits are raised to match the number of workers and tables.
+    """
+    buffer_pool = config.get('innodb-buffer-pool-size') or '128M'
+    if buffer_pool == 'auto':
+        buffer_pool = '128M'
+    try:
+        buffer_pool = parse_bytes(buffer_pool)
+    except ValueError, exc:
+        raise BackupError("Invalid innodb-buffer-pool-size: %s" % exc)
+    wanted = workers*256*1024**2
+    memory = available_memory()
+    if memory:
+        wanted = min(wanted, memory // 2)
+    buffer_pool = max(buffer_pool, wanted)
+    config['innodb-buffer-pool-size'] = int(buffer_pool)
+    if buffer_pool >= 1024**3:
+        config['loose-innodb-buffer-pool-instances'] = min(workers, 64)
+    config['loose-innodb-read-io-threads'] = min(max(workers, 4), 64)
+    # each mysqldump uses one connection; leave room for holland's own
+    config['max-connections'] = workers + 10
+    table_cache = max(400, min(tables, 4000), workers*64)
+    config['loose-table-open-cache'] = table_cache
+    config['open-files-limit'] = table_cache*2 + config['max-connections'] + \
+                                 1024
+    LOG.info("Sized snapshot mysqld for %d workers: "
+             "innodb-buffer-pool-size=%d max-connections=%d "
+             "open-files-limit=%d", workers, config['innodb-buffer-pool-size'],
+             config['max-connections'], config['open-files-limit'])
+    return config
+
 def generate_server_config(config, path):
     conf_data = StringIO()
     valid_params = [
@@ -85,6 +222,11 @@ def generate_server_config(config, path):
         'innodb-data-file-path',
         'innodb-fast-shutdown',
         'open-files-limit',
+        'max-connections',
+        'loose-table-open-cache',
+        'loose-innodb-buffer-pool-instances',
+        'loose-innodb-read-io-threads',
+        'loose-innodb-write-io-threads',
         'key-buffer-size',
         'tmpdir',
         'user',
@@ -1,21 +1,137 @@
 """Perform InnoDB recovery against a MySQL data directory"""
 
 import os
+import re
 import time
+import fnmatch
 import signal
 import logging
-from cStringIO import StringIO
-from subprocess import Popen, STDOUT, list2cmdline
 from holland.core.exceptions import BackupError
-from _mysqld import locate_mysqld_exe, generate_server_config, MySQLServer
+from holland.core.util.supervise import Supervisor
+from _mysqld import locate_mysqld_exe, generate_server_config, MySQLServer, \
+                    ErrorLogTail, size_recovery_config
 
 LOG = logging.getLogger(__name__)
 
+# files in the datadir that recovery may write to, relative to the
+# datadir.  Everything else can be archived while recovery is running.
+# On MariaDB the bootstrap mysqld also runs Aria recovery, which writes
+# the Aria logs and may rewrite any Aria table, and replays the DDL log
+# and the transaction coordinator log.
+RECOVERY_FILES = [
+    'ibdata*',
+    'ib_logfile*',
+    'ib_buffer_pool',
+    'ibtmp*',
+    '*.dblwr',
+    'undo*',
+    '*.ibd',
+    '*.ibu',
+    '*.isl',
+    '#innodb_*',
+    'aria_log*',
+    '*.MAI',
+    '*.MAD',
+    'ddl_recovery.log',
+    'tc.log',
+    'mysql/*',
+    '*.pid',
+    'innodb_recovery.log',
+    'my.innodb_recovery.cnf',
+]
+
+def is_recovery_file(relpath):
+    """Check whether InnoDB recovery may modify a datadir relative path"""
+    for pattern in RECOVERY_FILES:
+        # '*' also matches '/', so '*.ibd' covers every database directory
+        if fnmatch.fnmatch(relpath, pattern):
+            return True
+    return False
+
+class RecoveryProgress(object):
+    """Follow the redo log scan and apply batches of InnoDB crash recovery
+    in the mysqld error log
+
+    Understands the "Progress in percent:" output of MySQL 5.x, the
+    per-line percentages of MySQL 8.0 and the batch messages of MariaDB.
+    """
+    lsn_re = re.compile(r'scanned up to log sequence number (\d+)')
+    batch_re = re.compile(r'Starting an apply batch of log records|'
+                          r'Applying a batch of|'
+                          r'Starting (?:a|final) batch to recover')
+    percent_re = re.compile(r'\]\s+(\d+)%\s*$')
+
+    def __init__(self, path, interval=10):
+        self.tail = ErrorLogTail(path)
+        self.interval = interval
+        self.lsn = None
+        self.batches = 0
+        self.percent = None
+        self._logged_lsn = 0
+        self._logged_percent = None
+
+    def update(self):
+        """Read new error log output and log progress"""
+        for line in self.tail.lines():
+            self._parse(line)
+        # 5.x writes the percentages of a batch on a single line
+        if 'Progress in percent:' in self.tail.partial:
+            self._parse(self.tail.partial)
+
+    def _parse(self, line):
+        match = self.lsn_re.search(line)
+        if match:
+            self.lsn = int(match.group(1))
+            if time.time() - self._logged_lsn >= self.interval:
+                self._logged_lsn = time.time()
+                LOG.info("InnoDB recovery: scanned redo log up to LSN %d",
+                         self.lsn)
+            return
+        if self.batch_re.search(line):
+            self.batches += 1
+            self.percent = None
+            self._logged_percent = None
+            LOG.info("InnoDB recovery: applying redo log batch %d",
+                     self.batches)
+        if 'Progress in percent:' in line:
+            values = line.split('Progress in percent:', 1)[1].split()
+            values = [value for value in values if value.isdigit()]
+            if values:
+                self._report(int(values[-1]))
+            return
+        match = self.percent_re.search(line)
+        if match and self.batches:
+            self._report(int(match.group(1)))
+
+    def _report(self, percent):
+        self.percent = percent
+        if self._logged_percent is None or percent == 100 or \
+            percent >= self._logged_percent + 10:
+            self._logged_percent = percent
+            LOG.info("InnoDB recovery: batch %d is %d%% applied",
+                     self.batches, percent)
+
 class InnodbRecoveryAction(object):
-    def __init__(self, mysqld_config):
+    """Run InnoDB crash recovery on the snapshot with a bootstrap mysqld
+
+    With background set, mysqld is only started and wait() must be
+    called before the files recovery writes to are archived.
+
+    :param config: backup config to record metrics in
+    """
+    is_recovery_file = staticmethod(is_recovery_file)
+
+    def __init__(self, mysqld_config, config=None, background=False):
         self.mysqld_config = mysqld_config
         if 'datadir' not in mysqld_config:
             raise BackupError("datadir must be set for InnodbRecovery")
+        self.config = config
+        self.background = background
+        self.mysqld = None
+        self.supervisor = None
+        self.progress = None
+        self.interrupted = None
+        self.start_time = None
 
     def __call__(self, event, snapshot_fsm, snapshot):
         LOG.info("Starting InnoDB recovery")
@@ -23,20 +139,51 @@ class InnodbRecoveryAction(object):
         mysqld_exe = locate_mysqld_exe(self.mysqld_config)
         LOG.info("Bootstrapping with %s", mysqld_exe)
 
-        mycnf_path = os.path.join(self.mysqld_config['datadir'], 
-                                  'my.innodb_recovery.cnf')
+        datadir = self.mysqld_config['datadir']
+        mycnf_path = os.path.join(datadir, 'my.innodb_recovery.cnf')
         self.mysqld_config['log-error'] = 'innodb_recovery.log'
+        size_recovery_config(self.mysqld_config)
         my_conf = generate_server_config(self.mysqld_config,
                                          mycnf_path)
-        
-        mysqld = MySQLServer(mysqld_exe, my_conf)
-        mysqld.start(bootstrap=True)
-
-        while mysqld.poll() is None:
-            if signal.SIGINT in snapshot_fsm.sigmgr.pending:
-                mysqld.kill(signal.SIGKILL)
-            time.sleep(0.5)
+
+        self.progress = RecoveryProgress(os.path.join(datadir,
+                                                      'innodb_recovery.log'))
+        self.interrupted = lambda: signal.SIGINT in snapshot_fsm.sigmgr.pending
+        self.supervisor = Supervisor()
+        self.start_time = time.time()
+        try:
+            # error log writes wake up the wait to report progress
+            self.supervisor.watch_directory(datadir)
+            self.mysqld = MySQLServer(mysqld_exe, my_conf, self.supervisor)
+            self.mysqld.start(bootstrap=True)
+        except:
+            self.supervisor.close()
+            raise
+        if self.background:
+            LOG.info("InnoDB recovery is running in the background")
+            return
+        self.wait()
+
+    def wait(self):
+        """Wait for mysqld to finish recovery
+
+        :raises: BackupError if mysqld failed
+        """
+        if self.mysqld is None:
+            return
+        mysqld_exe = self.mysqld.mysqld_exe
+        def interrupted():
+            self.progress.update()
+            return self.interrupted()
+        try:
+            self.supervisor.wait_process(self.mysqld.process, interrupted)
+            self.mysqld.poll()
+            self.progress.update()
+        finally:
+            self.supervisor.close()
+            self._record_metrics()
         LOG.info("%s has stopped", mysqld_exe)
+        mysqld, self.mysqld = self.mysqld, None
 
         if mysqld.returncode != 0:
             datadir = self.mysqld_config['datadir']
@@ -46,3 +193,27 @@ class InnodbRecoveryAction(object):
                               "InnoDB recovery" % (mysqld_exe, mysqld.returncode))
         else:
             LOG.info("%s ran successfully", mysqld_exe)
+
+    def cancel(self):
+        """Kill a mysqld still running recovery so the snapshot can be
+        unmounted"""
+        if self.mysqld is None:
+            return
+        try:
+            self.mysqld.kill_safe(signal.SIGKILL)
+            self.supervisor.wait_process(self.mysqld.process)
+        finally:
+            self.supervisor.close()
+            self.mysqld = None
+
+    def _record_metrics(self):
+        if self.config is None:
+            return
+        metrics = self.config.setdefault('holland:metrics', {})
+        metrics['innodb-recovery-time'] = '%.3f' % \
+                                          (time.time() - self.start_time)
+        metrics['innodb-recovery-buffer-pool-size'] = \
+            self.mysqld_config['innodb-buffer-pool-size']
+        metrics['innodb-recovery-batches'] = self.progress.batches
+        if self.progress.lsn is not None:
+            metrics['innodb-recovery-lsn'] = self.progress.lsn
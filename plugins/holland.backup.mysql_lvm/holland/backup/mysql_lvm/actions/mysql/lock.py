@@ -1,20 +1,21 @@
 import logging
+from holland.lib.mysql.lock import GlobalReadLock
 
 LOG = logging.getLogger(__name__)
 
 class FlushAndLockMySQLAction(object):
-    def __init__(self, client, extra_flush=True):
+    def __init__(self, client, extra_flush=True, lock=None, config=None):
         self.client = client
         self.extra_flush = extra_flush
+        self.lock = lock or GlobalReadLock(client)
+        self.config = config
 
     def __call__(self, event, snapshot_fsm, snapshot_vol):
         if event == 'pre-snapshot':
-            if self.extra_flush:
-                LOG.debug("Executing FLUSH TABLES")
-                self.client.flush_tables()
-            LOG.debug("Executing FLUSH TABLES WITH READ LOCK")
             LOG.info("Acquiring read-lock and flushing tables")
-            self.client.flush_tables_with_read_lock()
+            self.lock.acquire(extra_flush=self.extra_flush)
         elif event == 'post-snapshot':
             LOG.info("Releasing read-lock")
-            self.client.unlock_tables()
+            self.lock.release()
+            if self.config is not None:
+                self.lock.record_metrics(self.config)
@@ -4,15 +4,28 @@ import os
 import time
 import signal
 import logging
+from holland.core.exceptions import BackupError
+from holland.core.util.supervise import Supervisor
 from holland.lib.mysql import connect, MySQLError, PassiveMySQLClient
-from _mysqld import generate_server_config, MySQLServer, locate_mysqld_exe
+from _mysqld import generate_server_config, MySQLServer, locate_mysqld_exe, \
+                    size_server_config, size_recovery_config, \
+                    ErrorLogWatch
 
 LOG = logging.getLogger(__name__)
 
 class MySQLDumpDispatchAction(object):
-    def __init__(self, mysqldump_plugin, mysqld_config):
+    """Start a mysqld on the snapshot and run the mysqldump plugin
+    against it
+
+    Nothing else writes to that mysqld, so with more than one worker
+    databases or tables are dumped in parallel without any locking.
+    """
+    def __init__(self, mysqldump_plugin, mysqld_config, workers=1,
+                 unit='database'):
         self.mysqldump_plugin = mysqldump_plugin
         self.mysqld_config = mysqld_config
+        self.workers = workers
+        self.unit = unit
 
     def __call__(self, event, snapshot_fsm, snapshot):
         LOG.info("Handing-off to mysqldump plugin")
@@ -36,30 +49,75 @@ class MySQLDumpDispatchAction(object):
         # log-bin is disabled to avoid conflict with the normal mysqld process
         self.mysqldump_plugin.config['mysqldump']['bin-log-position'] = False
 
-        mysqld = MySQLServer(mysqld_exe, my_conf)
+        if self.workers > 1:
+            tables = 0
+            for database in self.mysqldump_plugin.schema.databases:
+                tables += len(database.tables)
+            size_server_config(self.mysqld_config, self.workers, tables)
+            # the snapshot instance is static, so there is nothing to lock
+            LOG.info("Dumping with %d workers per %s without locking",
+                     self.workers, self.unit)
+            self.mysqldump_plugin.config['mysqldump']['lock-method'] = 'none'
+            self.mysqldump_plugin.workers = self.workers
+            self.mysqldump_plugin.parallel_unit = self.unit
+        elif self.mysqld_config.get('innodb-buffer-pool-size') == 'auto':
+            size_recovery_config(self.mysqld_config)
+
+        supervisor = Supervisor()
+        mysqld = MySQLServer(mysqld_exe, my_conf, supervisor)
+        ready = ErrorLogWatch(os.path.join(datadir, 'holland_lvm.log'))
         mysqld.start(bootstrap=False)
         LOG.info("Waiting for %s to start", mysqld_exe)
 
+        start = time.time()
         try:
             wait_for_mysqld(self.mysqldump_plugin.mysql_config['client'],
-                            mysqld)
+                            mysqld, ready, supervisor)
             LOG.info("%s accepting connections on unix socket %s", mysqld_exe, socket)
+            if self.workers > 1 and self.unit == 'table':
+                # list the tables actually on the snapshot
+                self.mysqldump_plugin.refresh_schema()
             self.mysqldump_plugin.backup()
         finally:
-            mysqld.kill(signal.SIGKILL) # DIE DIE DIE
+            mysqld.kill_safe(signal.SIGKILL) # DIE DIE DIE
             mysqld.stop() # we dont' really care about the exit code, if mysqldump ran smoothly :)
+            supervisor.close()
+            metrics = self.mysqldump_plugin.config.setdefault('holland:metrics',
+                                                              {})
+            metrics['mysqldump-workers'] = self.workers
+            metrics['mysqldump-time'] = '%.3f' % (time.time() - start)
+
+def wait_for_mysqld(config, mysqld, ready=None, supervisor=None):
+    """Wait until mysqld accepts connections
+
+    With an ErrorLogWatch and the Supervisor reaping mysqld, this sleeps
+    until mysqld logs that it is ready for connections, waking up only
+    when the directory holding its error log changes, and then confirms
+    that with a single connection.  Otherwise, or if that connection
+    fails, connecting is retried every 0.75 seconds.
 
-def wait_for_mysqld(config, mysqld):
+    :raises: BackupError if mysqld exits first
+    """
+    exited = lambda: mysqld.poll() is not None
+    if ready is not None and supervisor is not None:
+        supervisor.watch_directory(os.path.dirname(ready.path))
+        supervisor.wait(lambda: exited() or ready())
     client = connect(config, PassiveMySQLClient)
     LOG.debug("connect via client %r", client)
-    while mysqld.process.poll() is None:
+    while not exited():
         try:
             client.connect()
             client.ping()
             LOG.debug("Ping succeeded")
         except MySQLError:
-            time.sleep(0.75)
+            if supervisor is not None:
+                supervisor.wait(exited, timeout=0.75)
+            else:
+                time.sleep(0.75)
             continue
         else:
             break
     client.disconnect()
+    if exited():
+        raise BackupError("mysqld exited with status %s before accepting "
+                          "connections" % mysqld.returncode)
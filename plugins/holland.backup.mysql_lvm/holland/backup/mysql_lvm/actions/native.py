@@ -0,0 +1,358 @@
+"""
+In-process parallel tar archiver for LVM snapshots
+
+Rather than running a single GNU tar over the snapshot, files are split
+into size-balanced shards which are written as independent tar archives
+by several reader threads, each through its own compression stream.
+Every shard can be extracted on its own with GNU tar.
+
+Sparse files (such as preallocated InnoDB tablespaces) are written as
+old GNU sparse members.  Only their data regions, found with
+SEEK_DATA/SEEK_HOLE, are read from the snapshot.
+"""
+
+import os
+import pwd
+import grp
+import stat
+import time
+import errno
+import fnmatch
+import signal
+import logging
+import tarfile
+import threading
+from holland.core.exceptions import BackupError
+
+LOG = logging.getLogger(__name__)
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+RECORDSIZE = tarfile.RECORDSIZE
+
+# lseek(2) whence values for sparse files (linux >= 3.1)
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+def _octal(value, length):
+    """Format value as a NUL terminated octal field of ``length`` bytes"""
+    return "%0*o\0" % (length - 1, value)
+
+def _checksum(header):
+    """Update the checksum field of a 512 byte tar header"""
+    header = header[:148] + ' '*8 + header[156:]
+    chksum = 0
+    for char in header:
+        chksum += ord(char)
+    return header[:148] + "%06o\0 " % chksum + header[156:]
+
+def data_regions(fd, size):
+    """
+    List the (offset, length) of each data region of the file open on fd
+
+    Holes are found with SEEK_DATA/SEEK_HOLE.  Where those are not
+    supported the whole file is returned as a single region.
+    """
+    regions = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, exc:
+                if exc.errno == errno.ENXIO:
+                    # no data past offset
+                    break
+                raise
+            end = os.lseek(fd, start, SEEK_HOLE)
+            regions.append((start, min(end, size) - start))
+            offset = end
+    except OSError, exc:
+        if exc.errno not in (errno.EINVAL, errno.ENOTSUP):
+            raise
+        return [(0, size)]
+    return regions
+
+def sparse_header(tarinfo, regions):
+    """
+    Build the header blocks for an old GNU format sparse member
+
+    :returns: header string (a multiple of BLOCKSIZE bytes)
+    """
+    stored = sum([length for offset, length in regions])
+    if not regions or regions[-1][0] + regions[-1][1] < tarinfo.size:
+        # GNU tar expects the map to cover the end of the file
+        regions = regions + [(tarinfo.size, 0)]
+    realsize = tarinfo.size
+    tarinfo.size = stored
+    buf = tarinfo.tobuf(tarfile.GNU_FORMAT)
+    tarinfo.size = realsize
+    prefix, header = buf[:-BLOCKSIZE], buf[-BLOCKSIZE:]
+    sparse = ''
+    for offset, length in regions[:4]:
+        sparse += _octal(offset, 12) + _octal(length, 12)
+    sparse = sparse.ljust(4*24, '\0')
+    extended = regions[4:]
+    header = header[:156] + tarfile.GNUTYPE_SPARSE + header[157:386] + \
+             sparse + chr(bool(extended)) + _octal(realsize, 12) + \
+             header[495:]
+    result = [prefix, _checksum(header)]
+    while extended:
+        block = ''
+        for offset, length in extended[:21]:
+            block += _octal(offset, 12) + _octal(length, 12)
+        extended = extended[21:]
+        block = block.ljust(504, '\0') + chr(bool(extended))
+        result.append(block.ljust(BLOCKSIZE, '\0'))
+    return ''.join(result)
+
+class _Owner(object):
+    """Cache of uid/gid to user and group names"""
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+
+    def uname(self, uid):
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self.users[uid] = ''
+        return self.users[uid]
+
+    def gname(self, gid):
+        if gid not in self.groups:
+            try:
+                self.groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self.groups[gid] = ''
+        return self.groups[gid]
+
+class TarShard(object):
+    """A single tar archive written to an output stream"""
+    def __init__(self, stream, owner):
+        self.stream = stream
+        self.owner = owner
+        self.size = 0
+        self.offset = 0
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def _tarinfo(self, path, name, info):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mode = stat.S_IMODE(info.st_mode)
+        tarinfo.uid = info.st_uid
+        tarinfo.gid = info.st_gid
+        tarinfo.uname = self.owner.uname(info.st_uid)
+        tarinfo.gname = self.owner.gname(info.st_gid)
+        tarinfo.mtime = int(info.st_mtime)
+        if stat.S_ISDIR(info.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(info.st_mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        else:
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = info.st_size
+        return tarinfo
+
+    def add(self, path, name, info):
+        """Add path to the archive as name"""
+        tarinfo = self._tarinfo(path, name, info)
+        if tarinfo.type != tarfile.REGTYPE:
+            self._write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = tarinfo.size
+            regions = [(0, size)]
+            if info.st_blocks*512 < size:
+                regions = data_regions(fd, size)
+            if regions == [(0, size)]:
+                self._write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+            else:
+                LOG.debug("%s is sparse (%d data regions)", name,
+                          len(regions))
+                self._write(sparse_header(tarinfo, regions))
+            stored = 0
+            for offset, length in regions:
+                os.lseek(fd, offset, os.SEEK_SET)
+                remaining = length
+                while remaining:
+                    data = os.read(fd, min(remaining, 1024*1024))
+                    if not data:
+                        # file shrunk; pad with zeros like GNU tar does
+                        data = '\0' * min(remaining, 1024*1024)
+                    self._write(data)
+                    remaining -= len(data)
+                stored += length
+            padding = (BLOCKSIZE - stored % BLOCKSIZE) % BLOCKSIZE
+            if padding:
+                self._write('\0' * padding)
+        finally:
+            os.close(fd)
+        self.size += size
+
+    def close(self):
+        """Write the end-of-archive marker and close the output stream"""
+        self._write('\0' * (BLOCKSIZE*2))
+        padding = (RECORDSIZE - self.offset % RECORDSIZE) % RECORDSIZE
+        if padding:
+            self._write('\0' * padding)
+        self.stream.close()
+
+def plan_shards(top, excludes, count, include=None, directories=True):
+    """
+    Walk top and split its contents into ``count`` lists of
+    (path, name, stat) of roughly equal total size
+
+    Directories and symlinks all go in the first shard unless
+    ``directories`` is false.  Regular files are assigned largest first to
+    the currently smallest shard.  Other special files (such as sockets)
+    are skipped like GNU tar does.
+
+    :param include: only add regular files whose path relative to top
+                    this callable returns true for
+    """
+    shards = [[] for idx in xrange(count)]
+    totals = [0] * count
+    files = []
+    for root, dirs, names in os.walk(top):
+        for name in dirs + names:
+            path = os.path.join(root, name)
+            relpath = path[len(top):].lstrip(os.sep)
+            arcname = os.path.join('.', relpath)
+            excluded = False
+            for pattern in excludes:
+                if fnmatch.fnmatch(relpath, pattern) or \
+                    fnmatch.fnmatch(arcname, pattern):
+                    excluded = True
+                    break
+            if excluded:
+                if name in dirs:
+                    dirs.remove(name)
+                continue
+            info = os.lstat(path)
+            if stat.S_ISREG(info.st_mode):
+                if include is None or include(relpath):
+                    files.append((info.st_size, path, arcname, info))
+            elif stat.S_ISDIR(info.st_mode) or stat.S_ISLNK(info.st_mode):
+                if directories:
+                    shards[0].append((path, arcname, info))
+            else:
+                LOG.debug("Skipping special file %s", path)
+    files.sort()
+    files.reverse()
+    for size, path, arcname, info in files:
+        idx = totals.index(min(totals))
+        shards[idx].append((path, arcname, info))
+        totals[idx] += size
+    return shards
+
+class NativeArchiveAction(object):
+    """
+    Archive a snapshot into size-balanced tar shards written in parallel
+
+    If ``recovery`` is an InnodbRecoveryAction running in the background,
+    the files it does not modify are archived first.  The remaining files
+    are planned and archived once recovery.wait() returns.
+    """
+    def __init__(self, snap_datadir, archive_streams, config, recovery=None):
+        self.snap_datadir = snap_datadir
+        self.archive_streams = archive_streams
+        self.config = config
+        self.recovery = recovery
+        self._abort = False
+
+    def __call__(self, event, snapshot_fsm, snapshot_vol):
+        start = time.time()
+        excludes = [param for param in self.config['exclude']]
+        count = len(self.archive_streams)
+        archive_dirname = os.path.dirname(self.archive_streams[0].name)
+        archive_log = open(os.path.join(archive_dirname, 'archive.log'), 'w')
+        owner = _Owner()
+        shards = [TarShard(stream, owner) for stream in self.archive_streams]
+        errors = []
+        try:
+            if self.recovery is None:
+                plan = plan_shards(self.snap_datadir, excludes, count)
+                self._archive(zip(plan, shards), snapshot_fsm, archive_log)
+            else:
+                recovering = self.recovery.is_recovery_file
+                LOG.info("Archiving files not modified by InnoDB recovery")
+                plan = plan_shards(self.snap_datadir, excludes, count,
+                                   include=lambda path: not recovering(path))
+                self._archive(zip(plan, shards), snapshot_fsm, archive_log)
+                LOG.info("Waiting for InnoDB recovery to finish")
+                self.recovery.wait()
+                plan = plan_shards(self.snap_datadir, excludes, count,
+                                   include=recovering,
+                                   directories=False)
+                self._archive(zip(plan, shards), snapshot_fsm, archive_log)
+        finally:
+            if self.recovery is not None:
+                self.recovery.cancel()
+            archive_log.close()
+            for shard in shards:
+                try:
+                    shard.close()
+                except IOError, exc:
+                    LOG.error("Failed to close %s: %s", shard.stream.name,
+                              exc)
+                    errors.append(exc)
+        if errors:
+            raise BackupError(str(errors[0]))
+        LOG.info("Archived snapshot in %.2f seconds", time.time() - start)
+
+    def _archive(self, pending, snapshot_fsm, archive_log):
+        """Add members to their shards from a pool of reader threads
+
+        :param pending: list of (members, TarShard) to archive
+        """
+        lock = threading.Lock()
+        errors = []
+
+        def reader():
+            while True:
+                lock.acquire()
+                try:
+                    if not pending or errors or self._abort:
+                        return
+                    members, shard = pending.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    for path, name, info in members:
+                        if self._abort:
+                            raise BackupError("Interrupted")
+                        shard.add(path, name, info)
+                        lock.acquire()
+                        try:
+                            print >>archive_log, name
+                        finally:
+                            lock.release()
+                except Exception, exc:
+                    LOG.error("Failed to archive to %s: %s",
+                              shard.stream.name, exc)
+                    errors.append(exc)
+
+        readers = min(self.config['readers'], len(pending)) or 1
+        LOG.info("Archiving %s into %d shard(s) with %d reader thread(s)",
+                 self.snap_datadir, len(pending), readers)
+        threads = []
+        for idx in xrange(readers):
+            thread = threading.Thread(target=reader)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.isAlive():
+                if signal.SIGINT in snapshot_fsm.sigmgr.pending:
+                    self._abort = True
+                thread.join(0.5)
+
+        if signal.SIGINT in snapshot_fsm.sigmgr.pending:
+            raise KeyboardInterrupt("Interrupted")
+        if errors:
+            raise BackupError(str(errors[0]))
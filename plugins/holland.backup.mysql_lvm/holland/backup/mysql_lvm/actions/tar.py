@@ -1,10 +1,10 @@
 import os
-import time
 import shlex
 import signal
 import logging
 from subprocess import list2cmdline, Popen, CalledProcessError
 from holland.core.exceptions import BackupError
+from holland.core.util.supervise import Supervisor
 
 LOG = logging.getLogger(__name__)
 
@@ -57,10 +57,13 @@ class TarArchiveAction(object):
                         stdout=self.archive_stream,
                         stderr=open(archive_log, 'w'),
                         close_fds=True)
-        while process.poll() is None:
-            if signal.SIGINT in snapshot_fsm.sigmgr.pending:
-                os.kill(process.pid, signal.SIGKILL)
-            time.sleep(0.5)
+        supervisor = Supervisor()
+        try:
+            supervisor.watch(process)
+            interrupted = lambda: signal.SIGINT in snapshot_fsm.sigmgr.pending
+            supervisor.wait_process(process, interrupted)
+        finally:
+            supervisor.close()
 
         try:
             self.archive_stream.close()
@@ -9,7 +9,9 @@ from holland.core.exceptions import BackupError
 from holland.core.util.fmt import format_bytes
 from holland.lib.mysql import PassiveMySQLClient, MySQLError, \
                               build_mysql_config, connect
-from holland.lib.lvm import Snapshot, parse_bytes
+from holland.lib.mysql.lock import GlobalReadLock, BackupLock
+from holland.core.spool import spool
+from holland.lib.lvm import Snapshot, SnapshotMonitor, parse_bytes
 
 LOG = logging.getLogger(__name__)
 
@@ -30,15 +32,96 @@ def cleanup_tempdir(path):
     LOG.info("Removing temporary mountpoint %s", path)
     shutil.rmtree(path)
 
-def build_snapshot(config, logical_volume, suppress_tmpdir=False):
+def predict_snapshot_size(backup_directory, margin=1.5, count=5):
+    """Predict the copy-on-write space a snapshot will need from the
+    snapshot usage and duration recorded by previous backups
+
+    The highest rate of snapshot growth seen over the last ``count``
+    backups is assumed to last as long as the longest of those backups,
+    and ``margin`` is applied on top of that.
+
+    :returns: predicted size in bytes or None if there is no usable history
+    """
+    backup_directory = os.path.abspath(backup_directory)
+    # previous backups may be stored on any root of the spool
+    backupset = spool.backupset_of(backup_directory)
+    rates = []
+    durations = []
+    for backup in backupset.list_backups(reverse=True) or []:
+        if os.path.abspath(backup.path) == backup_directory:
+            continue
+        config = backup.config['holland:backup']
+        metrics = backup.config.get('holland:metrics', {})
+        duration = config['stop-time'] - config['start-time']
+        try:
+            used = max(float(metrics.get('snapshot-peak-bytes', 0)),
+                       float(metrics.get('snapshot-final-bytes', 0)))
+        except ValueError:
+            continue
+        if duration <= 0 or used <= 0:
+            continue
+        rates.append(used / duration)
+        durations.append(duration)
+        if len(rates) >= count:
+            break
+    if not rates:
+        return None
+    return int(max(rates) * max(durations) * margin)
+
+def history_snapshot_extents(config, logical_volume, backup_directory):
+    """Size a snapshot from the usage of previous snapshots
+
+    :returns: snapshot size in extents or None if there is no usable history
+    """
+    predicted = None
+    if backup_directory:
+        predicted = predict_snapshot_size(backup_directory,
+                                          config.get('snapshot-size-margin',
+                                                     1.5))
+    if predicted is None:
+        LOG.info("No snapshot usage recorded by previous backups. "
+                 "Using the default snapshot-size.")
+        return None
+    extent_size = int(logical_volume.vg_extent_size)
+    # never go below 1% of the origin volume
+    size = max(predicted, int(logical_volume.lv_size) // 100)
+    extents = (size + extent_size - 1) // extent_size
+    LOG.info("Auto-sizing snapshot-size to %s (%d extents) from previous "
+             "snapshot usage", format_bytes(extents*extent_size), extents)
+    free_extents = int(logical_volume.vg_free_count)
+    if extents > free_extents:
+        LOG.warning("Only %s is free in volume group %s. "
+                    "Truncating snapshot-size to %d extents",
+                    format_bytes(free_extents*extent_size),
+                    logical_volume.vg_name, free_extents)
+        extents = free_extents
+    if extents < 1:
+        raise BackupError("Insufficient free extents on %s "
+                          "to create snapshot (free extents = %s)" %
+                          (logical_volume.device_name(),
+                          logical_volume.vg_free_count))
+    return extents
+
+def build_snapshot(config, logical_volume, suppress_tmpdir=False,
+                   backup_directory=None):
     """Create a snapshot process for running through the various steps
     of creating, mounting, unmounting and removing a snapshot
+
+    With snapshot-size = auto the snapshot is sized from the history of
+    the backups in the backupset of ``backup_directory``.
     """
     snapshot_name = config['snapshot-name'] or \
                     logical_volume.lv_name + '_snapshot'
     extent_size = int(logical_volume.vg_extent_size)
     snapshot_size = config['snapshot-size']
-    if not snapshot_size:
+    auto_extents = None
+    if snapshot_size == 'auto':
+        auto_extents = history_snapshot_extents(config, logical_volume,
+                                                backup_directory)
+        snapshot_size = None
+    if auto_extents:
+        snapshot_size = auto_extents
+    elif not snapshot_size:
         snapshot_size = min(int(logical_volume.vg_free_count),
                             (int(logical_volume.lv_size)*0.2) / extent_size,
                             (15*1024**3) / extent_size,
@@ -89,16 +172,60 @@ def build_snapshot(config, logical_volume, suppress_tmpdir=False):
             if exc.errno != errno.EEXIST:
                 raise BackupError("Failure creating snapshot mountpoint: %s" %
                                   str(exc))
-    snapshot = Snapshot(snapshot_name, int(snapshot_size), mountpoint)
+    snapshot = Snapshot(snapshot_name, int(snapshot_size), mountpoint,
+                        monitor=build_monitor(config, extent_size))
     if tempdir:
         snapshot.register('finish',
                           lambda *args, **kwargs: cleanup_tempdir(mountpoint))
     return snapshot
 
-def log_final_snapshot_size(event, snapshot):
-    """Log the final size of the snapshot before it is removed"""
+def build_monitor(config, extent_size):
+    """Create a monitor to watch and extend the snapshot while it is
+    mounted"""
+    threshold = config.get('snapshot-extend-threshold', 80) or None
+    extend_extents = None
+    extend_size = config.get('snapshot-extend-size')
+    if extend_size:
+        try:
+            extend_extents = max(1, parse_bytes(extend_size) / extent_size)
+        except ValueError, exc:
+            raise BackupError("Problem parsing snapshot-extend-size %s" % exc)
+    return SnapshotMonitor(threshold=threshold,
+                           extend_extents=extend_extents,
+                           interval=config.get('snapshot-monitor-interval', 5))
+
+def build_lock(config, client):
+    """Create the lock taken around the snapshot from a [mysql-lvm]
+    config section"""
+    kwargs = dict(long_query_time=config['long-query-time'],
+                  action=config['long-query-action'],
+                  timeout=config['lock-wait-timeout'])
+    if config.get('lock-method') == 'backup-lock':
+        return BackupLock(client, **kwargs)
+    return GlobalReadLock(client, **kwargs)
+
+def record_snapshot_metrics(config, snapshot):
+    """Record the snapshot usage seen by the snapshot's monitor in the
+    [holland:metrics] section of the backup config"""
+    if not snapshot.monitor or not snapshot.monitor.stats:
+        return
+    metrics = config.setdefault('holland:metrics', {})
+    for key, value in snapshot.monitor.stats.items():
+        if isinstance(value, float):
+            value = '%.2f' % value
+        metrics['snapshot-' + key] = value
+
+def log_final_snapshot_size(event, snapshot, config=None):
+    """Log the final size of the snapshot before it is removed
+
+    If a backup config is given the size is also recorded as
+    snapshot-final-bytes in its [holland:metrics] section.
+    """
     snapshot.reload()
     snap_percent = float(snapshot.snap_percent)/100
     snap_size = float(snapshot.lv_size)
     LOG.info("Final LVM snapshot size for %s is %s",
         snapshot.device_name(), format_bytes(snap_size*snap_percent))
+    if config is not None:
+        metrics = config.setdefault('holland:metrics', {})
+        metrics['snapshot-final-bytes'] = int(snap_size*snap_percent)
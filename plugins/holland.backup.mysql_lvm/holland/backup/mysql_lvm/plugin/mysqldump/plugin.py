@@ -10,7 +10,8 @@ from holland.core.util.fmt import format_bytes
 from holland.core.util.path import directory_size
 from holland.core.exceptions import BackupError
 from holland.backup.mysql_lvm.plugin.common import build_snapshot, \
-                                                   connect_simple
+                                                   connect_simple, \
+                                                   record_snapshot_metrics
 from holland.backup.mysql_lvm.plugin.mysqldump.util import setup_actions
 from holland.backup.mysqldump import MySQLDumpPlugin
 
@@ -22,18 +23,50 @@ CONFIGSPEC = """
 snapshot-name = string(default=None)
 
 # default: minimum of 20% of mysql lv or mysql vg free size
+# auto: predict from the snapshot usage of previous backups
 snapshot-size = string(default=None)
 
+# safety margin applied to the snapshot-size = auto prediction
+snapshot-size-margin = float(min=1.0, default=1.5)
+
 # default: temporary directory
 snapshot-mountpoint = string(default=None)
 
+# extend the snapshot when it is this percent full (0 disables)
+snapshot-extend-threshold = integer(min=0, max=99, default=80)
+
+# default: 20% of the current snapshot size
+snapshot-extend-size = string(default=None)
+
+# seconds between checks of snapshot usage
+snapshot-monitor-interval = integer(min=1, default=5)
+
 # default: flush tables with read lock by default
 lock-tables = boolean(default=yes)
 
+# flush-lock: FLUSH TABLES WITH READ LOCK
+# backup-lock: LOCK TABLES FOR BACKUP where the server supports it,
+#              otherwise flush-lock
+lock-method = option('flush-lock', 'backup-lock', default='flush-lock')
+
 # default: do an extra (non-locking) flush tables before
 #          run flush tables with read lock
 extra-flush-tables = boolean(default=yes)
 
+# before locking, statements running longer than this many seconds
+# are waited for, killed or cause the backup to abort (0 disables)
+long-query-time = integer(min=0, default=60)
+long-query-action = option('wait', 'kill', 'abort', default='wait')
+
+# seconds to wait for long queries and for the read lock itself
+lock-wait-timeout = integer(min=1, default=300)
+
+# number of mysqldump processes run at once against the snapshot
+dump-workers = integer(min=1, default=1)
+
+# with several dump-workers, dump each database or each table separately
+dump-unit = option('database', 'table', default='database')
+
 [mysqld]
 mysqld-exe              = force_list(default=list('mysqld', '/usr/libexec/mysqld'))
 user                    = string(default='mysql')
@@ -91,7 +124,8 @@ class MysqlDumpLVMBackup(object):
 
         # create a snapshot manager
         snapshot = build_snapshot(self.config['mysql-lvm'], volume,
-                                  suppress_tmpdir=self.dry_run)
+                                  suppress_tmpdir=self.dry_run,
+                                  backup_directory=self.target_directory)
         # calculate where the datadirectory on the snapshot will be located
         rpath = relpath(datadir, getmount(datadir))
         snap_datadir = os.path.abspath(os.path.join(snapshot.mountpoint or
@@ -117,15 +151,18 @@ class MysqlDumpLVMBackup(object):
             return self.mysqldump_plugin.backup()
 
         try:
-            snapshot.start(volume)
-        except CallbackFailuresError, exc:
-            # XXX: one of our actions failed.  Log this better
-            for callback, error in exc.errors:
-                LOG.error("%s", error)
-            raise BackupError("Error occurred during snapshot process. Aborting.")
-        except LVMCommandError, exc:
-            # Something failed in the snapshot process
-            raise BackupError(str(exc))
+            try:
+                snapshot.start(volume)
+            except CallbackFailuresError, exc:
+                # XXX: one of our actions failed.  Log this better
+                for callback, error in exc.errors:
+                    LOG.error("%s", error)
+                raise BackupError("Error occurred during snapshot process. Aborting.")
+            except LVMCommandError, exc:
+                # Something failed in the snapshot process
+                raise BackupError(str(exc))
+        finally:
+            record_snapshot_metrics(self.config, snapshot)
 
     def _dry_run(self, volume, snapshot, datadir):
         """Implement dry-run for LVM snapshots.
@@ -12,7 +12,8 @@ from holland.backup.mysql_lvm.actions import FlushAndLockMySQLAction, \
                                              RecordMySQLReplicationAction, \
                                              MySQLDumpDispatchAction
 from holland.backup.mysql_lvm.plugin.common import log_final_snapshot_size, \
-                                                   connect_simple
+                                                   connect_simple, \
+                                                   build_lock
 from holland.backup.mysql_lvm.plugin.innodb import MySQLPathInfo, check_innodb
 
 LOG = logging.getLogger(__name__)
@@ -28,7 +29,8 @@ def setup_actions(snapshot, config, client, datadir, spooldir, plugin):
 
     if config['mysql-lvm']['lock-tables']:
         extra_flush = config['mysql-lvm']['extra-flush-tables']
-        act = FlushAndLockMySQLAction(client, extra_flush)
+        lock = build_lock(config['mysql-lvm'], client)
+        act = FlushAndLockMySQLAction(client, extra_flush, lock, config)
         snapshot.register('pre-snapshot', act, priority=100)
         snapshot.register('post-snapshot', act, priority=100)
     if config['mysql-lvm'].get('replication', True):
@@ -80,7 +82,9 @@ def setup_actions(snapshot, config, client, datadir, spooldir, plugin):
             LOG.info("Remapped innodb-log-group-home-dir from %s to %s for snapshot",
                      pathinfo.get_innodb_logdir(), ib_logdir)
 
-    act = MySQLDumpDispatchAction(plugin, mysqld_config)
+    act = MySQLDumpDispatchAction(plugin, mysqld_config,
+                                  workers=config['mysql-lvm']['dump-workers'],
+                                  unit=config['mysql-lvm']['dump-unit'])
     snapshot.register('post-mount', act, priority=100)
 
     errlog_src = os.path.join(datadir, 'holland_lvm.log')
@@ -90,4 +94,7 @@ def setup_actions(snapshot, config, client, datadir, spooldir, plugin):
                                                               errlog_dst)
                      )
 
-    snapshot.register('pre-remove', log_final_snapshot_size)
+    snapshot.register('pre-remove',
+                      lambda event, volume: log_final_snapshot_size(event,
+                                                                    volume,
+                                                                    config))
@@ -3,13 +3,15 @@
 import os
 import logging
 import tempfile
-from holland.core.util.path import directory_size, format_bytes
+from holland.core.util.path import format_bytes
 from holland.core.exceptions import BackupError
 from holland.lib.lvm import LogicalVolume, CallbackFailuresError, \
                             LVMCommandError, relpath, getmount
 from holland.lib.mysql.client import MySQLError
+from holland.lib.mysql.size import estimate_datadir_size
 from holland.backup.mysql_lvm.plugin.common import build_snapshot, \
-                                                   connect_simple
+                                                   connect_simple, \
+                                                   record_snapshot_metrics
 from holland.backup.mysql_lvm.plugin.raw.util import setup_actions
 
 LOG = logging.getLogger(__name__)
@@ -20,39 +22,76 @@ CONFIGSPEC = """
 snapshot-name = string(default=None)
 
 # default: minimum of 20% of mysql lv or mysql vg free size
+# auto: predict from the snapshot usage of previous backups
 snapshot-size = string(default=None)
 
+# safety margin applied to the snapshot-size = auto prediction
+snapshot-size-margin = float(min=1.0, default=1.5)
+
 # default: temporary directory
 snapshot-mountpoint = string(default=None)
 
+# extend the snapshot when it is this percent full (0 disables)
+snapshot-extend-threshold = integer(min=0, max=99, default=80)
+
+# default: 20% of the current snapshot size
+snapshot-extend-size = string(default=None)
+
+# seconds between checks of snapshot usage
+snapshot-monitor-interval = integer(min=1, default=5)
+
 # default: no
 innodb-recovery = boolean(default=no)
 
+# archive files InnoDB recovery does not modify while it is running
+# (archiver = native only)
+innodb-recovery-overlap = boolean(default=no)
+
 # ignore errors due to strange innodb configurations
 force-innodb-backup = boolean(default=no)
 
 # default: flush tables with read lock by default
 lock-tables = boolean(default=yes)
 
+# flush-lock: FLUSH TABLES WITH READ LOCK
+# backup-lock: LOCK TABLES FOR BACKUP where the server supports it,
+#              otherwise flush-lock
+lock-method = option('flush-lock', 'backup-lock', default='flush-lock')
+
 # default: do an extra (non-locking) flush tables before
 #          run flush tables with read lock
 extra-flush-tables = boolean(default=yes)
 
+# before locking, statements running longer than this many seconds
+# are waited for, killed or cause the backup to abort (0 disables)
+long-query-time = integer(min=0, default=60)
+long-query-action = option('wait', 'kill', 'abort', default='wait')
+
+# seconds to wait for long queries and for the read lock itself
+lock-wait-timeout = integer(min=1, default=300)
+
 [mysqld]
 mysqld-exe              = force_list(default=list('mysqld', '/usr/libexec/mysqld'))
 user                    = string(default='mysql')
-innodb-buffer-pool-size = string(default=128M)
+# auto: half of the available memory for InnoDB recovery
+innodb-buffer-pool-size = string(default=auto)
 tmpdir                  = string(default=None)
 
 [tar]
 exclude = force_list(default='mysql.sock')
 post-args = string(default=None)
 pre-args = string(default=None)
+# tar: run GNU tar; native: archive in-process into parallel shards
+archiver = option('tar', 'native', default='tar')
+# number of shards and reader threads used by the native archiver
+shards = integer(min=1, default=4)
+readers = integer(min=1, default=4)
 
 [compression]
 method = option('none', 'gzip', 'gzip-rsyncable', 'pigz', 'bzip2', 'pbzip2', 'lzop', 'gpg', default='gzip')
 options = string(default="")
 level = integer(min=0, max=9, default=1)
+split-size = string(default=None)
 
 [mysql:client]
 # default: ~/.my.cnf
@@ -94,15 +133,17 @@ class MysqlLVMBackup(object):
     def estimate_backup_size(self):
         """Estimate the backup size this plugin will produce
 
-        This is currently the total directory size of the MySQL datadir
+        This is the estimated size of the MySQL datadir
         """
         try:
             self.client.connect()
-            datadir = self.client.show_variable('datadir')
-            self.client.disconnect()
+            try:
+                datadir = self.client.show_variable('datadir')
+                return estimate_datadir_size(self.client, datadir)
+            finally:
+                self.client.disconnect()
         except MySQLError, exc:
             raise BackupError("[%d] %s" % exc.args)
-        return directory_size(datadir)
 
     def configspec(self):
         """INI Spec for the configuration values this plugin supports"""
@@ -131,30 +172,54 @@ class MysqlLVMBackup(object):
 
         # create a snapshot manager
         snapshot = build_snapshot(self.config['mysql-lvm'], volume,
-                                  suppress_tmpdir=self.dry_run)
+                                  suppress_tmpdir=self.dry_run,
+                                  backup_directory=self.target_directory)
         # calculate where the datadirectory on the snapshot will be located
         rpath = relpath(datadir, getmount(datadir))
         snap_datadir = os.path.abspath(os.path.join(snapshot.mountpoint, rpath))
+        if self.dry_run:
+            size_hint = None
+        else:
+            size_hint = self._archive_size_hint()
         # setup actions to perform at each step of the snapshot process
         setup_actions(snapshot=snapshot,
                       config=self.config,
                       client=self.client,
                       snap_datadir=snap_datadir,
-                      spooldir=self.target_directory)
+                      spooldir=self.target_directory,
+                      size_hint=size_hint)
 
         if self.dry_run:
             return self._dry_run(volume, snapshot, datadir)
 
         try:
-            snapshot.start(volume)
-        except CallbackFailuresError, exc:
-            # XXX: one of our actions failed.  Log this better
-            for callback, error in exc.errors:
-                LOG.error("%s", error)
-            raise BackupError("Error occurred during snapshot process. Aborting.")
-        except LVMCommandError, exc:
-            # Something failed in the snapshot process
-            raise BackupError(str(exc))
+            try:
+                snapshot.start(volume)
+            except CallbackFailuresError, exc:
+                # XXX: one of our actions failed.  Log this better
+                for callback, error in exc.errors:
+                    LOG.error("%s", error)
+                raise BackupError("Error occurred during snapshot process. Aborting.")
+            except LVMCommandError, exc:
+                # Something failed in the snapshot process
+                raise BackupError(str(exc))
+        finally:
+            record_snapshot_metrics(self.config, snapshot)
+
+    def _archive_size_hint(self):
+        """Estimate the final size of backup.tar from the estimated size of
+        this backup and how previous backups compared to their estimates
+        """
+        size = self.config.lookup('holland:backup.estimated-size')
+        if not size:
+            return None
+        factor = self.config.lookup('holland:backup.historic-size-factor')
+        if factor:
+            return int(size*factor)
+        zconfig = self.config['compression']
+        if zconfig['method'] == 'none' or zconfig['level'] == 0:
+            return int(size)
+        return None
 
     def _dry_run(self, volume, snapshot, datadir):
         """Implement dry-run for LVM snapshots.
@@ -4,21 +4,27 @@ import shutil
 import tempfile
 import logging
 from holland.core.backup import BackupError
+from holland.core.util.fmt import parse_bytes
 from holland.lib.compression import open_stream
 from holland.backup.mysql_lvm.actions import FlushAndLockMySQLAction, \
                                              RecordMySQLReplicationAction, \
                                              InnodbRecoveryAction, \
-                                             TarArchiveAction
+                                             TarArchiveAction, \
+                                             NativeArchiveAction
 from holland.backup.mysql_lvm.plugin.common import log_final_snapshot_size, \
-                                                   connect_simple
+                                                   connect_simple, \
+                                                   build_lock
 from holland.backup.mysql_lvm.plugin.innodb import MySQLPathInfo, check_innodb
 
 LOG = logging.getLogger(__name__)
 
-def setup_actions(snapshot, config, client, snap_datadir, spooldir):
+def setup_actions(snapshot, config, client, snap_datadir, spooldir,
+                  size_hint=None):
     """Setup actions for a LVM snapshot based on the provided
     configuration.
 
+    If size_hint is provided, space is reserved for the archive up front.
+
     Optional actions:
         * MySQL locking
         * InnoDB recovery
@@ -38,7 +44,8 @@ def setup_actions(snapshot, config, client, snap_datadir, spooldir):
 
     if config['mysql-lvm']['lock-tables']:
         extra_flush = config['mysql-lvm']['extra-flush-tables']
-        act = FlushAndLockMySQLAction(client, extra_flush)
+        lock = build_lock(config['mysql-lvm'], client)
+        act = FlushAndLockMySQLAction(client, extra_flush, lock, config)
         snapshot.register('pre-snapshot', act, priority=100)
         snapshot.register('post-snapshot', act, priority=100)
     if config['mysql-lvm'].get('replication', True):
@@ -52,19 +59,59 @@ def setup_actions(snapshot, config, client, snap_datadir, spooldir):
             mysqld_config['tmpdir'] = tempfile.gettempdir()
         ib_log_size = client.show_variable('innodb_log_file_size')
         mysqld_config['innodb-log-file-size'] = ib_log_size
-        act = InnodbRecoveryAction(mysqld_config)
-        snapshot.register('post-mount', act, priority=100)
+        overlap = config['mysql-lvm']['innodb-recovery-overlap']
+        if overlap and config['tar']['archiver'] != 'native':
+            LOG.warning("innodb-recovery-overlap requires archiver = native. "
+                        "Archiving will wait for InnoDB recovery to finish.")
+            overlap = False
+        recovery = InnodbRecoveryAction(mysqld_config, config,
+                                        background=overlap)
+        snapshot.register('post-mount', recovery, priority=100)
+    else:
+        overlap = False
 
-    try:
-        archive_stream = open_stream(os.path.join(spooldir, 'backup.tar'),
-                                     'w',
-                                     method=config['compression']['method'],
-                                     level=config['compression']['level'],
-                                     extra_args=config['compression']['options'])
-    except OSError, exc:
-        raise BackupError("Unable to create archive file '%s': %s" %
-                          (os.path.join(spooldir, 'backup.tar'), exc))
-    act = TarArchiveAction(snap_datadir, archive_stream, config['tar'])
+    split_size = config['compression']['split-size']
+    if split_size:
+        try:
+            split_size = parse_bytes(split_size)
+        except ValueError, exc:
+            raise BackupError("Invalid split-size: %s" % exc)
+    if config['tar']['archiver'] == 'native':
+        shards = config['tar']['shards']
+        if size_hint:
+            size_hint = size_hint // shards
+        names = ['backup.tar']
+        if shards > 1:
+            names = ['backup-%03d.tar' % idx for idx in xrange(shards)]
+    else:
+        names = ['backup.tar']
+    archive_streams = []
+    for name in names:
+        try:
+            archive_streams.append(
+                open_stream(os.path.join(spooldir, name),
+                            'w',
+                            method=config['compression']['method'],
+                            level=config['compression']['level'],
+                            extra_args=config['compression']['options'],
+                            size_hint=size_hint,
+                            durability=config.lookup(
+                                       'holland:backup.durability'),
+                            split_size=split_size))
+        except (IOError, OSError), exc:
+            for stream in archive_streams:
+                stream.close()
+            raise BackupError("Unable to create archive file '%s': %s" %
+                              (os.path.join(spooldir, name), exc))
+    if config['tar']['archiver'] == 'native':
+        act = NativeArchiveAction(snap_datadir, archive_streams, config['tar'])
+        if overlap:
+            act.recovery = recovery
+    else:
+        act = TarArchiveAction(snap_datadir, archive_streams[0], config['tar'])
     snapshot.register('post-mount', act, priority=50)
 
-    snapshot.register('pre-remove', log_final_snapshot_size)
+    snapshot.register('pre-remove',
+                      lambda event, volume: log_final_snapshot_size(event,
+                                                                    volume,
+                                                                    config))
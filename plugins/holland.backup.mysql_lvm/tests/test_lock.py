@@ -0,0 +1,21 @@
+"""
+Test the lock mysql-lvm takes around the snapshot
+"""
+
+from nose.tools import *
+from holland.lib.mysql.lock import GlobalReadLock, BackupLock
+from holland.backup.mysql_lvm.plugin.common import build_lock
+
+CONFIG = {
+    'long-query-time' : 60,
+    'long-query-action' : 'wait',
+    'lock-wait-timeout' : 300,
+}
+
+def test_build_lock():
+    lock = build_lock(dict(CONFIG), None)
+    ok_(not isinstance(lock, BackupLock))
+    ok_(isinstance(lock, GlobalReadLock))
+    lock = build_lock(dict(CONFIG, **{'lock-method' : 'backup-lock'}), None)
+    ok_(isinstance(lock, BackupLock))
+    ok_(lock.binlog)
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from holland.backup.mysql_lvm.actions.mysql._mysqld import size_server_config, \
+                                                            size_recovery_config, \
+                                                            ErrorLogWatch
+from holland.backup.mysql_lvm.actions.mysql.innodb import RecoveryProgress, \
+                                                          is_recovery_file
+
+def test_size_server_config():
+    config = size_server_config({'innodb-buffer-pool-size' : '128M'}, 8, 100)
+    assert_equals(config['max-connections'], 18)
+    assert_equals(config['loose-table-open-cache'], 512)
+    assert_equals(config['open-files-limit'], 512*2 + 18 + 1024)
+    ok_(config['innodb-buffer-pool-size'] >= 128*1024**2)
+    ok_(config['innodb-buffer-pool-size'] <= 8*256*1024**2)
+
+def test_size_server_config_keeps_larger_pool():
+    config = size_server_config({'innodb-buffer-pool-size' : '64G'}, 2)
+    assert_equals(config['innodb-buffer-pool-size'], 64*1024**3)
+    assert_equals(config['loose-innodb-buffer-pool-instances'], 2)
+
+def test_error_log_watch():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'mysqld.err')
+        open(path, 'w').write('old run: ready for connections\n')
+        ready = ErrorLogWatch(path)
+        ok_(not ready())
+        fileobj = open(path, 'a')
+        fileobj.write('InnoDB: started\nmysqld: ready for conn')
+        fileobj.flush()
+        ok_(not ready())
+        fileobj.write('ections.\n')
+        fileobj.close()
+        ok_(ready())
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_size_recovery_config():
+    config = size_recovery_config({'innodb-buffer-pool-size' : 'auto'},
+                                  memory=16*1024**3, cpus=8)
+    assert_equals(config['innodb-buffer-pool-size'], 8*1024**3)
+    assert_equals(config['loose-innodb-buffer-pool-instances'], 8)
+    assert_equals(config['loose-innodb-read-io-threads'], 8)
+    assert_equals(config['loose-innodb-write-io-threads'], 8)
+    config = size_recovery_config({'innodb-buffer-pool-size' : '256M'},
+                                  memory=16*1024**3, cpus=2)
+    assert_equals(config['innodb-buffer-pool-size'], 256*1024**2)
+    assert_equals(config['loose-innodb-read-io-threads'], 4)
+
+def test_recovery_progress():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'innodb_recovery.log')
+        progress = RecoveryProgress(path)
+        fileobj = open(path, 'w')
+        fileobj.write('InnoDB: Doing recovery: scanned up to log sequence '
+                      'number 1234567\n'
+                      'InnoDB: Starting an apply batch of log records to '
+                      'the database...\n'
+                      'InnoDB: Progress in percent: 0 1 2 3 ')
+        fileobj.flush()
+        progress.update()
+        assert_equals(progress.lsn, 1234567)
+        assert_equals(progress.batches, 1)
+        assert_equals(progress.percent, 3)
+        fileobj.write('4 5 99 \n'
+                      '2020-01-01T00:00:00Z 0 [Note] [MY-012550] [InnoDB] '
+                      'Applying a batch of 20 redo log records ...\n'
+                      '2020-01-01T00:00:00Z 0 [Note] [MY-012551] [InnoDB] '
+                      '40%\n')
+        fileobj.close()
+        progress.update()
+        assert_equals(progress.batches, 2)
+        assert_equals(progress.percent, 40)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_is_recovery_file():
+    ok_(is_recovery_file('ibdata1'))
+    ok_(is_recovery_file('db/t.ibd'))
+    ok_(is_recovery_file('#innodb_redo/#ib_redo10'))
+    ok_(is_recovery_file('mysql/user.MYD'))
+    ok_(not is_recovery_file('db/t.frm'))
+    ok_(not is_recovery_file('db/t.MYD'))
+    # MariaDB's Aria, DDL log and transaction coordinator log recovery
+    ok_(is_recovery_file('aria_log_control'))
+    ok_(is_recovery_file('aria_log.00000001'))
+    ok_(is_recovery_file('db/t.MAI'))
+    ok_(is_recovery_file('db/t.MAD'))
+    ok_(is_recovery_file('ddl_recovery.log'))
+    ok_(is_recovery_file('tc.log'))
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import subprocess
+from nose.tools import *
+from holland.backup.mysql_lvm.actions.native import plan_shards, TarShard, \
+                                                    _Owner, NativeArchiveAction
+
+def setup_func():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_func():
+    global tmpdir
+    shutil.rmtree(tmpdir)
+
+@with_setup(setup_func, teardown_func)
+def test_native_shards():
+    global tmpdir
+    src = os.path.join(tmpdir, 'src')
+    os.makedirs(os.path.join(src, 'db'))
+    # sparse file with a hole at the start and at the end
+    fileobj = open(os.path.join(src, 'ibdata1'), 'wb')
+    fileobj.seek(5*1024*1024)
+    fileobj.write('data' * 1000)
+    fileobj.truncate(12*1024*1024)
+    fileobj.close()
+    open(os.path.join(src, 'db', 't.frm'), 'w').write('frm' * 100)
+    open(os.path.join(src, 'db', 't.MYD'), 'w').write(os.urandom(300000))
+    open(os.path.join(src, 'mysql.sock'), 'w').close()
+
+    shards = plan_shards(src, ['mysql.sock'], 2)
+    assert_equal(len(shards), 2)
+    names = [name for members in shards for path, name, info in members]
+    ok_('./mysql.sock' not in names)
+    assert_equal(sorted(names),
+                 ['./db', './db/t.MYD', './db/t.frm', './ibdata1'])
+
+    dst = os.path.join(tmpdir, 'dst')
+    os.mkdir(dst)
+    for idx, members in enumerate(shards):
+        path = os.path.join(tmpdir, 'backup-%03d.tar' % idx)
+        shard = TarShard(open(path, 'wb'), _Owner())
+        for args in members:
+            shard.add(*args)
+        shard.close()
+        assert_equal(os.path.getsize(path) % 10240, 0)
+        assert_equal(subprocess.call(['tar', '-xf', path, '-C', dst]), 0)
+    for name in ('ibdata1', 'db/t.frm', 'db/t.MYD'):
+        assert_equal(open(os.path.join(src, name), 'rb').read(),
+                     open(os.path.join(dst, name), 'rb').read())
+
+class FakeRecovery(object):
+    """Appends to ibdata1 when waited for, as InnoDB recovery would"""
+    def __init__(self, path):
+        self.path = path
+        self.waited = False
+        self.cancelled = False
+
+    def is_recovery_file(self, relpath):
+        return relpath.startswith('ibdata')
+
+    def wait(self):
+        self.waited = True
+        open(self.path, 'ab').write('recovered')
+
+    def cancel(self):
+        self.cancelled = True
+
+class FakeSnapshot(object):
+    class sigmgr(object):
+        pending = []
+
+@with_setup(setup_func, teardown_func)
+def test_native_recovery_overlap():
+    global tmpdir
+    src = os.path.join(tmpdir, 'src')
+    os.makedirs(os.path.join(src, 'db'))
+    open(os.path.join(src, 'ibdata1'), 'w').write('data')
+    open(os.path.join(src, 'db', 't.frm'), 'w').write('frm')
+    streams = [open(os.path.join(tmpdir, 'backup-%03d.tar' % idx), 'wb')
+               for idx in xrange(2)]
+    recovery = FakeRecovery(os.path.join(src, 'ibdata1'))
+    action = NativeArchiveAction(src, streams,
+                                 {'exclude' : [], 'readers' : 2}, recovery)
+    action('post-mount', FakeSnapshot(), None)
+    ok_(recovery.waited)
+    ok_(recovery.cancelled)
+    dst = os.path.join(tmpdir, 'dst')
+    os.mkdir(dst)
+    for stream in streams:
+        assert_equal(subprocess.call(['tar', '-xf', stream.name, '-C', dst]),
+                     0)
+    assert_equal(open(os.path.join(dst, 'ibdata1')).read(), 'datarecovered')
+    assert_equal(open(os.path.join(dst, 'db', 't.frm')).read(), 'frm')
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from holland.core.spool import Backup, spool
+from holland.backup.mysql_lvm.plugin.common import predict_snapshot_size, \
+                                                   history_snapshot_extents
+
+class FakeVolume(object):
+    lv_size = str(100*1024**3)
+    vg_name = 'vg'
+    vg_extent_size = str(4*1024**2)
+    vg_free_count = '10000'
+
+    def device_name(self):
+        return '/dev/vg/mysql'
+
+def setup_func():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_func():
+    global tmpdir
+    shutil.rmtree(tmpdir)
+
+def _add_backup(name, duration, peak, final=None, root=None):
+    path = os.path.join(root or tmpdir, 'default', name)
+    os.makedirs(path)
+    backup = Backup(path, 'default', name)
+    backup.config['holland:backup']['start-time'] = 1000.0
+    backup.config['holland:backup']['stop-time'] = 1000.0 + duration
+    metrics = backup.config.setdefault('holland:metrics', {})
+    metrics['snapshot-peak-bytes'] = peak
+    if final is not None:
+        metrics['snapshot-final-bytes'] = final
+    backup.flush()
+    return path
+
+@with_setup(setup_func, teardown_func)
+def test_predict_snapshot_size():
+    _add_backup('20140101_000000', 100, 1000)
+    _add_backup('20140102_000000', 50, 1000, final=2000)
+    current = os.path.join(tmpdir, 'default', '20140103_000000')
+    os.makedirs(current)
+    # 40 bytes/s for up to 100 seconds, plus the margin
+    assert_equals(predict_snapshot_size(current, margin=1.5), 6000)
+
+@with_setup(setup_func, teardown_func)
+def test_history_snapshot_extents():
+    current = os.path.join(tmpdir, 'default', '20140103_000000')
+    os.makedirs(current)
+    config = {'snapshot-size-margin' : 1.0}
+    assert_equals(history_snapshot_extents(config, FakeVolume(), current),
+                  None)
+    _add_backup('20140102_000000', 60, 10*1024**3)
+    # 10G used in a previous run rounds up to whole extents
+    assert_equals(history_snapshot_extents(config, FakeVolume(), current),
+                  2560)
+    volume = FakeVolume()
+    volume.vg_free_count = '100'
+    assert_equals(history_snapshot_extents(config, volume, current), 100)
+
+@with_setup(setup_func, teardown_func)
+def test_predict_across_roots():
+    saved_paths = spool.paths
+    roots = [tmpdir, os.path.join(tmpdir, 'spool1')]
+    spool.path = roots
+    try:
+        _add_backup('20140101_000000', 100, 1000, root=roots[1])
+        current = os.path.join(tmpdir, 'default', '20140102_000000')
+        os.makedirs(current)
+        assert_equals(predict_snapshot_size(current, margin=1.0), 1000)
+    finally:
+        spool.path = saved_paths
@@ -3,7 +3,9 @@
 import sys
 import csv
 import errno
+import Queue
 import logging
+import threading
 from holland.core.exceptions import BackupError
 from holland.lib.safefilename import encode
 from holland.backup.mysqldump.command import ALL_DATABASES, MySQLDumpError
@@ -22,13 +24,35 @@ def dry_run(*args, **kwargs):
 
 def run(mysqldump, config): pass
 
+def _open(path, mode, method=None, size_hint=None):
+    """Default open_stream for start() that ignores compression hints"""
+    return open(path, mode)
+
 def start(mysqldump,
           schema=None,
           lock_method='auto-detect',
           file_per_database=True,
-          open_stream=open,
-          compression_ext=''):
-    """Run a mysqldump backup"""
+          open_stream=_open,
+          compression_ext='',
+          workers=1,
+          unit='database'):
+    """Run a mysqldump backup
+
+    With more than one worker, databases (unit='database') or tables
+    (unit='table') are dumped to separate files by that many mysqldump
+    processes at once.  This does not give a consistent backup of a live
+    server and is meant for a server nothing else writes to.
+    """
+
+    if workers > 1:
+        if not schema:
+            raise BackupError("parallel dumps require a valid schema")
+        if not file_per_database:
+            LOG.warning("file-per-database = no is ignored when dumping with "
+                        "%d workers", workers)
+        start_parallel(mysqldump, schema, lock_method, open_stream,
+                       compression_ext, workers, unit)
+        return
 
     if not schema and file_per_database:
         raise BackupError("file_per_database specified without a valid schema")
@@ -61,7 +85,8 @@ def start(mysqldump,
             if db_name != db.name:
                 LOG.warning("Encoding file-name for database %s to %s", db.name, db_name)
             try:
-                stream = open_stream('%s.sql' % db_name, 'w')
+                stream = open_stream('%s.sql' % db_name, 'w',
+                                     size_hint=db.size)
             except (IOError, OSError), exc:
                 raise BackupError("Failed to open output stream %s: %s" %
                                   ('%s.sql' + compression_ext, str(exc)))
@@ -76,8 +101,13 @@ def start(mysqldump,
                         raise BackupError(str(exc))
     else:
         more_options = [mysqldump_lock_option(lock_method, target_databases)]
+        if schema:
+            size_hint = sum([db.size for db in schema.databases
+                             if not db.excluded])
+        else:
+            size_hint = None
         try:
-            stream = open_stream('all_databases.sql', 'w')
+            stream = open_stream('all_databases.sql', 'w', size_hint=size_hint)
         except (IOError, OSError), exc:
             raise BackupError("Failed to open output stream %s: %s" %
                               'all_databases.sql' + compression_ext, exc)
@@ -93,14 +123,22 @@ def start(mysqldump,
                     LOG.error("%s", str(exc))
                     raise BackupError(str(exc))
 
-def write_manifest(schema, open_stream, ext):
-    """Write real database names => encoded names to MANIFEST.txt"""
+def write_manifest(schema, open_stream, ext, files=None):
+    """Write real database names => encoded names to MANIFEST.txt
+
+    :param files: list of (database name, path) to record instead of one
+                  file per database
+    """
     manifest_fileobj = open_stream('MANIFEST.txt', 'w', method='none')
     try:
         manifest = csv.writer(manifest_fileobj,
                               dialect=csv.excel_tab,
                               lineterminator="\n",
                               quoting=csv.QUOTE_MINIMAL)
+        if files is not None:
+            for name, path in files:
+                manifest.writerow([name.encode('utf-8'), path + ext])
+            return
         for database in schema.databases:
             if database.excluded:
                 continue
@@ -111,6 +149,112 @@ def write_manifest(schema, open_stream, ext):
         manifest_fileobj.close()
         LOG.info("Wrote backup manifest %s", manifest_fileobj.name)
 
+def parallel_jobs(mysqldump, schema, lock_method, unit='database'):
+    """List the mysqldump runs of a parallel backup
+
+    Each job is a (size, database, tables, path, options) tuple.  With
+    unit='table' every table is dumped to <database>/<table>.sql and the
+    routines and events of a database, if requested, to
+    <database>/<database>.routines.sql.
+
+    :returns: list of jobs, biggest first
+    """
+    jobs = []
+    for database in schema.databases:
+        if database.excluded:
+            continue
+        db_name = encode(database.name)[0]
+        lock_option = mysqldump_lock_option(lock_method, [database])
+        if unit == 'database':
+            jobs.append((database.size, database.name, None,
+                         db_name + '.sql', [lock_option]))
+            continue
+        # routines and events are dumped once per database, not per table
+        skip_options = []
+        if '--routines' in mysqldump.options:
+            skip_options.append('--skip-routines')
+        if '--events' in mysqldump.options:
+            skip_options.append('--skip-events')
+        for table in database.tables:
+            if table.excluded:
+                continue
+            path = '%s/%s.sql' % (db_name, encode(table.name)[0])
+            jobs.append((table.size, database.name, [table.name], path,
+                         [lock_option] + skip_options))
+        if skip_options:
+            path = '%s/%s.routines.sql' % (db_name, db_name)
+            jobs.append((0, database.name, None, path,
+                         ['--skip-lock-tables', '--no-create-info',
+                          '--no-data', '--skip-triggers']))
+    jobs.sort(lambda x, y: cmp(y[0], x[0]))
+    return jobs
+
+def start_parallel(mysqldump, schema, lock_method, open_stream,
+                   compression_ext, workers, unit='database'):
+    """Run the jobs of a parallel backup from a pool of threads
+
+    Jobs are handed out biggest first so the largest dump does not end up
+    running alone after everything else has finished.  The first error
+    stops the remaining workers from starting new jobs and is raised once
+    the running ones finish.
+    """
+    if '--flush-logs' in mysqldump.options:
+        LOG.info("Not flushing logs in a parallel dump")
+        mysqldump.options.remove('--flush-logs')
+    jobs = parallel_jobs(mysqldump, schema, lock_method, unit)
+    if unit == 'table':
+        files = [(job[1], job[3]) for job in jobs]
+        write_manifest(schema, open_stream, compression_ext, files)
+    else:
+        write_manifest(schema, open_stream, compression_ext)
+    LOG.info("Dumping %d %ss with %d workers", len(jobs), unit, workers)
+
+    pending = Queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                size, database, tables, path, options = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                _dump(mysqldump, database, tables, path, size, options,
+                      open_stream, compression_ext)
+            except Exception, exc:
+                errors.append(exc)
+
+    threads = []
+    for _ in xrange(min(workers, len(jobs))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def _dump(mysqldump, database, tables, path, size, options, open_stream,
+          compression_ext):
+    """Run one mysqldump of a database, or some of its tables, into path"""
+    try:
+        stream = open_stream(path, 'w', size_hint=size)
+    except (IOError, OSError), exc:
+        raise BackupError("Failed to open output stream %s: %s" %
+                          (path + compression_ext, exc))
+    try:
+        mysqldump.run([database], stream, options, tables=tables)
+    finally:
+        try:
+            stream.close()
+        except (IOError, OSError), exc:
+            if exc.errno != errno.EPIPE:
+                LOG.error("%s", str(exc))
+                raise BackupError(str(exc))
+
 def mysqldump_lock_option(lock_method, databases):
     """Choose the mysqldump option to use for locking
     given the requested lock-method and the set of databases to
@@ -123,6 +267,7 @@ def mysqldump_lock_option(lock_method, databases):
             'flush-lock'            : '--lock-all-tables',
             'lock-tables'           : '--lock-tables',
             'single-transaction'    : '--single-transaction',
+            'backup-lock'           : '--lock-for-backup',
             'none'                  : '--skip-lock-tables',
         }
         try:
@@ -131,6 +276,37 @@ def mysqldump_lock_option(lock_method, databases):
             raise BackupError("Invalid mysqldump lock method %r" % \
                               lock_method)
 
+def resolve_lock_options(schema, lock_method, file_per_database=True,
+                         workers=1):
+    """List the lock options start() will run mysqldump with"""
+    databases = [db for db in schema.databases if not db.excluded]
+    if workers > 1 or file_per_database:
+        return [mysqldump_lock_option(lock_method, [db]) for db in databases]
+    if not [x for x in schema.excluded_databases]:
+        databases = ALL_DATABASES
+    return [mysqldump_lock_option(lock_method, databases)]
+
+def takes_table_locks(lock_options, options):
+    """Check whether mysqldump will take FLUSH TABLES WITH READ LOCK or
+    LOCK TABLES, which have to wait for long running queries
+
+    :param lock_options: lock options from resolve_lock_options()
+    :param options: the other options mysqldump is run with
+    """
+    master_data = [opt for opt in options if opt.startswith('--master-data')]
+    for lock_option in lock_options:
+        if lock_option in ('--lock-all-tables', '--lock-tables'):
+            return True
+        # --single-transaction takes a brief global read lock to read the
+        # binary log position or flush the logs
+        if lock_option == '--single-transaction' and \
+            (master_data or '--flush-logs' in options):
+            return True
+        # --master-data implies --lock-all-tables otherwise
+        if lock_option == '--skip-lock-tables' and master_data:
+            return True
+    return False
+
 def mysqldump_autodetect_lock(databases):
     """Auto-detect if we can do a transactional or
     non-transactional backup with mysqldump
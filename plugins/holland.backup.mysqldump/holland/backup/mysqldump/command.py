@@ -120,6 +120,7 @@ MYSQLDUMP_OPTIONS = [
     MyOption('--single-transaction', (4,0,2)),
     MyOption('--lock-all-tables', min_version=(4,1,8)),
     MyOption('--lock-tables'),
+    MyOption('--lock-for-backup'),
 
     # misc
     MyOption('--skip-dump-date', min_version=(5,1,23)),
@@ -161,6 +162,25 @@ def mysqldump_version(command):
         raise MySQLDumpError("Failed to determine mysqldump version for %s" % \
                              command)
 
+def mysqldump_help(command):
+    """Return the --help output of the given mysqldump command"""
+    args = [
+        command,
+        '--no-defaults',
+        '--help',
+    ]
+    LOG.debug("Executing: %s", subprocess.list2cmdline(args))
+    try:
+        process = subprocess.Popen(args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   close_fds=True)
+        stdout, _ = process.communicate()
+    except OSError, exc:
+        raise MySQLDumpError("Error[%d:%s] when trying to run '%s'" % \
+                (exc.errno, errno.errorcode[exc.errno], command))
+    return stdout or ''
+
 class MySQLDump(object):
     """mysqldump command runner"""
     def __init__(self,
@@ -178,6 +198,16 @@ class MySQLDump(object):
         for optspec in MYSQLDUMP_OPTIONS:
             self.mysqldump_optcheck.add_option(optspec)
         self.options = []
+        self._help = None
+
+    def supports(self, option):
+        """Check whether this mysqldump accepts option, according to its
+        --help output.  This catches options only found in some builds,
+        such as Percona Server's --lock-for-backup.
+        """
+        if self._help is None:
+            self._help = mysqldump_help(self.cmd_path)
+        return option in self._help
 
     def add_option(self, option):
         """Add an option to this mysqldump instance, to be used
@@ -188,8 +218,12 @@ class MySQLDump(object):
         self.options.append(option)
         self.mysqldump_optcheck.check_option(option)
 
-    def run(self, databases, stream, additional_options=None):
-        """Run mysqldump with the options configured on this instance"""
+    def run(self, databases, stream, additional_options=None, tables=None):
+        """Run mysqldump with the options configured on this instance
+
+        If tables is given, only those tables of the single database in
+        databases are dumped.
+        """
         if not hasattr(stream, 'fileno'):
             raise MySQLDumpError("Invalid output stream")
 
@@ -211,6 +245,12 @@ class MySQLDump(object):
 
         if databases is ALL_DATABASES:
             args.append('--all-databases')
+        elif tables:
+            if len(databases) != 1:
+                raise MySQLDumpError("Tables can only be dumped from a single "
+                                     "database")
+            args.extend(databases)
+            args.extend(tables)
         else:
             if len(databases) > 1:
                 args.append('--databases')
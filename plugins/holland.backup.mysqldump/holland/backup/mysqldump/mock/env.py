@@ -68,7 +68,7 @@ def _setup_mysqlclient(mocker):
 def match_mysqldump(param):
     LOG.debug("match_mysqldump %r", param)
     if param and 'mysqldump' in param[0]:
-        return "--version" in param
+        return "--version" in param or "--help" in param
     return False
 
 def _setup_subprocess(mocker):
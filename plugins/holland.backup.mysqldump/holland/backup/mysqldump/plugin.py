@@ -2,17 +2,23 @@
 
 import os
 import re
+import errno
 import codecs
 import logging
 from holland.core.exceptions import BackupError
-from holland.lib.compression import open_stream, lookup_compression
+from holland.core.util.path import disk_free
+from holland.core.dedup import ChunkStore, RECIPE_SUFFIX
+from holland.lib.compression import open_stream, lookup_compression, \
+                                    CompressionQueue
 from holland.lib.mysql import MySQLSchema, connect, MySQLError
+from holland.lib.mysql.lock import GlobalReadLock, LockError
 from holland.lib.mysql import include_glob, exclude_glob, \
                               include_glob_qualified, \
                               exclude_glob_qualified
 from holland.lib.mysql import DatabaseIterator, MetadataTableIterator, \
                               SimpleTableIterator
-from holland.backup.mysqldump.base import start
+from holland.backup.mysqldump.base import start, resolve_lock_options, \
+                                         takes_table_locks
 from holland.backup.mysqldump.util import INIConfig, update_config
 from holland.backup.mysqldump.util.ini import OptionLine, CommentLine
 from holland.lib.mysql.option import load_options, \
@@ -30,7 +36,11 @@ CONFIGSPEC = """
 extra-defaults      = boolean(default=no)
 mysql-binpath       = force_list(default=list())
 
-lock-method         = option('flush-lock', 'lock-tables', 'single-transaction', 'auto-detect', 'none', default='auto-detect')
+lock-method         = option('flush-lock', 'lock-tables', 'single-transaction', 'backup-lock', 'auto-detect', 'none', default='auto-detect')
+
+long-query-time     = integer(min=0, default=60)
+long-query-action   = option('wait', 'kill', 'abort', default='wait')
+lock-wait-timeout   = integer(min=1, default=300)
 
 databases           = force_list(default=list('*'))
 exclude-databases   = force_list(default=list())
@@ -62,6 +72,8 @@ method = option('none', 'gzip', 'gzip-rsyncable', 'pigz', 'bzip2', 'pbzip2', 'lz
 options = string(default="")
 inline = boolean(default=yes)
 level  = integer(min=0, max=9, default=1)
+deferred-workers = integer(min=1, default=2)
+deferred-watermark = string(default=None)
 
 [mysql:client]
 defaults-extra-file = force_list(default=list('~/.my.cnf'))
@@ -82,6 +94,12 @@ class MySQLDumpPlugin(object):
         self.target_directory = target_directory
         self.dry_run = dry_run
         self.config.validate_config(self.CONFIGSPEC) # -> ValidationError
+        self.compression_queue = None
+        self.chunk_store = None
+        # parallel dumps are only safe against a server nothing else
+        # writes to, such as the snapshot instance of mysqldump-lvm
+        self.workers = 1
+        self.parallel_unit = 'database'
 
         # Setup a discovery shell to find schema items
         # This will iterate over items during the estimate
@@ -135,8 +153,12 @@ class MySQLDumpPlugin(object):
         # However, with lock-method=auto-detect we must look at table engines
         # to determine what lock method to use
         config = self.config['mysqldump']
-        fast_iterate = config['lock-method'] != 'auto-detect' and \
-                        not config['exclude-invalid-views']
+        # lock-method=backup-lock may fall back to auto-detect
+        fast_iterate = config['lock-method'] not in ('auto-detect',
+                                                     'backup-lock') and \
+                        not config['exclude-invalid-views'] and \
+                        not (self.workers > 1 and
+                             self.parallel_unit == 'table')
 
         try:
             db_iter = DatabaseIterator(self.client)
@@ -152,6 +174,26 @@ class MySQLDumpPlugin(object):
         finally:
             self.client.disconnect()
 
+    def refresh_schema(self):
+        """Look up the schema again when the backup runs
+
+        mysqldump-lvm uses this to list tables from the snapshot instance
+        it dumps rather than the live server.  Table sizes found by an
+        earlier lookup are kept, since tables are only listed this time.
+        """
+        sizes = {}
+        for database in self.schema.databases:
+            for table in database.tables:
+                sizes[(table.database, table.name)] = (table.data_size,
+                                                       table.index_size)
+        self.schema.databases = []
+        self.schema.timestamp = None
+        self._fast_refresh_schema()
+        for database in self.schema.databases:
+            for table in database.tables:
+                table.data_size, table.index_size = \
+                    sizes.get((table.database, table.name), (0, 0))
+
     def backup(self):
         """Run a MySQL backup"""
 
@@ -214,7 +256,19 @@ class MySQLDumpPlugin(object):
         options = collect_mysqldump_options(config, mysqldump, self.client)
         validate_mysqldump_options(mysqldump, options)
 
+        lock_method = config['lock-method']
+        if lock_method == 'backup-lock':
+            lock_method = self._backup_lock_method(mysqldump)
+
+        lock_options = resolve_lock_options(self.schema, lock_method,
+                                            config['file-per-database'],
+                                            self.workers)
+        if not self.dry_run and takes_table_locks(lock_options, options):
+            self._check_long_queries()
+
         os.mkdir(os.path.join(self.target_directory, 'backup_data'))
+        for path in self._stripe_directories()[1:]:
+            os.mkdir(path)
 
         if self.config['compression']['method'] != 'none' and \
             self.config['compression']['level'] > 0:
@@ -232,31 +286,193 @@ class MySQLDumpPlugin(object):
             cmd = ''
             ext = ''
 
+        if self.config.lookup('holland:backup.dedup') and not self.dry_run:
+            self.chunk_store = self._chunk_store()
+            ext = RECIPE_SUFFIX
+        elif cmd and not self.config['compression']['inline'] and \
+            not self.dry_run:
+            self.compression_queue = self._compression_queue()
+
         try:
-            start(mysqldump=mysqldump,
-                  schema=self.schema,
-                  lock_method=config['lock-method'],
-                  file_per_database=config['file-per-database'],
-                  open_stream=self._open_stream,
-                  compression_ext=ext)
+            try:
+                start(mysqldump=mysqldump,
+                      schema=self.schema,
+                      lock_method=lock_method,
+                      file_per_database=config['file-per-database'],
+                      open_stream=self._open_stream,
+                      compression_ext=ext,
+                      workers=self.workers,
+                      unit=self.parallel_unit)
+            except (MySQLDumpError, IOError), exc:
+                raise BackupError(str(exc))
+        finally:
+            if self.chunk_store is not None:
+                self.chunk_store.record_metrics(self.config)
+                LOG.info("Deduplicated %d bytes into %d new bytes "
+                         "(ratio %.2f)",
+                         self.chunk_store.stats['logical-bytes'],
+                         self.chunk_store.stats['new-bytes'],
+                         self.chunk_store.dedup_ratio())
+            if self.compression_queue is not None:
+                queue = self.compression_queue
+                self.compression_queue = None
+                LOG.info("Waiting for deferred compression to complete")
+                try:
+                    queue.join()
+                except IOError, exc:
+                    raise BackupError(str(exc))
+
+    def _backup_lock_method(self, mysqldump):
+        """Check that mysqldump and the server both support backup locks
+
+        mysqldump --lock-for-backup --single-transaction takes
+        LOCK TABLES FOR BACKUP rather than FLUSH TABLES WITH READ LOCK,
+        so InnoDB tables can still be written to while non-transactional
+        tables are dumped.
+
+        :returns: the lock method to run mysqldump with
+        """
+        try:
+            supported = mysqldump.supports('--lock-for-backup')
         except MySQLDumpError, exc:
             raise BackupError(str(exc))
+        if not supported:
+            LOG.warning("%s does not support --lock-for-backup. Using "
+                        "lock-method = auto-detect instead.",
+                        mysqldump.cmd_path)
+            return 'auto-detect'
+        if not self.dry_run:
+            try:
+                kind = self.client.backup_lock_type()
+            except MySQLError, exc:
+                raise BackupError("MySQL Error [%d] %s" % exc.args)
+            if kind != 'tables':
+                LOG.warning("Server does not support LOCK TABLES FOR BACKUP. "
+                            "Using lock-method = auto-detect instead.")
+                return 'auto-detect'
+        validate_mysqldump_options(mysqldump, ['--single-transaction'])
+        return 'backup-lock'
+
+    def _check_long_queries(self):
+        """Deal with long running queries before mysqldump takes its locks
+
+        mysqldump issues FLUSH TABLES WITH READ LOCK or LOCK TABLES itself,
+        so only the processlist check applies here.
+        """
+        config = self.config['mysqldump']
+        guard = GlobalReadLock(self.client,
+                               long_query_time=config['long-query-time'],
+                               action=config['long-query-action'],
+                               timeout=config['lock-wait-timeout'])
+        try:
+            try:
+                guard.check()
+            except LockError, exc:
+                raise BackupError(str(exc))
+            except MySQLError, exc:
+                raise BackupError("Failed to check for long running "
+                                  "queries: [%d] %s" % exc.args)
+        finally:
+            guard.record_metrics(self.config)
+
+    def _compression_queue(self):
+        """Build the queue used to compress dumps after mysqldump finishes
+        writing them when inline compression is disabled"""
+        workers = self.config['compression']['deferred-workers']
+        watermark = self.config['compression']['deferred-watermark']
+        if watermark is not None:
+            try:
+                watermark = parse_size(watermark)
+            except ValueError, exc:
+                raise BackupError("Invalid deferred-watermark: %s" % exc)
+        LOG.info("Deferring compression to %d background worker(s)", workers)
+        return CompressionQueue(workers=workers, watermark=watermark)
+
+    def _chunk_store(self):
+        """Build the chunk store dumps are deduplicated into when
+        dedup is enabled for this backupset"""
+        level = 0
+        if self.config['compression']['method'] != 'none':
+            level = min(self.config['compression']['level'], 9)
+        store = ChunkStore.for_backup(self.target_directory, level=level,
+                    durability=self.config.lookup('holland:backup.durability'))
+        LOG.info("Deduplicating dumps into %s", store.path)
+        return store
+
+    def _stripe_directories(self):
+        """List the directories dump files may be written to
+
+        The first entry is always this backup's own backup_data directory.
+        If the backup is striped across several spool directories, the
+        backup_data directory under each stripe follows.
+        """
+        stripe_paths = self.config.lookup('holland:backup.stripe-paths') or []
+        return [os.path.join(path, 'backup_data')
+                for path in [self.target_directory] + list(stripe_paths)]
 
-    def _open_stream(self, path, mode, method=None):
+    def _open_stream(self, path, mode, method=None, size_hint=None):
         """Open a stream through the holland compression api, relative to
         this instance's target directory
+
+        Dumps of a striped backup are written to whichever stripe has the
+        most free space and symlinked into this backup's backup_data
+        directory.
         """
-        path = os.path.join(self.target_directory, 'backup_data', path)
+        data_dirs = self._stripe_directories()
+        data_dir = data_dirs[0]
+        if os.path.dirname(path) and not self.dry_run:
+            # per-table dumps are written to a directory per database
+            for name in data_dirs:
+                _mkdir(os.path.join(name, os.path.dirname(path)))
+        if method is None and self.chunk_store is not None:
+            return open_stream(os.path.join(data_dir, path), mode,
+                               chunk_store=self.chunk_store)
+        if method is None and len(data_dirs) > 1:
+            free = [(disk_free(name), name) for name in data_dirs]
+            free.sort()
+            data_dir = free[-1][1]
+        subdir = os.path.dirname(path)
+        path = os.path.join(data_dir, path)
         compression_method = method or self.config['compression']['method']
         compression_level = self.config['compression']['level']
         compression_options = self.config['compression']['options']
+        if self.dry_run:
+            durability = None
+        else:
+            durability = self.config.lookup('holland:backup.durability')
         stream = open_stream(path,
                              mode,
                              compression_method,
                              compression_level,
-                             extra_args=compression_options)
+                             inline=self.config['compression']['inline'],
+                             extra_args=compression_options,
+                             queue=self.compression_queue,
+                             size_hint=self._output_size(size_hint,
+                                                         compression_method),
+                             durability=durability)
+        if data_dir != data_dirs[0]:
+            link = os.path.join(data_dirs[0], subdir,
+                                os.path.basename(stream.name))
+            LOG.debug("Striping %s to %s", link, stream.name)
+            os.symlink(stream.name, link)
         return stream
 
+    def _output_size(self, size, method):
+        """Estimate how many bytes will be written for ``size`` bytes of
+        table data, based on how previous backups compared to their
+        estimates.
+
+        Returns None if no reasonable estimate can be made.
+        """
+        if not size or self.dry_run:
+            return None
+        factor = self.config.lookup('holland:backup.historic-size-factor')
+        if factor:
+            return int(size*factor)
+        if method == 'none' or self.config['compression']['level'] == 0:
+            return size
+        return None
+
     def info(self):
         """Summarize information about this backup"""
         import textwrap
@@ -289,6 +505,14 @@ class MySQLDumpPlugin(object):
         )
 
 
+def _mkdir(path):
+    """Create a directory that parallel workers may also be creating"""
+    try:
+        os.mkdir(path)
+    except OSError, exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
 def find_mysqldump(path=None):
     """Find a usable mysqldump binary in path or ENV[PATH]"""
     search_path = ':'.join(path) or os.environ.get('PATH', '')
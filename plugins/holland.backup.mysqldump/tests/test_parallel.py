@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from holland.lib.mysql.schema.base import Database, Table
+from holland.backup.mysqldump.base import parallel_jobs, start, \
+     resolve_lock_options, takes_table_locks
+
+class FakeMySQLDump(object):
+    """Records the mysqldump runs of a backup"""
+    def __init__(self, options):
+        self.options = options
+        self.runs = []
+
+    def run(self, databases, stream, additional_options=None, tables=None):
+        self.runs.append((databases, tables, additional_options))
+        stream.write('-- dump\n')
+
+def _schema():
+    class Schema(object):
+        databases = []
+    schema = Schema()
+    for name, sizes in (('small', [1]), ('big', [100, 5])):
+        database = Database(name)
+        for idx, size in enumerate(sizes):
+            database.add_table(Table(name, 't%d' % idx, size, 0, 'InnoDB'))
+        schema.databases.append(database)
+    excluded = Database('excluded')
+    excluded.excluded = True
+    schema.databases.append(excluded)
+    schema.excluded_databases = [excluded]
+    return schema
+
+def test_parallel_jobs_database():
+    jobs = parallel_jobs(FakeMySQLDump([]), _schema(), 'none')
+    assert_equals([(job[1], job[3]) for job in jobs],
+                  [('big', 'big.sql'), ('small', 'small.sql')])
+
+def test_parallel_jobs_table():
+    mysqldump = FakeMySQLDump(['--routines'])
+    jobs = parallel_jobs(mysqldump, _schema(), 'none', unit='table')
+    assert_equals([(job[1], job[2], job[3]) for job in jobs],
+                  [('big', ['t0'], 'big/t0.sql'),
+                   ('big', ['t1'], 'big/t1.sql'),
+                   ('small', ['t0'], 'small/t0.sql'),
+                   ('small', None, 'small/small.routines.sql'),
+                   ('big', None, 'big/big.routines.sql')])
+    ok_('--skip-routines' in jobs[0][4])
+    ok_('--no-data' in jobs[-1][4])
+
+def setup_func():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_func():
+    shutil.rmtree(tmpdir)
+
+def _open(path, mode, method=None, size_hint=None):
+    path = os.path.join(tmpdir, path)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return open(path, mode)
+
+@with_setup(setup_func, teardown_func)
+def test_start_parallel():
+    mysqldump = FakeMySQLDump(['--flush-logs'])
+    start(mysqldump, _schema(), lock_method='none', open_stream=_open,
+          workers=4, unit='table')
+    assert_equals(len(mysqldump.runs), 3)
+    ok_('--flush-logs' not in mysqldump.options)
+    for name in ('big/t0.sql', 'big/t1.sql', 'small/t0.sql', 'MANIFEST.txt'):
+        ok_(os.path.exists(os.path.join(tmpdir, name)))
+    manifest = open(os.path.join(tmpdir, 'MANIFEST.txt')).read()
+    ok_('big\tbig/t1.sql' in manifest)
+
+def test_resolve_lock_options():
+    assert_equals(resolve_lock_options(_schema(), 'lock-tables'),
+                  ['--lock-tables', '--lock-tables'])
+    assert_equals(resolve_lock_options(_schema(), 'flush-lock', False),
+                  ['--lock-all-tables'])
+
+def test_takes_table_locks():
+    ok_(takes_table_locks(['--lock-all-tables'], []))
+    ok_(takes_table_locks(['--lock-tables'], []))
+    ok_(not takes_table_locks(['--single-transaction'], ['--routines']))
+    ok_(takes_table_locks(['--single-transaction'], ['--master-data=2']))
+    ok_(takes_table_locks(['--single-transaction'], ['--flush-logs']))
+    ok_(not takes_table_locks(['--skip-lock-tables'], []))
+    ok_(takes_table_locks(['--skip-lock-tables'], ['--master-data=2']))
@@ -5,6 +5,9 @@ to backup MySQL databases using mysqldump
 
 import os
 import glob
+import time
+import Queue
+import threading
 import subprocess
 import tempfile
 import shutil
@@ -15,10 +18,13 @@ from holland.lib.mysql.schema import MySQLSchema, \
                                      DatabaseIterator, \
                                      TableIterator
 from holland.lib.mysql.option import make_mycnf
-from holland.lib.archive import create_archive
+from holland.lib.mysql.lock import GlobalReadLock, BackupLock, LockError
+from holland.lib.archive import create_archive, DirArchive
+from holland.lib.archive.dir_archive import MANIFEST_NAME, VerifyError
 from holland.core.util.path import format_bytes, disk_free
 from holland.core.config.configobj import ConfigObj, ParseError
 from holland.core.exceptions import BackupError
+from holland.core.spool import spool
 
 LOG = logging.getLogger(__name__)
 
@@ -35,8 +41,11 @@ mysql-binpath       = string(default=None)
 # How should tables be locked?
 # flush-lock: global read lock (FLUSH TABLES WITH READ LOCK)
 # lock-tables: lock only the tables being backed up
-# default lock-tables. Use flush-lock if bin-log-position is set
-lock-method         = option('flush-lock', 'lock-tables', 'none', default='lock-tables')
+# backup-lock: LOCK TABLES FOR BACKUP where the server supports it
+#              (Percona Server), otherwise flush-lock
+# default lock-tables. Use flush-lock or backup-lock if bin-log-position
+# is set
+lock-method         = option('flush-lock', 'lock-tables', 'backup-lock', 'none', default='lock-tables')
 # Names of databases to backup
 databases           = coerced_list(default=list('*'))
 # Names of databases to exclude
@@ -45,6 +54,9 @@ exclude-databases   = coerced_list(default=list())
 tables              = coerced_list(default=list('*'))
 # Names of tables to exclude
 exclude-tables      = coerced_list(default=list())
+# Number of threads copying files while tables are locked
+# (archive-method = dir) or compressing each file (tar or zip)
+copy-workers        = integer(min=1, default=1)
 # Only backup the 2K header of MyISAM indexes
 # (makes for faster backups sometimes, table must be repaired on restore)
 partial-indexes     = boolean(default=false)
@@ -55,6 +67,18 @@ partial-indexes     = boolean(default=false)
 # dir or zip offer constant time lookup and provides faster per-table restores
 # tar probably gets somewhat better overall compression
 archive-method      = option(dir,tar,zip,default="dir")
+# With archive-method = dir, hardlink (or reflink) files that are
+# unchanged since the previous backup instead of copying them again
+incremental         = boolean(default=false)
+# Checksum linked files once tables are unlocked rather than trusting
+# their size and mtime.  The backup fails if any differ.
+incremental-checksum = boolean(default=true)
+# Before locking, statements running longer than this many seconds
+# are waited for, killed or cause the backup to abort (0 disables)
+long-query-time     = integer(min=0, default=60)
+long-query-action   = option('wait', 'kill', 'abort', default='wait')
+# Seconds to wait for long queries and for the read lock itself
+lock-wait-timeout   = integer(min=1, default=300)
 # stop the slave before running backups
 stop-slave          = boolean(default=false)
 # record the binary log position
@@ -158,46 +182,186 @@ class MySQLHotcopy(object):
         datadir = self.mysqlclient.show_variable('datadir')
         archive_method = self.config.lookup('mysqlhotcopy.archive-method')
         if not self.dry_run:
-            archive = create_archive(archive_method, os.path.join(self.target_directory, 'backup_data'))
+            archive_path = os.path.join(self.target_directory, 'backup_data')
+            if archive_method == 'dir' and \
+                self.config.lookup('mysqlhotcopy.incremental'):
+                reference = self._find_reference()
+                if reference:
+                    LOG.info("Linking unchanged files from %s", reference)
+                verify = self.config.lookup('mysqlhotcopy.incremental-checksum')
+                archive = DirArchive(archive_path,
+                                     reference=reference,
+                                     verify=verify)
+            elif archive_method in ('tar', 'zip'):
+                workers = self.config.lookup('mysqlhotcopy.copy-workers')
+                archive = create_archive(archive_method, archive_path,
+                                         workers=workers)
+            else:
+                archive = create_archive(archive_method, archive_path)
         LOG.info("Creating backup_data %s archive", archive_method)
 
-        if self.config.lookup('mysqlhotcopy.lock-method') == 'flush-lock':
-            if not self.dry_run:
-                self.mysqlclient.flush_tables_with_read_lock(extra_flush=True)
-        elif self.config.lookup('mysqlhotcopy.lock-method') == 'lock-tables':
-            tables = [x for x in self._find_tables() if x not in [('mysql', 'general_log'), ('mysql', 'slow_log')]]
-            quoted_tables = map(lambda x: '`' + '`.`'.join(x) +
-                                '`', tables)
-            if not self.dry_run:
-                self.mysqlclient.lock_tables(quoted_tables)
-                self.mysqlclient.flush_tables()
+        lock_method = self.config.lookup('mysqlhotcopy.lock-method')
+        lock_options = dict(
+            long_query_time=self.config.lookup('mysqlhotcopy.long-query-time'),
+            action=self.config.lookup('mysqlhotcopy.long-query-action'),
+            timeout=self.config.lookup('mysqlhotcopy.lock-wait-timeout'))
+        if lock_method == 'backup-lock':
+            lock = BackupLock(self.mysqlclient, **lock_options)
+        else:
+            lock = GlobalReadLock(self.mysqlclient, **lock_options)
+        try:
+            if lock_method in ('flush-lock', 'backup-lock'):
+                if not self.dry_run:
+                    lock.acquire(extra_flush=True)
+            elif lock_method == 'lock-tables':
+                tables = [x for x in self._find_tables() if x not in [('mysql', 'general_log'), ('mysql', 'slow_log')]]
+                quoted_tables = map(lambda x: '`' + '`.`'.join(x) +
+                                    '`', tables)
+                if not self.dry_run:
+                    lock.check()
+                    self.mysqlclient.lock_tables(quoted_tables)
+                    self.mysqlclient.flush_tables()
+        except LockError, exc:
+            lock.record_metrics(self.config)
+            raise BackupError(str(exc))
 
+        lock_start = time.time()
         LOG.info("Starting Backup")
         error = None
         try:
             if self.config.lookup('mysqlhotcopy.partial-indexes'):
                 LOG.info("Only archiving partial indexes")
-            for cpath in self._find_files(datadir):
-                rpath = os.sep.join(cpath.split(os.sep)[-2:])
-                if self.config.lookup('mysqlhotcopy.partial-indexes') \
-                    and rpath.endswith('.MYI'):
-                    if not self.dry_run:
-                        partial_data = open(cpath, 'r').read(2048)
-                        archive.add_string(partial_data, rpath)
-                    LOG.debug("%s [partial]", rpath)
-                else:
-                    LOG.debug("%s", rpath)
-                    if not self.dry_run:
-                        archive.add_file(cpath, rpath)
+            files = [(cpath, os.sep.join(cpath.split(os.sep)[-2:]))
+                     for cpath in self._find_files(datadir)]
+            workers = self.config.lookup('mysqlhotcopy.copy-workers')
+            if workers > 1 and archive_method == 'dir' and not self.dry_run:
+                self._archive_files_parallel(archive, files, workers)
+            else:
+                for cpath, rpath in files:
+                    self._archive_file(archive, cpath, rpath)
         except Exception, e:
             error = e
             LOG.error("Failed to archive data file. %s", e)
 
         if not self.dry_run:
-            self.mysqlclient.unlock_tables()
-            archive.close()
+            if lock_method in ('flush-lock', 'backup-lock'):
+                lock.release()
+            else:
+                self.mysqlclient.unlock_tables()
+            stats = {}
+            if lock_method != 'none':
+                lock.record_metrics(self.config)
+                stats['lock-time'] = time.time() - lock_start
+                LOG.info("Tables were locked for %.3f seconds",
+                         stats['lock-time'])
+            try:
+                archive.close()
+            except VerifyError, exc:
+                LOG.error("%s", exc)
+                error = error or BackupError(str(exc))
+            if isinstance(archive, DirArchive):
+                stats.update(archive.stats)
+            self._record_metrics(stats)
         if error:
-            raise e
+            raise error
+
+    def _archive_file(self, archive, cpath, rpath):
+        """Add a single data file to the archive"""
+        if self.config.lookup('mysqlhotcopy.partial-indexes') \
+            and rpath.endswith('.MYI'):
+            if not self.dry_run:
+                partial_data = open(cpath, 'r').read(2048)
+                archive.add_string(partial_data, rpath)
+            LOG.debug("%s [partial]", rpath)
+        else:
+            LOG.debug("%s", rpath)
+            if not self.dry_run:
+                archive.add_file(cpath, rpath)
+
+    def _archive_files_parallel(self, archive, files, workers):
+        """Add files to a DirArchive from a pool of worker threads
+
+        Files are handed out biggest first so one large table does not
+        end up being copied alone after everything else has finished.
+        The first error encountered stops the remaining workers and is
+        raised.
+        """
+        sized = []
+        for cpath, rpath in files:
+            try:
+                size = os.stat(cpath).st_size
+            except OSError:
+                size = 0
+            sized.append((size, cpath, rpath))
+        sized.sort()
+        sized.reverse()
+        pending = Queue.Queue()
+        for item in sized:
+            pending.put(item)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    size, cpath, rpath = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._archive_file(archive, cpath, rpath)
+                except Exception, exc:
+                    errors.append(exc)
+
+        workers = min(workers, len(sized)) or 1
+        LOG.info("Copying %d files with %d workers", len(sized), workers)
+        threads = []
+        for idx in xrange(workers):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _find_reference(self):
+        """Find the backup_data directory of the most recent previous
+        successful backup in this backupset that can be linked from"""
+        backup_directory = os.path.abspath(self.target_directory)
+        own_device = os.stat(backup_directory).st_dev
+        # previous backups may be stored on any root of the spool
+        backupset = spool.backupset_of(backup_directory)
+        for backup in backupset.list_backups(reverse=True) or []:
+            if os.path.abspath(backup.path) == backup_directory:
+                continue
+            config = backup.config['holland:backup']
+            # the backup runner records failures as failed = True
+            if str(config.get('failed')) == 'True' or \
+                not config['stop-time']:
+                LOG.debug("Skipping reference %s from a failed or "
+                          "unfinished backup", backup.name)
+                continue
+            candidate = os.path.join(backup.path, 'backup_data')
+            if not os.path.exists(os.path.join(candidate, MANIFEST_NAME)):
+                continue
+            if os.stat(candidate).st_dev != own_device:
+                LOG.debug("Skipping reference %s on another filesystem",
+                          candidate)
+                continue
+            return candidate
+        return None
+
+    def _record_metrics(self, stats):
+        """Record how much of the archive was copied vs linked and how
+        long tables were locked"""
+        self.config.setdefault('holland:metrics', {})
+        for key, value in stats.items():
+            self.config['holland:metrics']['hotcopy-' + key] = value
+        if 'copied-files' not in stats:
+            return
+        LOG.info("Copied %d files (%s), linked %d unchanged files (%s)",
+                 stats['copied-files'], format_bytes(stats['copied-bytes']),
+                 stats['linked-files'], format_bytes(stats['linked-bytes']))
 
     def cleanup(self):
         """
@@ -50,10 +50,11 @@ class MySQL(object):
             raise BackupError("Invalid variable scope used")
         var = var.replace('%', '\\%').replace('_', '\\_')
         sql = "SHOW %s VARIABLES LIKE '%s'" % (scope, var)
-        try:
-            return self.first(sql)[1]
-        except IndexError:
+        row = self.first(sql)
+        # no row if the server does not have this variable
+        if row is None:
             return None
+        return row[1]
 
     def close(self):
         try:
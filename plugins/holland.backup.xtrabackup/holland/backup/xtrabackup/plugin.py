@@ -5,14 +5,23 @@ holland.mysql.xtrabackup
 Xtrabackup backup strategy plugin
 """
 
+import os
 import sys
+import time
+import shutil
 import logging
 from os.path import join
 from holland.core.backup import BackupError
-from holland.core.util.path import directory_size
-from holland.lib.compression import open_stream
+from holland.core.spool import spool
+from holland.core.util.fmt import parse_bytes, format_bytes
+from holland.core.util.sysinfo import cpu_count, available_memory
+from holland.lib.compression import open_stream, stream_info
+from holland.lib.mysql.size import estimate_datadir_size
 from holland.backup.xtrabackup.mysql import MySQL
 from holland.backup.xtrabackup import util
+from holland.backup.xtrabackup.prepare import record_state, start_worker
+from holland.backup.xtrabackup.progress import XtrabackupProgress, \
+                                              parse_innodb_status_lsn
 
 LOG = logging.getLogger(__name__)
 
@@ -29,12 +38,21 @@ no-lock             = boolean(default=no)
 tmpdir              = string(default=None)
 additional-options  = force_list(default=list())
 pre-command         = string(default=None)
+incremental         = boolean(default=no)
+max-incrementals    = integer(min=0, default=6)
+parallel            = string(default=auto)
+compress-threads    = string(default=auto)
+use-memory          = string(default=auto)
+extract-stream      = boolean(default=no)
+deferred-prepare    = boolean(default=no)
+prepare-priority    = option('low', 'idle', 'normal', default='low')
 
 [compression]
 method              = option('none', 'gzip', 'gzip-rsyncable', 'pigz', 'bzip2', 'pbzip2', 'lzma', 'lzop', 'gpg', default=gzip)
 inline              = boolean(default=yes)
 options             = string(default="")
 level               = integer(min=0, max=9, default=1)
+split-size          = string(default=None)
 
 [mysql:client]
 defaults-extra-file = force_list(default=list('~/.my.cnf'))
@@ -52,6 +70,9 @@ class XtrabackupPlugin(object):
     #: path to the my.cnf generated by this plugin
     defaults_path = None
 
+    #: thread counts and memory chosen by tune()
+    tuning = None
+
     def __init__(self, name, config, target_directory, dry_run=False):
         self.name = name
         self.config = config
@@ -63,7 +84,9 @@ class XtrabackupPlugin(object):
         client_opts = self.config['mysql:client']
         includes = [self.config['xtrabackup']['global-defaults']] + \
                    client_opts['defaults-extra-file']
-        util.generate_defaults_file(defaults_path, includes, client_opts)
+        # a deferred prepare reuses the defaults file of its backup
+        if not os.path.exists(defaults_path):
+            util.generate_defaults_file(defaults_path, includes, client_opts)
         self.defaults_path = defaults_path
 
     def estimate_backup_size(self):
@@ -74,7 +97,7 @@ class XtrabackupPlugin(object):
         try:
             try:
                 datadir = client.var('datadir')
-                return directory_size(datadir)
+                return estimate_datadir_size(client, datadir)
             except MySQL.MySQLError, exc:
                 raise BackupError("Failed to find mysql datadir: [%d] %s" %
                                   exc.args)
@@ -92,37 +115,257 @@ class XtrabackupPlugin(object):
         except IOError, exc:
             raise BackupError('[%d] %s' % (exc.errno, exc.strerror))
 
+    def open_progress(self):
+        """Create an XtrabackupProgress for this backup
+
+        If the server can be queried, copied files are measured in its
+        datadir and its LSN is compared with the redo log copy.
+
+        :returns: (progress, client).  client is None or a connection to
+                  close once the backup has finished.
+        """
+        path = join(self.target_directory, 'xtrabackup.log')
+        total_size = self.config.lookup('holland:backup.estimated-size')
+        try:
+            client = MySQL.from_defaults(self.defaults_path)
+        except MySQL.MySQLError, exc:
+            LOG.info("Not checking the server's redo log progress: "
+                     "failed to connect to MySQL: %s", exc)
+            return XtrabackupProgress(path, total_size=total_size), None
+        try:
+            datadir = client.var('datadir')
+            capacity = client.var('innodb_redo_log_capacity', 'GLOBAL')
+            if capacity is None:
+                capacity = int(client.var('innodb_log_file_size', 'GLOBAL'))*\
+                           int(client.var('innodb_log_files_in_group',
+                                          'GLOBAL'))
+        except (MySQL.MySQLError, TypeError), exc:
+            LOG.info("Not checking the server's redo log progress: %s", exc)
+            client.close()
+            return XtrabackupProgress(path, total_size=total_size), None
+        def server_lsn():
+            return parse_innodb_status_lsn(
+                        client.first('SHOW ENGINE INNODB STATUS')[-1])
+        progress = XtrabackupProgress(path, datadir=datadir,
+                                      total_size=total_size,
+                                      server_lsn=server_lsn,
+                                      log_capacity=int(capacity))
+        return progress, client
+
     def open_xb_stdout(self):
-        """Open the stdout output for a streaming xtrabackup run"""
+        """Open the stdout output for a streaming xtrabackup run
+
+        Both tar and xbstream streams are compressed according to the
+        [compression] section, unless xtrabackup already compresses the
+        files itself with --compress.
+        """
         config = self.config['xtrabackup']
-        backup_directory = self.target_directory
         stream = util.determine_stream_method(config['stream'])
-        if stream:
-            # XXX: bounce through compression
-            if stream == 'tar':
-                archive_path = join(backup_directory, 'backup.tar')
-                zconfig = self.config['compression']
+        if not stream:
+            return open('/dev/null', 'w')
+        zconfig = self.config['compression']
+        split_size = zconfig['split-size']
+        if split_size:
+            try:
+                split_size = parse_bytes(split_size)
+            except ValueError, exc:
+                raise BackupError("Invalid split-size: %s" % exc)
+        durability = self.config.lookup('holland:backup.durability')
+        archive_path, method = self.stream_output()
+        if method != zconfig['method']:
+            LOG.info("Not compressing the backup stream with %s as "
+                     "xtrabackup --compress is used", zconfig['method'])
+        extra_args = zconfig['options']
+        if method in ('pigz', 'pbzip2') and '-p' not in extra_args.split():
+            extra_args += ' -p %d' % self.tune()['compress-threads']
+        try:
+            return open_stream(archive_path, 'w',
+                               method=method,
+                               level=zconfig['level'],
+                               extra_args=extra_args,
+                               size_hint=self._output_size_hint(),
+                               durability=durability,
+                               split_size=split_size)
+        except (IOError, OSError), exc:
+            raise BackupError("Unable to create output file: %s" % exc)
+
+    def stream_output(self):
+        """Determine the path and compression method of the backup stream
+
+        :returns: (path, method) with path before any compression suffix
+        """
+        config = self.config['xtrabackup']
+        stream = util.determine_stream_method(config['stream'])
+        method = self.config['compression']['method']
+        if '--compress' in config['additional-options']:
+            method = 'none'
+        if stream == 'xbstream':
+            name = 'backup.xb'
+        else:
+            name = 'backup.tar'
+        return join(self.target_directory, name), method
+
+    def _output_size_hint(self):
+        """Estimate the final size of the backup stream from the estimated
+        size of this backup and how previous backups compared to their
+        estimates
+        """
+        if self.dry_run:
+            return None
+        size = self.config.lookup('holland:backup.estimated-size')
+        if not size:
+            return None
+        factor = self.config.lookup('holland:backup.historic-size-factor')
+        if factor:
+            return int(size*factor)
+        method = self.stream_output()[1]
+        if '--compress' not in self.config['xtrabackup']['additional-options'] \
+            and (method == 'none' or self.config['compression']['level'] == 0):
+            return int(size)
+        return None
+
+    def tune(self):
+        """Choose --parallel, --compress-threads and the --use-memory for
+        --apply-log from the cores and memory of this host and the write
+        throughput of previous backups in the spool
+
+        Options not set to 'auto' are used as given.  The chosen values are
+        recorded in [holland:metrics] of backup.conf.
+
+        :returns: dict with parallel, compress-threads and use-memory
+        """
+        if self.tuning is not None:
+            return self.tuning
+        xb_cfg = self.config['xtrabackup']
+        root = os.path.dirname(os.path.dirname(
+                    os.path.abspath(self.target_directory)))
+        # a new spool root borrows the history of the other roots
+        throughput = spool.expected_throughput(root)
+        tuning = util.auto_tune(cpu_count(), available_memory(),
+                                throughput)
+        for key in ('parallel', 'compress-threads'):
+            if xb_cfg[key] != 'auto':
                 try:
-                    return open_stream(archive_path, 'w',
-                                       method=zconfig['method'],
-                                       level=zconfig['level'],
-                                       extra_args=zconfig['options'])
-                except OSError, exc:
-                    raise BackupError("Unable to create output file: %s" % exc)
-            elif stream == 'xbstream':
-                archive_path = join(backup_directory, 'backup.xb')
-                return open(archive_path, 'w')
+                    tuning[key] = int(xb_cfg[key])
+                except ValueError:
+                    raise BackupError("Invalid %s '%s'. Must be 'auto' or a "
+                                      "number of threads." %
+                                      (key, xb_cfg[key]))
+                if tuning[key] < 1:
+                    raise BackupError("%s must be at least 1" % key)
+        if xb_cfg['use-memory'] != 'auto':
+            try:
+                tuning['use-memory'] = int(parse_bytes(xb_cfg['use-memory']))
+            except ValueError, exc:
+                raise BackupError("Invalid use-memory: %s" % exc)
+        LOG.info("Using %d copy threads, %d compression threads and %s of "
+                 "memory to apply the log", tuning['parallel'],
+                 tuning['compress-threads'], format_bytes(tuning['use-memory']))
+        metrics = self.config.setdefault('holland:metrics', {})
+        for key, value in tuning.items():
+            metrics['xtrabackup-' + key] = value
+        self.tuning = tuning
+        return tuning
+
+    def find_incremental_base(self):
+        """Find the backup an incremental backup should be taken against
+
+        This is the newest successful xtrabackup backup in the backupset
+        with an xtrabackup_checkpoints file, unless its chain already holds
+        max-incrementals incremental backups, is missing a backup or its
+        full backup was fully prepared.
+
+        :returns: (backup, checkpoints) or (None, None) for a full backup
+        """
+        xb_cfg = self.config['xtrabackup']
+        if not xb_cfg['incremental']:
+            return None, None
+        backup_directory = os.path.abspath(self.target_directory)
+        # previous backups may be stored on any root of the spool
+        backupset = spool.backupset_of(backup_directory)
+        for backup in backupset.list_backups(reverse=True) or []:
+            if os.path.abspath(backup.path) == backup_directory:
+                continue
+            config = backup.config['holland:backup']
+            # the backup runner records failures as failed = True
+            if config['plugin'] != 'xtrabackup' or \
+                str(config.get('failed')) == 'True' or \
+                not config['stop-time']:
+                continue
+            checkpoints = util.read_checkpoints(backup.path)
+            if checkpoints is None:
+                LOG.info("No xtrabackup_checkpoints found for %s. Taking a "
+                         "full backup.", backup.name)
+                return None, None
+            chain = backup.config.get('xtrabackup:chain', {})
+            incrementals = int(chain.get('incrementals', 0))
+            if xb_cfg['max-incrementals'] and \
+                incrementals >= xb_cfg['max-incrementals']:
+                LOG.info("%s is incremental backup %d of its chain. Taking a "
+                         "full backup.", backup.name, incrementals)
+                return None, None
+            parent = backup
+            while parent.parent():
+                name = parent.parent()
+                parent = backupset.find_backup(name.split('/')[-1])
+                if parent is None:
+                    LOG.warning("%s needed by %s no longer exists. Taking a "
+                                "full backup.", name, backup.name)
+                    return None, None
+            # restore rolls back the --redo-only prepare of a full backup
+            # before copying it back
+            if parent.config.get('xtrabackup:chain', {}).get('prepared') == \
+                'full':
+                LOG.info("%s was fully prepared for a restore. Taking a full "
+                         "backup.", parent.name)
+                return None, None
+            return backup, checkpoints
+        LOG.info("No previous xtrabackup backup found. Taking a full backup.")
+        return None, None
+
+    def _build_args(self, base, checkpoints):
+        """Build the xtrabackup commandline for a full backup or an
+        incremental backup against base"""
+        xb_cfg = self.config['xtrabackup']
+        kwargs = {}
+        if xb_cfg['incremental']:
+            kwargs['extra_lsndir'] = self.target_directory
+        if base is not None:
+            basedir = join(base.path, 'data')
+            if os.path.exists(join(basedir, 'xtrabackup_checkpoints')) and \
+                '--compress' not in xb_cfg['additional-options']:
+                kwargs['incremental_basedir'] = basedir
             else:
-                raise BackupError("Unknown stream method '%s'" % stream)
-        else:
-            return open('/dev/null', 'w')
+                kwargs['incremental_lsn'] = checkpoints['to_lsn']
+            LOG.info("Taking an incremental backup against %s from LSN %s",
+                     base.name, checkpoints['to_lsn'])
+        return util.build_xb_args(xb_cfg, self.target_directory,
+                                  self.defaults_path, tuning=self.tune(),
+                                  **kwargs)
 
+    def record_chain(self, base, checkpoints):
+        """Record the incremental chain this backup belongs to in
+        backup.conf"""
+        chain = self.config.setdefault('xtrabackup:chain', {})
+        if base is None:
+            chain['backup-type'] = 'full'
+            chain['incrementals'] = 0
+        else:
+            self.config.setdefault('holland:backup', {})['parent'] = base.name
+            base_chain = base.config.get('xtrabackup:chain', {})
+            chain['backup-type'] = 'incremental'
+            chain['base'] = base.name
+            chain['base-lsn'] = checkpoints['to_lsn']
+            chain['incrementals'] = int(base_chain.get('incrementals', 0)) + 1
+        own = util.read_checkpoints(self.target_directory)
+        if own:
+            chain['from-lsn'] = own.get('from_lsn')
+            chain['to-lsn'] = own['to_lsn']
 
     def dryrun(self):
         from subprocess import Popen, list2cmdline, PIPE, STDOUT
-        xb_cfg = self.config['xtrabackup']
-        args = util.build_xb_args(xb_cfg, self.target_directory,
-                self.defaults_path)
+        base, checkpoints = self.find_incremental_base()
+        args = self._build_args(base, checkpoints)
         LOG.info("* xtrabackup command: %s", list2cmdline(args))
         args = [
             'xtrabackup',
@@ -155,16 +398,18 @@ class XtrabackupPlugin(object):
         tmpdir = util.evaluate_tmpdir(xb_cfg['tmpdir'], backup_directory)
         # innobackupex --tmpdir does not affect xtrabackup
         util.add_xtrabackup_defaults(self.defaults_path, tmpdir=tmpdir)
-        args = util.build_xb_args(xb_cfg, backup_directory, self.defaults_path)
+        base, checkpoints = self.find_incremental_base()
+        args = self._build_args(base, checkpoints)
         util.execute_pre_command(xb_cfg['pre-command'],
                                  backup_directory=backup_directory)
         stderr = self.open_xb_logfile()
+        progress, client = self.open_progress()
         try:
             stdout = self.open_xb_stdout()
             exc = None
             try:
                 try:
-                    util.run_xtrabackup(args, stdout, stderr)
+                    util.run_xtrabackup(args, stdout, stderr, progress)
                 except Exception, exc:
                     LOG.info("!! %s", exc)
                     for line in open(join(self.target_directory, 'xtrabackup.log'), 'r'):
@@ -179,6 +424,103 @@ class XtrabackupPlugin(object):
                         raise
         finally:
             stderr.close()
+            progress.record_metrics(self.config)
+            if client is not None:
+                client.close()
+        if xb_cfg['incremental']:
+            self.record_chain(base, checkpoints)
         if xb_cfg['apply-logs']:
-            util.apply_xtrabackup_logfile(xb_cfg, args[-1])
+            if base is not None:
+                LOG.info("Skipping --apply-log for an incremental backup. "
+                         "It is applied to its full backup on restore.")
+            elif util.determine_stream_method(xb_cfg['stream']) and \
+                not xb_cfg['extract-stream']:
+                LOG.warning("Skipping --prepare/--apply-logs since backup is "
+                            "streamed. Set extract-stream = yes to prepare "
+                            "it.")
+            elif xb_cfg['deferred-prepare']:
+                record_state(self.config, 'pending',
+                             **{'queued-at' : time.time()})
+                start_worker(self.target_directory,
+                             xb_cfg['prepare-priority'])
+            else:
+                self.prepare()
+                record_state(self.config, 'prepared')
+
+    def prepare(self):
+        """Prepare a full backup with --apply-log
+
+        A streamed backup is extracted into a staging directory, prepared
+        there and moved to data/ once --apply-log succeeded.  The stream
+        itself is kept.
+
+        With incremental = yes the backup is prepared with --redo-only,
+        which is recorded as prepared = redo-only in [xtrabackup:chain].
+        """
+        xb_cfg = self.config['xtrabackup']
+        tuning = self.tune()
+        # a fully prepared backup can no longer take incrementals
+        kwargs = dict(redo_only=xb_cfg['incremental'],
+                      use_memory=tuning['use-memory'],
+                      parallel=tuning['compress-threads'])
+        stream = util.determine_stream_method(xb_cfg['stream'])
+        if stream is None:
+            util.apply_xtrabackup_logfile(xb_cfg,
+                                          join(self.target_directory, 'data'),
+                                          **kwargs)
+            self._record_prepare(kwargs['redo_only'])
+            return
+        archive_path, method = self.stream_output()
+        argv = None
+        if method != 'none' and self.config['compression']['level'] != 0:
+            try:
+                argv, archive_path = stream_info(archive_path, method)
+            except OSError, exc:
+                raise BackupError(str(exc))
+        staging = join(self.target_directory, 'data.extract')
+        start = time.time()
+        try:
+            os.mkdir(staging)
+        except OSError, exc:
+            raise BackupError("Failed to create %s: [%d] %s" %
+                              (staging, exc.errno, exc.strerror))
+        try:
+            stderr = self.open_xb_logfile()
+            try:
+                util.extract_stream(stream, archive_path, staging, argv,
+                                    parallel=tuning['parallel'],
+                                    stderr=stderr)
+            finally:
+                stderr.close()
+            metrics = self.config.setdefault('holland:metrics', {})
+            metrics['xtrabackup-extract-time'] = '%.3f' % (time.time() - start)
+            util.apply_xtrabackup_logfile(xb_cfg, staging, **kwargs)
+            os.rename(staging, join(self.target_directory, 'data'))
+        except:
+            LOG.error("Removing %s", staging)
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self._record_prepare(kwargs['redo_only'])
+
+    def finish_prepare(self):
+        """Complete the --redo-only prepare of a full backup so it can be
+        copied back
+
+        Uncommitted transactions are rolled back, after which incremental
+        backups can no longer be applied to the backup.
+        """
+        xb_cfg = self.config['xtrabackup']
+        tuning = self.tune()
+        util.apply_xtrabackup_logfile(xb_cfg,
+                                      join(self.target_directory, 'data'),
+                                      redo_only=False,
+                                      use_memory=tuning['use-memory'],
+                                      parallel=tuning['compress-threads'])
+        self.config.setdefault('xtrabackup:chain', {})['prepared'] = 'full'
+
+    def _record_prepare(self, redo_only):
+        """Record a --redo-only prepare in [xtrabackup:chain]"""
+        if redo_only:
+            chain = self.config.setdefault('xtrabackup:chain', {})
+            chain['prepared'] = 'redo-only'
 
@@ -0,0 +1,246 @@
+"""
+holland.backup.xtrabackup.prepare
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Deferred --apply-log for xtrabackup backups
+
+With deferred-prepare, a backup is only marked as pending in the
+[xtrabackup:prepare] section of its backup.conf and a detached worker
+process prepares it once holland has finished the backup.  Workers run at
+a lower CPU and I/O priority and one at a time on a host, so the
+prepare does not hold up the next backupset and gets the memory of the
+host to itself.
+
+The state of a backup's prepare is one of:
+
+* pending  - queued and not started yet
+* running  - innobackupex --apply-log is running
+* prepared - the backup is prepared
+* failed   - the prepare failed.  The error is recorded as well.
+
+run_prepare() is also used by restore to wait for a running prepare or to
+prepare a pending backup right away.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import errno
+import fcntl
+import logging
+from subprocess import Popen
+from holland.core.backup import BackupError
+from holland.core.config.config import BaseConfig
+from holland.core.spool import Backup
+from holland.core.util.path import directory_size
+from holland.core.util.supervise import Supervisor
+from holland.lib.which import which, WhichError
+
+LOG = logging.getLogger(__name__)
+
+#: lock held while a backup is prepared
+PREPARE_LOCK = '.prepare.lock'
+
+#: lock serializing deferred prepares on this host.  It is kept out of
+#: the spool, which may only contain backupsets.
+QUEUE_LOCK = os.path.join(tempfile.gettempdir(),
+                          'holland-xtrabackup-prepare.lock')
+
+#: nice and ionice arguments for each prepare-priority
+PRIORITIES = {
+    'low'    : (['-n', '10'], ['-c2', '-n7']),
+    'idle'   : (['-n', '19'], ['-c3']),
+    'normal' : (None, None),
+}
+
+WORKER = "import sys; " \
+         "from holland.backup.xtrabackup.prepare import main; " \
+         "sys.exit(main(sys.argv[1:]))"
+
+def prepare_state(config):
+    """Return the prepare state recorded in a backup config or None"""
+    return config.get('xtrabackup:prepare', {}).get('state')
+
+def record_state(config, state, **kwargs):
+    """Record the prepare state and extra values in a backup config"""
+    section = config.setdefault('xtrabackup:prepare', {})
+    section['state'] = state
+    for key, value in kwargs.items():
+        section[key] = value
+
+def _priority_args(priority):
+    """Build the nice/ionice command prefix for a prepare-priority"""
+    args = []
+    nice, ionice = PRIORITIES[priority]
+    for name, extra in (('nice', nice), ('ionice', ionice)):
+        if extra is None:
+            continue
+        try:
+            args += [which(name)] + extra
+        except WhichError:
+            LOG.info("%s not found. Not lowering the priority of the "
+                     "deferred prepare.", name)
+    return args
+
+def start_worker(backup_directory, priority='low'):
+    """Start a detached process that prepares backup_directory once the
+    current holland process has finished the backup"""
+    args = _priority_args(priority) + \
+           [sys.executable, '-c', WORKER,
+            os.path.abspath(backup_directory), str(os.getpid())]
+    env = os.environ.copy()
+    # plugins may have been loaded from plugin directories
+    env['PYTHONPATH'] = os.pathsep.join([path for path in sys.path if path])
+    devnull = open('/dev/null', 'r+')
+    try:
+        try:
+            Popen(args, stdin=devnull, stdout=devnull, stderr=devnull,
+                  close_fds=True, preexec_fn=os.setsid, env=env)
+        except OSError, exc:
+            raise BackupError("Failed to start the deferred prepare: %s" %
+                              exc)
+    finally:
+        devnull.close()
+    LOG.info("Deferred --apply-log of %s to a background process",
+             backup_directory)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, exc:
+        return exc.errno == errno.EPERM
+    return True
+
+def backup_finished(path):
+    """Check whether holland has finished writing a backup
+
+    :returns: True once the backup completed, False if it failed and None
+              while it is still running
+    """
+    try:
+        config = BaseConfig(os.path.join(path, 'backup.conf'),
+                            file_error=False)
+    except Exception, exc:
+        # backup.conf is being rewritten
+        LOG.debug("Failed to read backup.conf: %s", exc)
+        return None
+    section = config.get('holland:backup', {})
+    if str(section.get('failed')) == 'True':
+        return False
+    # on-disk-size is written last, once the backup succeeded
+    if section.get('stop-time') and section.get('on-disk-size'):
+        return True
+    return None
+
+def wait_for_backup(path, pid):
+    """Wait until the holland process pid finished the backup in path
+
+    :returns: True if the backup completed successfully
+    """
+    supervisor = Supervisor()
+    try:
+        supervisor.watch_directory(path)
+        def done():
+            return backup_finished(path) is not None or \
+                   not _process_alive(pid)
+        while not supervisor.wait(done, timeout=60):
+            pass
+    finally:
+        supervisor.close()
+    return backup_finished(path) is True
+
+def _lock(path, blocking=True):
+    """Take an exclusive lock on path
+
+    :returns: the open lock file, or None if blocking is false and the
+              lock is held elsewhere
+    """
+    fileobj = open(path, 'a')
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(fileobj.fileno(), flags)
+    except IOError, exc:
+        fileobj.close()
+        if exc.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return fileobj
+
+def load_backup(path):
+    """Load the Backup stored in path"""
+    path = os.path.abspath(path)
+    return Backup(path, os.path.basename(os.path.dirname(path)),
+                  os.path.basename(path))
+
+def run_prepare(backup, blocking=True):
+    """Prepare a backup whose prepare is pending
+
+    :param blocking: wait for a prepare of this backup that is already
+                     running.  Otherwise return immediately.
+    :returns: the prepare state of the backup afterwards
+    :raises: BackupError if the prepare failed
+    """
+    lock = _lock(os.path.join(backup.path, PREPARE_LOCK), blocking)
+    if lock is None:
+        LOG.info("%s is already being prepared", backup.name)
+        return 'running'
+    try:
+        backup.load_config()
+        state = prepare_state(backup.config)
+        if state != 'pending':
+            return state
+        # the plugin module imports this module
+        from holland.backup.xtrabackup.plugin import XtrabackupPlugin
+        plugin = XtrabackupPlugin(backup.name, backup.config, backup.path)
+        start = time.time()
+        record_state(backup.config, 'running', **{'start-time' : start})
+        backup.config.write()
+        LOG.info("Preparing %s", backup.name)
+        try:
+            plugin.prepare()
+        except Exception, exc:
+            record_state(backup.config, 'failed', error=str(exc),
+                         **{'stop-time' : time.time()})
+            backup.config.write()
+            raise BackupError("Failed to prepare %s: %s" %
+                              (backup.name, exc))
+        record_state(backup.config, 'prepared',
+                     **{'stop-time' : time.time()})
+        # the prepare may have extracted the stream into data/
+        backup.config['holland:backup']['on-disk-size'] = \
+            directory_size(backup.path)
+        backup.config.write()
+        LOG.info("Prepared %s in %.3f seconds", backup.name,
+                 time.time() - start)
+        return 'prepared'
+    finally:
+        lock.close()
+
+def main(args):
+    """Entry point of the deferred prepare worker
+
+    :param args: backup directory and pid of the holland process
+    """
+    path, pid = args[0], int(args[1])
+    handler = logging.FileHandler(os.path.join(path, 'prepare.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s '
+                                           '[%(levelname)s] %(message)s'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    try:
+        if not wait_for_backup(path, pid):
+            LOG.info("Backup %s did not complete. Not preparing it.", path)
+            return 1
+        queue = _lock(QUEUE_LOCK)
+        try:
+            run_prepare(load_backup(path), blocking=False)
+        finally:
+            queue.close()
+    except Exception, exc:
+        LOG.error("%s", exc, exc_info=True)
+        return 1
+    return 0
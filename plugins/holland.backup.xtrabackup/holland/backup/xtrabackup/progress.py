@@ -0,0 +1,233 @@
+"""
+holland.backup.xtrabackup.progress
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Follow xtrabackup's output while a backup runs
+
+xtrabackup logs each data file it copies, streams or compresses and the
+LSN its redo log copy thread has scanned up to.  XtrabackupProgress reads
+these lines from xtrabackup.log as they are written and turns them into
+copy throughput, an ETA and the rate the redo log is copied at.
+
+If the server's current LSN is available, it also compares how fast the
+server generates redo with how fast xtrabackup copies it.  xtrabackup
+fails once InnoDB overwrites redo it has not copied yet, so a warning is
+logged when the log copy falls behind by a large part of the redo log
+capacity or stops advancing while the server keeps writing.
+"""
+
+import os
+import re
+import time
+import logging
+from holland.core.util.fmt import format_bytes, format_interval
+
+LOG = logging.getLogger(__name__)
+
+class LogTail(object):
+    """Read complete lines appended to a file since the last read"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = ''
+
+    def lines(self):
+        """Return the lines written since the last call"""
+        try:
+            fileobj = open(self.path, 'r')
+        except IOError:
+            return []
+        try:
+            fileobj.seek(self.offset)
+            data = fileobj.read()
+            self.offset = fileobj.tell()
+        finally:
+            fileobj.close()
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+def parse_innodb_status_lsn(status):
+    """Find the current LSN in SHOW ENGINE INNODB STATUS output
+
+    MySQL 5.0 and 5.1 print the LSN as two 32 bit numbers.
+
+    :returns: LSN as an integer or None
+    """
+    match = re.search(r'^Log sequence number\s+(\d+)(?:\s+(\d+))?\s*$',
+                      status, re.M)
+    if not match:
+        return None
+    high, low = match.groups()
+    if low is not None:
+        return (int(high) << 32) + int(low)
+    return int(high)
+
+class XtrabackupProgress(object):
+    """Report the progress of a running xtrabackup from its log
+
+    :param path: path of xtrabackup.log
+    :param datadir: datadir of the server.  Copied files are looked up
+                    here to count the bytes copied.
+    :param total_size: estimated size of the backup, for the ETA
+    :param server_lsn: callable returning the server's current LSN
+    :param log_capacity: bytes of redo the server keeps before it
+                         overwrites the oldest redo
+    :param interval: seconds between progress reports and server checks
+    """
+    copy_re = re.compile(r'(?:\[(\d+)\]\s+)?'
+                         r'(Done: )?(?:Copying|Streaming|'
+                         r'Compressing and streaming|Compressing) (\S+)')
+    done_re = re.compile(r'\[(\d+)\]\s+\.\.\.done')
+    lsn_re = re.compile(r'log scanned up to \((\d+)\)')
+
+    #: fraction of the redo log capacity the log copy may fall behind
+    #: before a warning is logged
+    lag_warning = 0.5
+
+    def __init__(self, path, datadir=None, total_size=None, server_lsn=None,
+                 log_capacity=None, interval=30):
+        self.tail = LogTail(path)
+        self.datadir = datadir
+        self.total_size = total_size
+        self.server_lsn = server_lsn
+        self.log_capacity = log_capacity
+        self.interval = interval
+        self.start_time = time.time()
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.start_lsn = None
+        self.lsn = None
+        self.max_lag = None
+        self.redo_rate = None
+        self.stalls = 0
+        self._active = {}
+        self._last_report = self.start_time
+        self._last_check = None
+
+    def update(self):
+        """Read new log output and report progress every interval
+        seconds"""
+        for line in self.tail.lines():
+            self._parse(line)
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self._check_server(now)
+            self.report()
+
+    def _parse(self, line):
+        match = self.lsn_re.search(line)
+        if match:
+            self.lsn = int(match.group(1))
+            if self.start_lsn is None:
+                self.start_lsn = self.lsn
+            return
+        match = self.done_re.search(line)
+        if match:
+            self._copied(self._active.pop(match.group(1), None))
+            return
+        match = self.copy_re.search(line)
+        if match:
+            thread, done, path = match.groups()
+            if done:
+                self._copied(path)
+            else:
+                self._active[thread] = path
+
+    def _copied(self, path):
+        if path is None:
+            return
+        self.files_copied += 1
+        if self.datadir and not os.path.isabs(path):
+            path = os.path.join(self.datadir, path)
+        try:
+            self.bytes_copied += os.path.getsize(path)
+        except OSError:
+            pass
+
+    def _check_server(self, now):
+        """Compare the server's LSN with the LSN copied so far"""
+        if self.server_lsn is None or self.lsn is None:
+            return
+        try:
+            server_lsn = self.server_lsn()
+        except Exception, exc:
+            LOG.debug("Failed to read the server's LSN: %s", exc)
+            return
+        if server_lsn is None:
+            return
+        lag = max(server_lsn - self.lsn, 0)
+        self.max_lag = max(self.max_lag or 0, lag)
+        if self._last_check is not None:
+            last_time, last_server_lsn, last_lsn, last_lag = self._last_check
+            elapsed = now - last_time
+            if elapsed > 0:
+                self.redo_rate = (server_lsn - last_server_lsn) / elapsed
+            if self.lsn == last_lsn and server_lsn > last_server_lsn:
+                self.stalls += 1
+                LOG.warning("xtrabackup has not copied any redo log for "
+                            "%s while the server wrote %s",
+                            format_interval(elapsed),
+                            format_bytes(server_lsn - last_server_lsn))
+            elif self.log_capacity and lag > last_lag and \
+                lag >= self.log_capacity*self.lag_warning:
+                self.stalls += 1
+                LOG.warning("Redo generation is outpacing xtrabackup's log "
+                            "copy: %s of %s redo log capacity not copied "
+                            "yet. The backup fails if InnoDB overwrites it.",
+                            format_bytes(lag),
+                            format_bytes(self.log_capacity))
+        self._last_check = (now, server_lsn, self.lsn, lag)
+
+    def copy_rate(self):
+        """Average bytes copied per second so far"""
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0
+        return self.bytes_copied / elapsed
+
+    def log_copy_rate(self):
+        """Average bytes of redo copied per second so far"""
+        elapsed = time.time() - self.start_time
+        if self.lsn is None or elapsed <= 0:
+            return 0
+        return (self.lsn - self.start_lsn) / elapsed
+
+    def eta(self):
+        """Estimated seconds until all data files are copied or None"""
+        rate = self.copy_rate()
+        if not self.total_size or not rate:
+            return None
+        return max(self.total_size - self.bytes_copied, 0) / rate
+
+    def report(self):
+        """Log the progress so far"""
+        message = "xtrabackup progress: %d files, %s copied at %s/s" % \
+                  (self.files_copied, format_bytes(self.bytes_copied),
+                   format_bytes(self.copy_rate()))
+        eta = self.eta()
+        if eta is not None:
+            message += ", about %s remaining" % format_interval(eta)
+        if self.lsn is not None:
+            message += "; redo copied up to LSN %d" % self.lsn
+        LOG.info("%s", message)
+
+    def record_metrics(self, config):
+        """Record the progress in the [holland:metrics] section of a backup
+        config"""
+        metrics = config.setdefault('holland:metrics', {})
+        metrics['xtrabackup-files-copied'] = self.files_copied
+        metrics['xtrabackup-bytes-copied'] = self.bytes_copied
+        metrics['xtrabackup-copy-rate'] = '%.3f' % self.copy_rate()
+        if self.lsn is not None:
+            metrics['xtrabackup-redo-copied'] = self.lsn - self.start_lsn
+            metrics['xtrabackup-redo-copy-rate'] = '%.3f' % \
+                                                   self.log_copy_rate()
+        if self.redo_rate is not None:
+            metrics['xtrabackup-redo-generation-rate'] = '%.3f' % \
+                                                         self.redo_rate
+        if self.max_lag is not None:
+            metrics['xtrabackup-redo-lag-max'] = self.max_lag
+        metrics['xtrabackup-redo-stall-warnings'] = self.stalls
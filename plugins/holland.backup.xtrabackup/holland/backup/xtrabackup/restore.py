@@ -0,0 +1,114 @@
+"""
+holland.backup.xtrabackup.restore
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Restore support for xtrabackup backups
+"""
+
+import os
+import logging
+from holland.core.command import Command, option
+from holland.core.backup import BackupError
+from holland.core.spool import spool
+from holland.backup.xtrabackup import util
+from holland.backup.xtrabackup.prepare import run_prepare
+from holland.backup.xtrabackup.plugin import XtrabackupPlugin
+
+LOG = logging.getLogger(__name__)
+
+class XtrabackupRestore(Command):
+    """${cmd_usage}
+
+    Prepare an xtrabackup backup for restore
+
+    A deferred prepare that is still running is waited for and a pending
+    one is run right away.  For an incremental backup every backup of its
+    chain is prepared.  With --copy-back a prepared full backup is copied
+    to the datadir named in the backup's my.cnf.  A full backup prepared
+    with --redo-only is fully prepared first, after which no incremental
+    backup can be applied to it.
+
+    ${cmd_option_list}
+    """
+
+    name = 'xtrabackup'
+
+    options = [
+        option('--copy-back', action='store_true', default=False,
+               help="Copy the prepared backup to the datadir with "
+                    "innobackupex --copy-back"),
+    ]
+
+    description = 'Prepare and restore an xtrabackup backup'
+
+    def __init__(self, backup):
+        Command.__init__(self)
+        self.backup = backup
+
+    def chain(self):
+        """List the backups this backup depends on, oldest first
+
+        :raises: BackupError if a backup of the chain no longer exists
+        """
+        chain = [self.backup]
+        while chain[0].parent():
+            name = chain[0].parent()
+            parent = spool.find_backup(name)
+            if parent is None:
+                raise BackupError("%s needed by %s no longer exists" %
+                                  (name, chain[0].name))
+            chain.insert(0, parent)
+        return chain
+
+    def finish_prepare(self):
+        """Roll back uncommitted transactions of a full backup that was
+        only prepared with --redo-only so it can be copied back"""
+        chain = self.backup.config.get('xtrabackup:chain', {})
+        if chain.get('prepared') != 'redo-only':
+            return
+        LOG.info("%s was prepared with --redo-only. Completing the prepare "
+                 "before copying it back.", self.backup.name)
+        plugin = XtrabackupPlugin(self.backup.name, self.backup.config,
+                                  self.backup.path)
+        plugin.finish_prepare()
+        self.backup.config.write()
+
+    def run(self, cmd, opts):
+        try:
+            for backup in self.chain():
+                state = run_prepare(backup)
+                if state == 'failed':
+                    error = backup.config['xtrabackup:prepare'].get('error')
+                    LOG.error("The prepare of %s failed: %s", backup.name,
+                              error)
+                    return 1
+                LOG.info("%s is %s", backup.name, state or 'not deferred')
+        except BackupError, exc:
+            LOG.error("%s", exc)
+            return 1
+
+        if not opts.copy_back:
+            return 0
+        if self.backup.parent():
+            LOG.error("%s is an incremental backup. Apply it to its full "
+                      "backup with innobackupex --apply-log --redo-only "
+                      "--incremental-dir before restoring it.",
+                      self.backup.name)
+            return 1
+        datadir = os.path.join(self.backup.path, 'data')
+        if not os.path.isdir(datadir):
+            LOG.error("%s was streamed and not extracted. Extract it to "
+                      "restore it.", self.backup.name)
+            return 1
+        try:
+            self.finish_prepare()
+        except BackupError, exc:
+            LOG.error("%s", exc)
+            return 1
+        try:
+            util.copy_back(self.backup.config['xtrabackup'], datadir,
+                           os.path.join(self.backup.path, 'my.cnf'))
+        except BackupError, exc:
+            LOG.error("%s", exc)
+            return 1
+        return 0
@@ -5,14 +5,18 @@ holland.backup.xtrabackup.util
 Utility methods used by the xtrabackup plugin
 """
 
+import os
 import codecs
 import tempfile
 import logging
 from string import Template
-from os.path import join, isabs, expanduser
+from os.path import join, isabs, expanduser, exists
+from shutil import copyfileobj
 from subprocess import Popen, PIPE, STDOUT, list2cmdline
 from holland.core.backup import BackupError
+from holland.core.util.supervise import Supervisor
 from holland.lib.which import which, WhichError
+from holland.lib.compression import read_split_index
 
 LOG = logging.getLogger(__name__)
 
@@ -52,8 +56,11 @@ def generate_defaults_file(defaults_file, include=(), auth_opts=None):
 
     return defaults_file
 
-def run_xtrabackup(args, stdout, stderr):
-    """Run xtrabackup"""
+def run_xtrabackup(args, stdout, stderr, progress=None):
+    """Run xtrabackup
+
+    :param progress: XtrabackupProgress to update while xtrabackup runs
+    """
     cmdline = list2cmdline(args)
     LOG.info("Executing: %s", cmdline)
     LOG.info("  > %s 2 > %s", stdout.name, stderr.name)
@@ -64,7 +71,10 @@ def run_xtrabackup(args, stdout, stderr):
         raise BackupError("%s failed: %s" % (args[0], exc.strerror))
 
     try:
-        process.wait()
+        if progress is None:
+            process.wait()
+        else:
+            _wait_with_progress(process, progress)
     except KeyboardInterrupt:
         raise BackupError("Interrupted")
     except SystemExit:
@@ -75,39 +85,26 @@ def run_xtrabackup(args, stdout, stderr):
         raise BackupError("innobackupex exited with failure status [%d]" %
                           process.returncode)
 
-def apply_xtrabackup_logfile(xb_cfg, backupdir):
-    """Apply xtrabackup_logfile via innobackupex --apply-log [options]"""
-    # run ${innobackupex} --apply-log ${backupdir}
-    # only applies when streaming is not used
-    stream_method = determine_stream_method(xb_cfg['stream'])
-    if stream_method is not None:
-        LOG.warning("Skipping --prepare/--apply-logs since backup is streamed")
-        return
-
-    if '--compress' in xb_cfg['additional-options']:
-        LOG.warning("Skipping --apply-logs since --compress option appears "
-                    "to have been used.")
-        return
+def _run_innobackupex(xb_cfg, args):
+    """Run innobackupex with args and log its output
 
+    :raises: BackupError if innobackupex could not be run or failed
+    """
     innobackupex = xb_cfg['innobackupex']
     if not isabs(innobackupex):
         try:
             innobackupex = which(innobackupex)
         except WhichError:
             raise BackupError("Failed to find innobackupex script")
-    args = [
-        innobackupex,
-        '--apply-log',
-        backupdir
-    ]
+    args = [innobackupex] + args
 
     cmdline = list2cmdline(args)
     LOG.info("Executing: %s", cmdline)
     try:
         process = Popen(args, stdout=PIPE, stderr=STDOUT, close_fds=True)
     except OSError, exc:
-        raise BackupError("Failed to run %s: [%d] %s",
-                          cmdline, exc.errno, exc.strerror)
+        raise BackupError("Failed to run %s: [%d] %s" %
+                          (cmdline, exc.errno, exc.strerror))
 
     for line in process.stdout:
         LOG.info("%s", line.rstrip())
@@ -116,6 +113,196 @@ def apply_xtrabackup_logfile(xb_cfg, backupdir):
         raise BackupError("%s returned failure status [%d]" %
                           (cmdline, process.returncode))
 
+def decompress_backup(xb_cfg, backupdir, parallel=1):
+    """Decompress the .qp files of a backup taken with --compress via
+    innobackupex --decompress and remove them"""
+    _run_innobackupex(xb_cfg, ['--decompress',
+                               '--parallel=%d' % parallel,
+                               backupdir])
+    for dirpath, dirnames, filenames in os.walk(backupdir):
+        for name in filenames:
+            if name.endswith('.qp'):
+                os.unlink(join(dirpath, name))
+
+def _wait_with_progress(process, progress):
+    """Wait for xtrabackup to exit and follow its log every second"""
+    supervisor = Supervisor()
+    try:
+        supervisor.watch(process)
+        def exited():
+            progress.update()
+            return process.returncode is not None
+        while not supervisor.wait(exited, timeout=1):
+            pass
+    finally:
+        supervisor.close()
+    progress.report()
+
+def apply_xtrabackup_logfile(xb_cfg, backupdir, redo_only=False,
+                             use_memory=None, parallel=1):
+    """Apply xtrabackup_logfile via innobackupex --apply-log [options]
+
+    With redo_only, uncommitted transactions are not rolled back so that
+    incremental backups can still be applied on top of the backup.
+    use_memory sets the buffer pool size, in bytes, used to apply the log.
+    A backup taken with --compress is decompressed with parallel threads
+    first.
+    """
+    if '--compress' in xb_cfg['additional-options']:
+        decompress_backup(xb_cfg, backupdir, parallel)
+
+    args = [
+        '--apply-log',
+    ]
+    if redo_only:
+        args.append('--redo-only')
+    if use_memory:
+        args.append('--use-memory=%d' % use_memory)
+    args.append(backupdir)
+    _run_innobackupex(xb_cfg, args)
+
+def copy_back(xb_cfg, backupdir, defaults_file=None):
+    """Copy a prepared backup to the datadir via innobackupex --copy-back
+
+    :param defaults_file: option file naming the datadir to restore to
+    """
+    args = []
+    if defaults_file:
+        args.append('--defaults-file=' + defaults_file)
+    args += ['--copy-back', backupdir]
+    _run_innobackupex(xb_cfg, args)
+
+def extract_stream(stream, path, destination, argv=None, parallel=1,
+                   stderr=None):
+    """Extract a tar or xbstream backup stream into destination
+
+    xbstream extracts with parallel threads.  A compressed stream is
+    decompressed by a separate process feeding the extractor.
+
+    :param path: path of the stream.  If path.index exists the stream was
+                 split and its volumes are extracted in order.
+    :param argv: compression command the stream was written with
+    :param stderr: file the extractor's output is written to
+    :raises: BackupError if extraction failed
+    """
+    if stream == 'xbstream':
+        name = 'xbstream'
+        args = ['-x', '-C', destination]
+        if parallel > 1:
+            args.append('--parallel=%d' % parallel)
+    else:
+        # innobackupex tar streams need --ignore-zeros
+        name = 'tar'
+        args = ['-x', '-i', '-f', '-', '-C', destination]
+    try:
+        args = [which(name)] + args
+    except WhichError:
+        raise BackupError("Failed to find %s to extract the backup" % name)
+    if exists(path + '.index'):
+        volumes = [volume[0] for volume in read_split_index(path)]
+    else:
+        volumes = [path]
+
+    LOG.info("Extracting %s into %s", path, destination)
+    LOG.info("Executing: %s", list2cmdline(args))
+    try:
+        extractor = Popen(args, stdin=PIPE, stdout=stderr, stderr=stderr,
+                          close_fds=True)
+    except OSError, exc:
+        raise BackupError("Failed to run %s: [%d] %s" %
+                          (list2cmdline(args), exc.errno, exc.strerror))
+    try:
+        for volume in volumes:
+            fileobj = open(volume, 'rb')
+            try:
+                if argv:
+                    process = Popen(argv + ['--decompress'], stdin=fileobj,
+                                    stdout=extractor.stdin, stderr=stderr,
+                                    close_fds=True)
+                    if process.wait() != 0:
+                        raise BackupError("%s exited with failure status [%d] "
+                                          "decompressing %s" %
+                                          (argv[0], process.returncode,
+                                           volume))
+                else:
+                    try:
+                        copyfileobj(fileobj, extractor.stdin, 1024*1024)
+                    except IOError, exc:
+                        # the extractor exited early; its status is
+                        # reported below
+                        LOG.debug("Writing to %s failed: %s", name, exc)
+                        break
+            finally:
+                fileobj.close()
+    finally:
+        try:
+            extractor.stdin.close()
+        except IOError:
+            pass
+        extractor.wait()
+    if extractor.returncode != 0:
+        raise BackupError("%s exited with failure status [%d]" %
+                          (name, extractor.returncode))
+
+def read_checkpoints(backupdir):
+    """Read the xtrabackup_checkpoints file of a backup
+
+    The file is looked for in backupdir itself, where --extra-lsndir
+    writes it, and in the data/ directory of a non-streamed backup.
+
+    :returns: dict of the checkpoint values or None if none was found
+    """
+    for path in (join(backupdir, 'xtrabackup_checkpoints'),
+                 join(backupdir, 'data', 'xtrabackup_checkpoints')):
+        if not exists(path):
+            continue
+        checkpoints = {}
+        try:
+            for line in open(path, 'r'):
+                if '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                checkpoints[key.strip()] = value.strip()
+        except IOError, exc:
+            LOG.warning("Failed to read %s: %s", path, exc)
+            continue
+        if 'to_lsn' in checkpoints:
+            return checkpoints
+    return None
+
+#: spool write throughput, in bytes per second, one copy thread can keep up
+COPY_THREAD_THROUGHPUT = 64*1024*1024
+
+def auto_tune(cpus, memory=None, throughput=None):
+    """Choose xtrabackup thread counts and prepare memory for this host
+
+    Half of the CPUs (at most 16) copy data files with --parallel, but no
+    more threads than the spool, at the ``throughput`` previous backups
+    were written with, can absorb.  The remaining CPUs compress.
+    --use-memory for --apply-log gets half of the available memory.
+
+    :returns: dict with parallel, compress-threads and use-memory
+    """
+    parallel = max(1, min(cpus // 2, 16))
+    if throughput:
+        parallel = max(1, min(parallel,
+                              int(throughput // COPY_THREAD_THROUGHPUT) + 1))
+    use_memory = 128*1024*1024
+    if memory:
+        use_memory = max(use_memory, memory // 2)
+    return {
+        'parallel'          : parallel,
+        'compress-threads'  : max(1, min(cpus - parallel, 64)),
+        'use-memory'        : int(use_memory),
+    }
+
+def has_option(args, name):
+    """Check whether a list of options already sets --name"""
+    for arg in args:
+        if arg == name or arg.startswith(name + '='):
+            return True
+    return False
+
 def determine_stream_method(stream):
     """Calculate the stream option from the holland config"""
     stream = stream.lower()
@@ -179,8 +366,19 @@ def add_xtrabackup_defaults(defaults_path, **kwargs):
                               defaults_path)
     finally:
         fileobj.close()
-def build_xb_args(config, basedir, defaults_file=None):
-    """Build the commandline for xtrabackup"""
+def build_xb_args(config, basedir, defaults_file=None, extra_lsndir=None,
+                  incremental_basedir=None, incremental_lsn=None,
+                  tuning=None):
+    """Build the commandline for xtrabackup
+
+    :param extra_lsndir: also write xtrabackup_checkpoints to this directory
+    :param incremental_basedir: take an incremental backup against the
+                                uncompressed backup in this directory
+    :param incremental_lsn: take an incremental backup of the pages changed
+                            since this LSN
+    :param tuning: dict from auto_tune().  Options already given in
+                   additional-options are not added again.
+    """
     innobackupex = config['innobackupex']
     if not isabs(innobackupex):
         try:
@@ -217,6 +415,20 @@ def build_xb_args(config, basedir, defaults_file=None):
     if no_lock:
         args.append('--no-lock')
     args.append('--no-timestamp')
+    if extra_lsndir:
+        args.append('--extra-lsndir=' + extra_lsndir)
+    if incremental_basedir:
+        args.append('--incremental')
+        args.append('--incremental-basedir=' + incremental_basedir)
+    elif incremental_lsn:
+        args.append('--incremental')
+        args.append('--incremental-lsn=' + str(incremental_lsn))
+    if tuning:
+        if not has_option(extra_opts, '--parallel'):
+            args.append('--parallel=%d' % tuning['parallel'])
+        if '--compress' in extra_opts and \
+            not has_option(extra_opts, '--compress-threads'):
+            args.append('--compress-threads=%d' % tuning['compress-threads'])
     if extra_opts:
         args.extend(extra_opts)
     if basedir:
@@ -23,6 +23,9 @@ setup(name='holland.backup.xtrabackup',
       entry_points="""
       [holland.backup]
       xtrabackup = holland.backup.xtrabackup:XtrabackupPlugin
+
+      [holland.restore]
+      xtrabackup = holland.backup.xtrabackup.restore:XtrabackupRestore
       """,
       namespace_packages=['holland', 'holland.backup'],
     )
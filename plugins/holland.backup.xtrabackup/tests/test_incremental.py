@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from holland.core.config.config import BaseConfig
+from holland.core.spool import Backup, spool
+from holland.backup.xtrabackup.plugin import XtrabackupPlugin
+
+def setup_func():
+    global tmpdir, roots, saved_paths
+    tmpdir = tempfile.mkdtemp()
+    roots = [os.path.join(tmpdir, 'spool0'), os.path.join(tmpdir, 'spool1')]
+    saved_paths = spool.paths
+    spool.path = roots
+
+def teardown_func():
+    spool.path = saved_paths
+    shutil.rmtree(tmpdir)
+
+def _add_backup(root, name, parent=None):
+    path = os.path.join(root, 'default', name)
+    os.makedirs(os.path.join(path, 'data'))
+    open(os.path.join(path, 'data', 'xtrabackup_checkpoints'), 'w').write(
+        "backup_type = full-backuped\n"
+        "from_lsn = 0\n"
+        "to_lsn = 1626007\n")
+    backup = Backup(path, 'default', name)
+    backup.config['holland:backup']['plugin'] = 'xtrabackup'
+    backup.config['holland:backup']['start-time'] = 1000.0
+    backup.config['holland:backup']['stop-time'] = 1100.0
+    if parent:
+        backup.config['holland:backup']['parent'] = parent
+    backup.flush()
+    return backup
+
+def _plugin(root, name):
+    path = os.path.join(root, 'default', name)
+    os.makedirs(path)
+    config = BaseConfig({'xtrabackup' : {'incremental' : 'yes'}})
+    return XtrabackupPlugin('default', config, path)
+
+@with_setup(setup_func, teardown_func)
+def test_incremental_base_across_roots():
+    _add_backup(roots[0], '20140101_000000')
+    _add_backup(roots[1], '20140102_000000', parent='default/20140101_000000')
+    plugin = _plugin(roots[0], '20140103_000000')
+    base, checkpoints = plugin.find_incremental_base()
+    eq_(base.name, 'default/20140102_000000')
+    eq_(checkpoints['to_lsn'], '1626007')
+
+@with_setup(setup_func, teardown_func)
+def test_incremental_base_fully_prepared():
+    backup = _add_backup(roots[0], '20140101_000000')
+    backup.config['xtrabackup:chain'] = {'prepared' : 'full'}
+    backup.flush()
+    plugin = _plugin(roots[0], '20140102_000000')
+    eq_(plugin.find_incremental_base(), (None, None))
+
+@with_setup(setup_func, teardown_func)
+def test_restore_redo_only():
+    from holland.backup.xtrabackup import util
+    from holland.backup.xtrabackup.restore import XtrabackupRestore
+    backup = _add_backup(roots[0], '20140101_000000')
+    backup.config['xtrabackup:chain'] = {'prepared' : 'redo-only'}
+    backup.flush()
+    calls = []
+    def apply_xtrabackup_logfile(xb_cfg, backupdir, redo_only=False,
+                                 use_memory=None, parallel=1):
+        calls.append(('apply-log', redo_only))
+    def copy_back(xb_cfg, backupdir, defaults_file=None):
+        calls.append(('copy-back', backupdir))
+    saved = util.apply_xtrabackup_logfile, util.copy_back
+    util.apply_xtrabackup_logfile, util.copy_back = \
+        apply_xtrabackup_logfile, copy_back
+    try:
+        class Options(object):
+            copy_back = True
+        eq_(XtrabackupRestore(backup).run('xtrabackup', Options()), 0)
+    finally:
+        util.apply_xtrabackup_logfile, util.copy_back = saved
+    eq_(calls, [('apply-log', False),
+                ('copy-back', os.path.join(backup.path, 'data'))])
+    backup.load_config()
+    eq_(backup.config['xtrabackup:chain']['prepared'], 'full')
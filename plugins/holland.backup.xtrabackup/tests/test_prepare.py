@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from holland.backup.xtrabackup.prepare import PREPARE_LOCK, _lock, \
+                                             backup_finished, load_backup, \
+                                             record_state, run_prepare
+
+def setup_func():
+    global tmpdir, backupdir
+    tmpdir = tempfile.mkdtemp()
+    backupdir = os.path.join(tmpdir, 'default', '20130101_000000')
+    os.makedirs(backupdir)
+
+def teardown_func():
+    shutil.rmtree(tmpdir)
+
+def _write_config(text):
+    open(os.path.join(backupdir, 'backup.conf'), 'w').write(text)
+
+@with_setup(setup_func, teardown_func)
+def test_backup_finished():
+    eq_(backup_finished(backupdir), None)
+    _write_config("[holland:backup]\nstart-time = 1\n")
+    eq_(backup_finished(backupdir), None)
+    _write_config("[holland:backup]\nstop-time = 2\non-disk-size = 100\n")
+    eq_(backup_finished(backupdir), True)
+    _write_config("[holland:backup]\nfailed = True\n")
+    eq_(backup_finished(backupdir), False)
+
+@with_setup(setup_func, teardown_func)
+def test_run_prepare_state():
+    backup = load_backup(backupdir)
+    record_state(backup.config, 'prepared')
+    backup.config.write()
+    eq_(run_prepare(backup), 'prepared')
+
+@with_setup(setup_func, teardown_func)
+def test_run_prepare_locked():
+    backup = load_backup(backupdir)
+    record_state(backup.config, 'pending')
+    backup.config.write()
+    lock = _lock(os.path.join(backupdir, PREPARE_LOCK))
+    try:
+        eq_(run_prepare(backup, blocking=False), 'running')
+    finally:
+        lock.close()
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from holland.core.config.config import BaseConfig
+from holland.backup.xtrabackup.mysql import MySQL
+from holland.backup.xtrabackup.plugin import XtrabackupPlugin
+from holland.backup.xtrabackup.progress import XtrabackupProgress, \
+                                              parse_innodb_status_lsn
+
+XB_LOG = """\
+>> log scanned up to (1000)
+[01] Streaming ./ibdata1
+>> log scanned up to (3000)
+[01]        ...done
+[02] Compressing and streaming ./test/t1.ibd
+[02]        ...done
+2020-01-01T00:00:00.000000-00:00 0 [Note] [MY-011825] [Xtrabackup] Done: Copying ./test/t2.ibd to /backup/test/t2.ibd
+"""
+
+def setup_func():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(tmpdir, 'test'))
+    for name, size in (('ibdata1', 1000), ('test/t1.ibd', 200),
+                       ('test/t2.ibd', 30)):
+        open(os.path.join(tmpdir, name), 'w').write('x'*size)
+
+def teardown_func():
+    shutil.rmtree(tmpdir)
+
+@with_setup(setup_func, teardown_func)
+def test_progress():
+    path = os.path.join(tmpdir, 'xtrabackup.log')
+    fileobj = open(path, 'w')
+    fileobj.write(XB_LOG[:20])
+    fileobj.flush()
+    progress = XtrabackupProgress(path, datadir=tmpdir, total_size=2460)
+    progress.update()
+    assert_equals(progress.lsn, None)
+    fileobj.write(XB_LOG[20:])
+    fileobj.close()
+    progress.update()
+    assert_equals(progress.files_copied, 3)
+    assert_equals(progress.bytes_copied, 1230)
+    assert_equals(progress.lsn, 3000)
+    config = {}
+    progress.record_metrics(config)
+    assert_equals(config['holland:metrics']['xtrabackup-redo-copied'], 2000)
+
+@with_setup(setup_func, teardown_func)
+def test_stall_warning():
+    path = os.path.join(tmpdir, 'xtrabackup.log')
+    open(path, 'w').write(">> log scanned up to (1000)\n")
+    server = [5000, 9000]
+    progress = XtrabackupProgress(path, server_lsn=lambda: server.pop(0),
+                                  log_capacity=10000, interval=0)
+    progress.update()
+    assert_equals(progress.max_lag, 4000)
+    progress.update()
+    assert_equals(progress.stalls, 1)
+    assert_equals(progress.max_lag, 8000)
+
+def test_parse_innodb_status_lsn():
+    assert_equals(parse_innodb_status_lsn("---\nLOG\n---\n"
+                                          "Log sequence number 1626007\n"),
+                  1626007)
+    assert_equals(parse_innodb_status_lsn("Log sequence number 1 5\n"),
+                  (1 << 32) + 5)
+    assert_equals(parse_innodb_status_lsn(""), None)
+
+class FakeCursor(object):
+    """Answers SHOW VARIABLES LIKE from a dict of variables"""
+    def __init__(self, variables):
+        self.variables = variables
+        self.row = None
+
+    def execute(self, sql, args=None):
+        name = sql.split("'")[1].replace('\\', '')
+        if name not in self.variables:
+            self.row = None
+            return 0
+        self.row = (name, self.variables[name])
+        return 1
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+class FakeConnection(object):
+    def __init__(self, variables):
+        self.variables = variables
+
+    def cursor(self):
+        return FakeCursor(self.variables)
+
+    def close(self):
+        pass
+
+@with_setup(setup_func, teardown_func)
+def test_open_progress_without_redo_log_capacity():
+    # MySQL 5.6, 5.7 and 8.0 before 8.0.30
+    client = MySQL.__new__(MySQL)
+    client._connection = FakeConnection({
+        'datadir' : tmpdir,
+        'innodb_log_file_size' : '50331648',
+        'innodb_log_files_in_group' : '2',
+    })
+    assert_equals(client.var('innodb_redo_log_capacity', 'GLOBAL'), None)
+    from_defaults = MySQL.__dict__['from_defaults']
+    MySQL.from_defaults = classmethod(lambda cls, path: client)
+    try:
+        target = os.path.join(tmpdir, 'backup')
+        os.mkdir(target)
+        plugin = XtrabackupPlugin('default', BaseConfig({}), target)
+        progress, connection = plugin.open_progress()
+    finally:
+        MySQL.from_defaults = from_defaults
+    ok_(connection is client)
+    assert_equals(progress.datadir, tmpdir)
+    assert_equals(progress.log_capacity, 2*50331648)
+    ok_(progress.server_lsn is not None)
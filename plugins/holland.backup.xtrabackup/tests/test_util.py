@@ -0,0 +1,112 @@
+import os
+import shutil
+import tarfile
+import tempfile
+from nose.tools import *
+from holland.lib.compression import open_stream, stream_info
+from holland.backup.xtrabackup.util import read_checkpoints, build_xb_args, \
+                                           auto_tune, extract_stream
+
+def setup_func():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_func():
+    shutil.rmtree(tmpdir)
+
+@with_setup(setup_func, teardown_func)
+def test_read_checkpoints():
+    assert_equals(read_checkpoints(tmpdir), None)
+    os.mkdir(os.path.join(tmpdir, 'data'))
+    open(os.path.join(tmpdir, 'data', 'xtrabackup_checkpoints'), 'w').write(
+        "backup_type = full-backuped\n"
+        "from_lsn = 0\n"
+        "to_lsn = 1626007\n"
+        "last_lsn = 1626007\n")
+    checkpoints = read_checkpoints(tmpdir)
+    assert_equals(checkpoints['backup_type'], 'full-backuped')
+    assert_equals(checkpoints['to_lsn'], '1626007')
+
+def _config(**kwargs):
+    config = {
+        'innobackupex'      : '/usr/bin/innobackupex',
+        'ibbackup'          : None,
+        'stream'            : 'xbstream',
+        'tmpdir'            : None,
+        'slave-info'        : False,
+        'safe-slave-backup' : False,
+        'no-lock'           : False,
+        'additional-options': [],
+    }
+    config.update(kwargs)
+    return config
+
+def test_build_incremental_args():
+    config = _config()
+    args = build_xb_args(config, '/backups/default/1', extra_lsndir='/tmp',
+                         incremental_lsn='1626007')
+    ok_('--extra-lsndir=/tmp' in args)
+    ok_('--incremental' in args)
+    ok_('--incremental-lsn=1626007' in args)
+    assert_equals(args[-1], '/backups/default/1')
+    args = build_xb_args(config, '/backups/default/1',
+                         incremental_basedir='/backups/default/0/data')
+    ok_('--incremental-basedir=/backups/default/0/data' in args)
+    ok_('--incremental-lsn=1626007' not in args)
+
+def test_auto_tune():
+    tuning = auto_tune(16, 8*1024**3)
+    assert_equals(tuning['parallel'], 8)
+    assert_equals(tuning['compress-threads'], 8)
+    assert_equals(tuning['use-memory'], 4*1024**3)
+    # a slow spool does not get more copy threads than it can absorb
+    tuning = auto_tune(16, None, throughput=100*1024**2)
+    assert_equals(tuning['parallel'], 2)
+    assert_equals(tuning['compress-threads'], 14)
+    assert_equals(tuning['use-memory'], 128*1024**2)
+    tuning = auto_tune(1)
+    assert_equals(tuning['parallel'], 1)
+    assert_equals(tuning['compress-threads'], 1)
+
+def test_build_tuned_args():
+    tuning = auto_tune(8)
+    config = _config(**{'additional-options' : ['--compress']})
+    args = build_xb_args(config, '/backups/default/1', tuning=tuning)
+    ok_('--parallel=4' in args)
+    ok_('--compress-threads=4' in args)
+    config = _config(**{'additional-options' : ['--parallel=2']})
+    args = build_xb_args(config, '/backups/default/1', tuning=tuning)
+    ok_('--parallel=4' not in args)
+    ok_('--parallel=2' in args)
+    ok_('--compress-threads=4' not in args)
+
+def _write_tar_stream(path, **kwargs):
+    source = os.path.join(tmpdir, 'source')
+    os.mkdir(source)
+    open(os.path.join(source, 'ibdata1'), 'w').write('x'*100000)
+    stream = open_stream(path, 'w', method='gzip', level=1, **kwargs)
+    archive = tarfile.open(mode='w|', fileobj=stream)
+    archive.add(os.path.join(source, 'ibdata1'), 'ibdata1')
+    archive.close()
+    stream.close()
+    return stream_info(path, 'gzip')
+
+@with_setup(setup_func, teardown_func)
+def test_extract_stream():
+    argv, path = _write_tar_stream(os.path.join(tmpdir, 'backup.tar'))
+    destination = os.path.join(tmpdir, 'data')
+    os.mkdir(destination)
+    extract_stream('tar', path, destination, argv)
+    assert_equals(open(os.path.join(destination, 'ibdata1')).read(),
+                  'x'*100000)
+
+@with_setup(setup_func, teardown_func)
+def test_extract_split_stream():
+    argv, path = _write_tar_stream(os.path.join(tmpdir, 'backup.tar'),
+                                   split_size=1024)
+    ok_(os.path.exists(path + '.index'))
+    destination = os.path.join(tmpdir, 'data')
+    os.mkdir(destination)
+    extract_stream('tar', path, destination, argv)
+    assert_equals(open(os.path.join(destination, 'ibdata1')).read(),
+                  'x'*100000)
@@ -14,7 +14,7 @@ archive_methods = {
     'zip' : (ZipArchive, '.zip')
 }
 
-def create_archive(method, base_path):
+def create_archive(method, base_path, **kwargs):
     archive_info = archive_methods.get(method)
     
     if not archive_info:
@@ -25,4 +25,4 @@ def create_archive(method, base_path):
     if not base_path.endswith(ext):
         base_path += ext
     
-    return cls(base_path)
+    return cls(base_path, **kwargs)
@@ -0,0 +1,153 @@
+"""
+Parallel deflate compression in the style of pigz
+
+Input is cut into fixed size blocks which are deflated independently on a
+pool of threads (zlib releases the GIL while compressing).  Each block is
+ended with a sync flush so it finishes on a byte boundary.  The blocks are
+then written out in order and terminated with an empty final block, which
+yields a single valid raw deflate stream.  Unlike pigz, blocks are not
+primed with the previous block's data as a dictionary, since
+zlib.compressobj() has no zdict argument before python 3.3.  This costs a
+little compression ratio.
+"""
+
+import time
+import zlib
+import Queue
+import struct
+import threading
+
+#: default amount of input deflated as one block
+BLOCK_SIZE = 256*1024
+
+class _Block(object):
+    """A block of input and, once a worker is done with it, its deflated
+    form"""
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class ParallelDeflate(object):
+    """
+    Write a raw deflate stream to ``fileobj`` compressing blocks on
+    ``workers`` threads
+
+    The crc32, uncompressed size and compressed size of everything written
+    are tracked as ``crc``, ``size`` and ``compressed_size``.
+    """
+    def __init__(self, fileobj, level=6, workers=2, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.crc = zlib.crc32('') & 0xffffffffL
+        self.size = 0
+        self.compressed_size = 0
+        self._buffer = ''
+        self._pending = []
+        self._max_pending = workers*4
+        self._queue = Queue.Queue()
+        self._threads = []
+        for idx in xrange(max(workers, 1)):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            try:
+                try:
+                    compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                                  -zlib.MAX_WBITS)
+                    block.result = compressor.compress(block.data) + \
+                                   compressor.flush(zlib.Z_SYNC_FLUSH)
+                except Exception, exc:
+                    block.error = exc
+            finally:
+                block.data = None
+                block.done.set()
+
+    def _submit(self, data):
+        block = _Block(data)
+        self._pending.append(block)
+        self._queue.put(block)
+        while len(self._pending) > self._max_pending:
+            self._write_block(self._pending.pop(0))
+
+    def _write_block(self, block):
+        block.done.wait()
+        if block.error is not None:
+            raise block.error
+        self.fileobj.write(block.result)
+        self.compressed_size += len(block.result)
+
+    def write(self, data):
+        if not data:
+            return
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffffL
+        self.size += len(data)
+        if self._buffer:
+            data = self._buffer + data
+        end = len(data) - len(data) % self.block_size
+        for offset in xrange(0, end, self.block_size):
+            self._submit(data[offset:offset + self.block_size])
+        self._buffer = data[end:]
+
+    def finish(self):
+        """Compress any buffered data, write all outstanding blocks and
+        terminate the deflate stream"""
+        try:
+            if self._buffer:
+                self._submit(self._buffer)
+                self._buffer = ''
+            while self._pending:
+                self._write_block(self._pending.pop(0))
+        finally:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        # an empty final block marks the end of the stream
+        tail = zlib.compressobj(self.level, zlib.DEFLATED,
+                                -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+        self.fileobj.write(tail)
+        self.compressed_size += len(tail)
+
+class ParallelGzipFile(object):
+    """
+    Minimal write-only gzip file object compressing with ParallelDeflate
+
+    Output is a single gzip member readable by gzip, zcat and tarfile.
+    """
+    def __init__(self, path, level=9, workers=2, block_size=BLOCK_SIZE):
+        self.name = path
+        self.fileobj = open(path, 'wb')
+        self.closed = False
+        # magic, deflate, no flags, mtime, max compression, unix
+        self.fileobj.write(struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0,
+                                       long(time.time()), 2, 3))
+        self.deflate = ParallelDeflate(self.fileobj, level, workers,
+                                       block_size)
+
+    def write(self, data):
+        self.deflate.write(data)
+
+    def tell(self):
+        return self.deflate.size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.deflate.finish()
+            self.fileobj.write(struct.pack('<LL', self.deflate.crc,
+                                           self.deflate.size & 0xffffffffL))
+        finally:
+            self.fileobj.close()
@@ -3,6 +3,7 @@ import pwd
 import grp
 import time
 import tarfile
+from holland.lib.archive.pdeflate import ParallelGzipFile
 
 try:
     from cStringIO import StringIO
@@ -25,7 +26,7 @@ class TarArchive(object):
     """
     Read, write, access Tar archives.
     """
-    def __init__(self, path, mode='w:gz'):
+    def __init__(self, path, mode='w:gz', workers=1):
         """
         Initialize a TarArchive.
         
@@ -33,10 +34,17 @@ class TarArchive(object):
         
         path -- Path to the archive file
         mode -- Archive mode.  Default: w:gz (write + gzip) (see tarfile)
+        workers -- Number of threads to gzip with when mode is w:gz.
+                   Default: 1 (compress in tarfile itself)
         """
         self.path = path
         self.mode = mode
-        self.archive = tarfile.open(path, mode)
+        self.gzipfile = None
+        if mode == 'w:gz' and workers > 1:
+            self.gzipfile = ParallelGzipFile(path, workers=workers)
+            self.archive = tarfile.open(path, 'w', fileobj=self.gzipfile)
+        else:
+            self.archive = tarfile.open(path, mode)
 
     def add_file(self, path, name):
         """
@@ -90,14 +98,34 @@ class TarArchive(object):
         Close archive.
         """
         self.archive.close()
+        if self.gzipfile is not None:
+            self.gzipfile.close()
 
 if __name__ == '__main__':
-    now = time.time()
-    xv = TarArchive('foo.tgz', 'w:gz')
-    xv.add_string("[mysqldump]\nignore-table=mysql.user\n", "my.cnf")
-    xv.add_string("blah", "test/test.MYD")
-    xv.add_file("user.frm", "mysql/user.frm")
-    xv.add_file("user.MYD", "mysql/user.MYD")
-    xv.add_file("user.MYI", "mysql/user.MYI")
-    xv.close()
-    print (time.time() - now), "seconds"
+    # Compare tarfile's own gzip compression with ParallelGzipFile
+    #
+    # usage: tar_archive.py <workers> <file> [<file> ...]
+    import sys
+    import tempfile
+    if len(sys.argv) < 3:
+        print >>sys.stderr, "usage: %s <workers> <file> [<file> ...]" % \
+                            sys.argv[0]
+        sys.exit(1)
+    workers = int(sys.argv[1])
+    paths = sys.argv[2:]
+    total = sum([os.stat(path).st_size for path in paths])
+    for count in (1, workers):
+        fd, name = tempfile.mkstemp(suffix='.tgz', dir='.')
+        os.close(fd)
+        try:
+            now = time.time()
+            xv = TarArchive(name, 'w:gz', workers=count)
+            for idx, path in enumerate(paths):
+                xv.add_file(path, 'data/%d' % idx)
+            xv.close()
+            elapsed = time.time() - now
+            print "workers=%-3d %.3f seconds %.2f MB/s %d bytes" % \
+                (count, elapsed, total / elapsed / 1024 / 1024,
+                 os.stat(name).st_size)
+        finally:
+            os.unlink(name)
@@ -1,6 +1,9 @@
+import os
 import time
+import zlib
 import zipfile
 import logging
+from holland.lib.archive.pdeflate import ParallelDeflate, BLOCK_SIZE
 
 LOGGER = logging.getLogger(__name__)
 
@@ -8,7 +11,7 @@ class ZipArchive(object):
     """
     Read, write, access Zip archives using zipfile.
     """
-    def __init__(self, path, mode='w'):
+    def __init__(self, path, mode='w', workers=1):
         """
         Initialize a ZipArchive.
         
@@ -16,9 +19,12 @@ class ZipArchive(object):
         
         path -- Path to the archive file
         mode -- Archive mode.  Default: w (write) (see zipfile)
+        workers -- Number of threads to deflate each file with.
+                   Default: 1 (compress in zipfile itself)
         """
         self.path = path
         self.mode = mode
+        self.workers = workers
         self.archive = zipfile.ZipFile(path, 
                                        mode, 
                                        zipfile.ZIP_DEFLATED, 
@@ -33,7 +39,63 @@ class ZipArchive(object):
         path -- Path to file for which to add to archive.
         name -- Name of file to save in the archive
         """
-        self.archive.write(path, name, zipfile.ZIP_DEFLATED)
+        if self.workers > 1:
+            self._write_parallel(path, name)
+        else:
+            self.archive.write(path, name, zipfile.ZIP_DEFLATED)
+
+    def _write_parallel(self, path, name):
+        """
+        Add a file to the archive, deflating it with ParallelDeflate
+
+        This follows what zipfile.ZipFile.write() does, including writing
+        Zip64 headers for files near or over 4GB.
+        """
+        archive = self.archive
+        info = os.stat(path)
+        zinfo = zipfile.ZipInfo(name, time.localtime(info.st_mtime)[0:6])
+        zinfo.external_attr = (info.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = info.st_size
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = archive.fp.tell()
+        archive._writecheck(zinfo)
+        archive._didModify = True
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        # compressed size can be larger than uncompressed size
+        zip64 = archive._allowZip64 and \
+                zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        archive.fp.write(zinfo.FileHeader(zip64))
+        deflate = ParallelDeflate(archive.fp, zlib.Z_DEFAULT_COMPRESSION,
+                                  self.workers)
+        fileobj = open(path, 'rb')
+        try:
+            try:
+                while True:
+                    data = fileobj.read(BLOCK_SIZE*self.workers)
+                    if not data:
+                        break
+                    deflate.write(data)
+            finally:
+                deflate.finish()
+        finally:
+            fileobj.close()
+        zinfo.CRC = deflate.crc
+        zinfo.file_size = deflate.size
+        zinfo.compress_size = deflate.compressed_size
+        if not zip64 and archive._allowZip64:
+            if zinfo.file_size > zipfile.ZIP64_LIMIT:
+                raise RuntimeError('File size has increased during compressing')
+            if zinfo.compress_size > zipfile.ZIP64_LIMIT:
+                raise RuntimeError('Compressed size larger than uncompressed size')
+        # rewrite the local header with the real crc and sizes
+        position = archive.fp.tell()
+        archive.fp.seek(zinfo.header_offset, 0)
+        archive.fp.write(zinfo.FileHeader(zip64))
+        archive.fp.seek(position, 0)
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[zinfo.filename] = zinfo
 
     def add_string(self, str, name):
         """
@@ -73,12 +135,30 @@ class ZipArchive(object):
         self.archive.close()
 
 if __name__ == '__main__':
-    now = time.time()
-    xv = ZipArchive('foo.zip', 'w')
-    xv.add_string("[mysqldump]\nignore-table=mysql.user\n", "my.cnf")
-    xv.add_string("blah", "test/test.MYD")
-    xv.add_file("user.frm", "mysql/user.frm")
-    xv.add_file("user.MYD", "mysql/user.MYD")
-    xv.add_file("user.MYI", "mysql/user.MYI")
-    xv.close()
-    print (time.time() - now), "seconds"
+    # Compare zipfile's own deflate with ParallelDeflate
+    #
+    # usage: zip_archive.py <workers> <file> [<file> ...]
+    import sys
+    import tempfile
+    if len(sys.argv) < 3:
+        print >>sys.stderr, "usage: %s <workers> <file> [<file> ...]" % \
+                            sys.argv[0]
+        sys.exit(1)
+    workers = int(sys.argv[1])
+    paths = sys.argv[2:]
+    total = sum([os.stat(path).st_size for path in paths])
+    for count in (1, workers):
+        fd, name = tempfile.mkstemp(suffix='.zip', dir='.')
+        os.close(fd)
+        try:
+            now = time.time()
+            xv = ZipArchive(name, 'w', workers=count)
+            for idx, path in enumerate(paths):
+                xv.add_file(path, 'data/%d' % idx)
+            xv.close()
+            elapsed = time.time() - now
+            print "workers=%-3d %.3f seconds %.2f MB/s %d bytes" % \
+                (count, elapsed, total / elapsed / 1024 / 1024,
+                 os.stat(name).st_size)
+        finally:
+            os.unlink(name)
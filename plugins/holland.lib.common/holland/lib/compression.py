@@ -4,7 +4,14 @@ import errno
 import subprocess
 import which
 import shlex
+import fcntl
+import threading
 from tempfile import TemporaryFile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from holland.lib.fsutil import OutputFile
 
 LOG = logging.getLogger(__name__)
 
@@ -77,25 +84,244 @@ class CompressionInput(object):
         self.closed = True
 
 
+def _compression_args(argv, level):
+    """Extend a compression command line with the requested level"""
+    argv = list(argv)
+    if level:
+        if "gpg" in argv[0]:
+            argv += ['-z%d' % level]
+        else:
+            argv += ['-%d' % level]
+    return argv
+
+def _log_stderr(name, stderr, status):
+    """Log the captured stderr of a compression command and raise an
+    IOError if the command exited with a non-zero status"""
+    stderr.flush()
+    stderr.seek(0)
+    try:
+        if status != 0:
+            for line in stderr:
+                if not line.strip(): continue
+                LOG.error("%s: %s", name, line.rstrip())
+            raise IOError(errno.EPIPE,
+                      "Compression program '%s' exited with status %d" %
+                        (name, status))
+        else:
+            for line in stderr:
+                if not line.strip(): continue
+                LOG.info("%s: %s", name, line.rstrip())
+    finally:
+        stderr.close()
+
+def compress_file(src, dst, argv, level=None, size_hint=None,
+                  durability=None):
+    """
+    Compress the file ``src`` to ``dst`` via the compression command ``argv``
+    and remove ``src`` on success.
+
+    Arguments:
+
+    src     -- Path to the uncompressed file
+    dst     -- Path to write the compressed output to
+    argv    -- Compression command (see lookup_compression)
+    level   -- Compression level
+    size_hint -- Expected size of the compressed output, used to
+                 preallocate ``dst``
+    durability -- How to sync ``dst`` once it is written
+                  (see holland.lib.fsutil.sync_file)
+    """
+    argv = _compression_args(argv, level)
+    src_f = open(src, 'r')
+    try:
+        dst_f = OutputFile(dst, 'w', size_hint, durability)
+        try:
+            LOG.debug("Running %r < %r > %r", argv, src, dst)
+            stderr = TemporaryFile()
+            pid = subprocess.Popen(argv,
+                                   stdin=src_f.fileno(),
+                                   stdout=dst_f.fileno(),
+                                   stderr=stderr,
+                                   close_fds=True)
+            status = pid.wait()
+        finally:
+            dst_f.close()
+    finally:
+        src_f.close()
+    _log_stderr(argv[0], stderr, status)
+    os.unlink(src)
+
+class CompressionQueue(object):
+    """
+    Compress finished files in the background with a bounded pool of
+    worker threads.
+
+    Files are handed to the queue via submit() once they have been
+    written out uncompressed.  Producers should call wait_for_space()
+    before writing a new file; this blocks while the uncompressed data
+    still waiting on the pool exceeds the watermark, so deferred
+    compression never needs more than roughly ``watermark`` bytes of
+    spool space beyond the compressed result.
+    """
+    def __init__(self, workers=2, watermark=None):
+        """
+        Initialize a CompressionQueue.
+
+        Arguments:
+
+        workers   -- Number of compression commands to run concurrently
+        watermark -- Maximum bytes of uncompressed data allowed to be
+                     pending.  Default: half of the free space on the
+                     filesystem of the first file submitted
+        """
+        self.workers = max(int(workers), 1)
+        self.watermark = watermark
+        self.pending_bytes = 0
+        self.errors = []
+        self._jobs = []
+        self._threads = []
+        self._active = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _check_watermark(self, path):
+        if self.watermark is None:
+            info = os.statvfs(os.path.dirname(os.path.abspath(path)))
+            self.watermark = (info.f_frsize*info.f_bavail) // 2
+            LOG.debug("Deferred compression watermark set to %d bytes",
+                      self.watermark)
+
+    def wait_for_space(self, path):
+        """
+        Block until pending uncompressed data drops below the watermark.
+
+        Raises an IOError if a previously submitted file failed to
+        compress, so a producer stops writing as early as possible.
+
+        Arguments:
+
+        path -- Path of the file about to be written
+        """
+        self._cond.acquire()
+        try:
+            self._check_watermark(path)
+            while (self.pending_bytes and
+                   self.pending_bytes >= self.watermark and
+                   not self.errors):
+                LOG.info("Waiting for deferred compression of %d bytes "
+                         "before writing %s", self.pending_bytes, path)
+                self._cond.wait()
+            if self.errors:
+                raise self.errors[0]
+        finally:
+            self._cond.release()
+
+    def submit(self, src, dst, argv, level=None, size_hint=None,
+               durability=None):
+        """
+        Queue ``src`` to be compressed to ``dst`` by the worker pool.
+
+        Arguments:
+
+        src     -- Path to the uncompressed file
+        dst     -- Path to write the compressed output to
+        argv    -- Compression command (see lookup_compression)
+        level   -- Compression level
+        size_hint -- Expected size of the compressed output
+        durability -- How to sync ``dst`` once it is written
+        """
+        size = os.stat(src).st_size
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise IOError("Compression queue is closed")
+            self._check_watermark(src)
+            self._jobs.append((src, dst, argv, level,
+                               size_hint, durability, size))
+            self.pending_bytes += size
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._jobs and not self._closed:
+                    self._cond.wait()
+                if not self._jobs:
+                    return
+                job = self._jobs.pop(0)
+                src, dst, argv, level, size_hint, durability, size = job
+                self._active += 1
+            finally:
+                self._cond.release()
+
+            error = None
+            try:
+                compress_file(src, dst, argv, level, size_hint, durability)
+                LOG.info("Compressed %s", dst)
+            except (IOError, OSError), exc:
+                LOG.error("Deferred compression of %s failed: %s", src, exc)
+                error = exc
+
+            self._cond.acquire()
+            try:
+                self._active -= 1
+                self.pending_bytes -= size
+                if error is not None:
+                    self.errors.append(error)
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def join(self):
+        """
+        Wait for all queued files to be compressed and stop the workers.
+
+        Raises the first error encountered by any worker as an IOError
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+        if self.errors:
+            raise IOError(errno.EPIPE,
+                          "%d deferred compression job(s) failed. "
+                          "First error: %s" % (len(self.errors),
+                                               self.errors[0]))
+
 class CompressionOutput(object):
     """
     Class to create a compressed file descriptor for writing.  Functions like
     a standard file descriptor such as from open().
     """
-    def __init__(self, path, mode, argv, level, inline):
+    def __init__(self, path, mode, argv, level, inline, queue=None,
+                 size_hint=None, durability=None):
         self.argv = argv
         self.level = level
         self.inline = inline
+        self.queue = queue
+        self.size_hint = size_hint
+        self.durability = durability
         if not inline:
+            if queue is not None:
+                queue.wait_for_space(path)
             self.fileobj = open(os.path.splitext(path)[0], mode)
             self.fd = self.fileobj.fileno()
         else:
-            self.fileobj = open(path, 'w')
-            if level:
-                if "gpg" in argv[0]:
-                    argv += ['-z%d' % level]
-                else:
-                    argv += ['-%d' % level]
+            self.fileobj = OutputFile(path, 'w', size_hint, durability)
+            argv = _compression_args(argv, level)
             LOG.debug("* Executing: %s", subprocess.list2cmdline(argv))
             self.stderr = TemporaryFile()
             self.pid = subprocess.Popen(argv,
@@ -115,44 +341,246 @@ class CompressionOutput(object):
     def close(self):
         self.closed = True
         if not self.inline:
-            argv = list(self.argv)
-            if self.level:
-                if "gpg" in argv[0]:
-                    argv += ['-z%d' % self.level, '-']
-                else:
-                    argv += ['-%d' % self.level, '-']
             self.fileobj.close()
-            self.fileobj = open(self.fileobj.name, 'r')
-            cmp_f = open(self.name, 'w')
-            LOG.debug("Running %r < %r[%d] > %r[%d]",
-                         argv, self.fileobj.name, self.fileobj.fileno(),
-                         cmp_f.name, cmp_f.fileno())
-            pid = subprocess.Popen(args,
-                                   stdin=self.fileobj.fileno(),
-                                   stdout=cmp_f.fileno())
-            status = pid.wait()
-            os.unlink(self.fileobj.name)
+            if self.queue is not None:
+                self.queue.submit(self.fileobj.name, self.name,
+                                  self.argv, self.level, self.size_hint,
+                                  self.durability)
+            else:
+                compress_file(self.fileobj.name, self.name,
+                              self.argv, self.level, self.size_hint,
+                              self.durability)
         else:
             self.pid.stdin.close()
             status = self.pid.wait()
-            stderr = self.stderr
-            stderr.flush()
-            stderr.seek(0)
+            self.fileobj.close()
+            _log_stderr(self.argv[0], self.stderr, status)
+
+
+def _file_digest(path):
+    """Return the size and sha1 hexdigest of the file at path"""
+    digest = sha1()
+    size = 0
+    fileobj = open(path, 'rb')
+    try:
+        while True:
+            data = fileobj.read(1024*1024)
+            if not data:
+                break
+            digest.update(data)
+            size += len(data)
+    finally:
+        fileobj.close()
+    return size, digest.hexdigest()
+
+class _Volume(object):
+    """A single volume of a SplitOutput"""
+    def __init__(self, path, argv, level, size_hint, durability):
+        self.path = path
+        self.written = 0
+        self.fileobj = OutputFile(path, 'w', size_hint, durability)
+        self.pid = None
+        if argv:
+            argv = _compression_args(argv, level)
+            self.command = argv[0]
+            LOG.debug("* Executing: %s > %s",
+                      subprocess.list2cmdline(argv), path)
+            self.stderr = TemporaryFile()
             try:
-                if status != 0:
-                    for line in stderr:
-                        if not line.strip(): continue
-                        LOG.error("%s: %s", self.argv[0], line.rstrip())
-                    raise IOError(errno.EPIPE,
-                              "Compression program '%s' exited with status %d" %
-                                (self.argv[0], status))
-                else:
-                    for line in stderr:
-                        if not line.strip(): continue
-                        LOG.info("%s: %s", self.argv[0], line.rstrip())
-            finally:
-                stderr.close()
+                self.pid = subprocess.Popen(argv,
+                                            stdin=subprocess.PIPE,
+                                            stdout=self.fileobj.fileno(),
+                                            stderr=self.stderr,
+                                            close_fds=True)
+            except OSError:
+                self.fileobj.close()
+                raise
+
+    def write(self, data):
+        if self.pid:
+            self.pid.stdin.write(data)
+        else:
+            self.fileobj.write(data)
+        self.written += len(data)
+
+    def size(self):
+        """Number of bytes written to the volume file so far"""
+        if self.pid:
+            return os.fstat(self.fileobj.fileno()).st_size
+        return self.written
+
+    def close(self):
+        """Finish this volume and return (size, sha1 hexdigest)"""
+        try:
+            if self.pid:
+                self.pid.stdin.close()
+                status = self.pid.wait()
+                _log_stderr(self.command, self.stderr, status)
+        finally:
+            self.fileobj.close()
+        return _file_digest(self.path)
 
+class SplitOutput(object):
+    """
+    Write a stream as a series of volumes named <path>.000, <path>.001, ...
+    each roughly ``split_size`` bytes.
+
+    If a compression command is given it is restarted for each volume, so
+    every volume is a complete compressed stream (e.g. a gzip member) that
+    can be decompressed on its own, while the volumes concatenated in order
+    still form a single valid compressed stream.
+
+    When the stream is closed an index is written to <path>.index listing
+    each volume with its offset into the concatenated stream, its size and
+    its sha1 checksum.
+
+    Data may be written with write() or by handing fileno() to a child
+    process.  A background thread reads it from a pipe and rolls over to a
+    new volume once the current one reaches ``split_size``.  Compressed
+    output lags behind its input, so once a volume has been completed the
+    compression ratio seen so far is used to predict when to roll over.
+    """
+    def __init__(self, path, split_size, argv=None, level=None,
+                 size_hint=None, durability=None):
+        if split_size <= 0:
+            raise IOError("Invalid split size %r" % split_size)
+        self.name = path
+        self.split_size = split_size
+        self.argv = argv
+        self.level = level
+        self.size_hint = size_hint
+        self.durability = durability
+        self.volumes = []
+        self.error = None
+        self.closed = False
+        self._raw_bytes = 0
+        self._rfd, self.fd = os.pipe()
+        for fd in (self._rfd, self.fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def _open_volume(self):
+        path = '%s.%03d' % (self.name, len(self.volumes))
+        size_hint = None
+        if self.size_hint:
+            written = sum([volume[2] for volume in self.volumes])
+            size_hint = min(self.split_size,
+                            max(self.size_hint - written, 0)) or None
+        LOG.debug("Starting volume %s", path)
+        return _Volume(path, self.argv, self.level,
+                       size_hint, self.durability)
+
+    def _volume_full(self, volume):
+        if volume.size() >= self.split_size:
+            return True
+        if self.argv and self._raw_bytes:
+            ratio = float(sum([entry[2] for entry in self.volumes])) / \
+                    self._raw_bytes
+            return volume.written*ratio >= self.split_size
+        return False
+
+    def _close_volume(self, volume):
+        size, digest = volume.close()
+        self._raw_bytes += volume.written
+        offset = sum([entry[2] for entry in self.volumes])
+        self.volumes.append((os.path.basename(volume.path),
+                             offset, size, digest))
+        LOG.info("Wrote volume %s (%d bytes)", volume.path, size)
+
+    def _run(self):
+        volume = None
+        try:
+            try:
+                while True:
+                    data = os.read(self._rfd, 65536)
+                    if not data:
+                        break
+                    while data:
+                        if volume is None:
+                            volume = self._open_volume()
+                        if self.argv:
+                            chunk, data = data, ''
+                        else:
+                            remaining = self.split_size - volume.written
+                            chunk, data = data[:remaining], data[remaining:]
+                        volume.write(chunk)
+                        if self._volume_full(volume):
+                            current, volume = volume, None
+                            self._close_volume(current)
+                if volume is None and not self.volumes:
+                    volume = self._open_volume()
+                if volume is not None:
+                    current, volume = volume, None
+                    self._close_volume(current)
+            except (IOError, OSError), exc:
+                LOG.error("Failed writing split volumes for %s: %s",
+                          self.name, exc)
+                self.error = exc
+                if volume is not None:
+                    try:
+                        volume.close()
+                    except (IOError, OSError):
+                        pass
+        finally:
+            os.close(self._rfd)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        os.close(self.fd)
+        self._thread.join()
+        if self.error is not None:
+            raise IOError(errno.EPIPE, "Failed to write %s: %s" %
+                                       (self.name, self.error))
+        index = OutputFile(self.name + '.index', 'w',
+                           durability=self.durability)
+        try:
+            print >>index, "# volume offset size sha1"
+            for volume in self.volumes:
+                print >>index, "%s %d %d %s" % volume
+        finally:
+            index.close()
+
+def read_split_index(path):
+    """
+    Read the index written for a split stream
+
+    :param path: path of the split stream, without the volume suffix
+    :returns: list of (volume path, offset, size, sha1) tuples
+    """
+    result = []
+    dirname = os.path.dirname(path)
+    for line in open(path + '.index', 'r'):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name, offset, size, digest = line.split()
+        result.append((os.path.join(dirname, name),
+                       int(offset), int(size), digest))
+    return result
+
+def verify_split_volume(path, size, digest):
+    """
+    Check a single volume of a split stream against its index entry
+
+    :raises: IOError if the volume is truncated or its checksum differs
+    """
+    nbytes, checksum = _file_digest(path)
+    if nbytes != size:
+        raise IOError("%s: expected %d bytes, found %d" %
+                      (path, size, nbytes))
+    if checksum != digest:
+        raise IOError("%s: sha1 mismatch" % path)
 
 def stream_info(path, method=None, level=None):
     """
@@ -190,7 +618,12 @@ def open_stream(path,
                 method=None,
                 level=None,
                 inline=True,
-                extra_args=None):
+                extra_args=None,
+                queue=None,
+                size_hint=None,
+                durability=None,
+                split_size=None,
+                chunk_store=None):
     """
     Opens a compressed data stream, and returns a file descriptor type object
     that acts much like os.open() does.  If no method is passed, or the 
@@ -202,8 +635,36 @@ def open_stream(path,
     method  -- Compression method (i.e. 'gzip', 'bzip2', 'pbzip2', 'lzop')
     level   -- Compression level
     inline  -- Boolean whether to compress inline, or after the file is written.
+    queue   -- CompressionQueue to hand files to when inline is False.  If
+               not set, the file is compressed synchronously on close()
+    size_hint -- Expected number of bytes written to ``path``.  If set,
+                 space is reserved up front for new files and an
+                 IOError(ENOSPC) is raised immediately if it is not
+                 available.
+    durability -- 'none', 'batch' or 'strict'.  With 'batch' writeback of
+                  the file is started when it is closed; with 'strict'
+                  the file is fsynced when it is closed.
+    split_size -- If set, write the stream as a series of volumes of about
+                  this many bytes with an index (see SplitOutput).  Output
+                  is always compressed inline when splitting.
+    chunk_store -- If set, deduplicate the stream into this chunk store
+                   (see holland.core.dedup.ChunkStore) and write a chunk
+                   recipe in place of ``path``.  Chunks are compressed by
+                   the store so method and split_size are ignored.
     """
+    if mode == 'w' and chunk_store is not None:
+        return chunk_store.open_output(path, durability=durability)
+    if mode == 'w' and split_size:
+        argv = None
+        if method and method != 'none' and level != 0:
+            argv, path = stream_info(path, method)
+            if extra_args:
+                argv += _parse_args(extra_args)
+        return SplitOutput(path, split_size, argv, level,
+                           size_hint=size_hint, durability=durability)
     if not method or method == 'none' or level == 0:
+        if mode == 'w' and (size_hint or durability):
+            return OutputFile(path, mode, size_hint, durability)
         return open(path, mode)
     else:
         argv, path = stream_info(path, method)
@@ -213,6 +674,8 @@ def open_stream(path,
             return CompressionInput(path, mode, argv=argv)
         elif mode == 'w':
             return CompressionOutput(path, mode, argv=argv, level=level,
-                                     inline=inline)
+                                     inline=inline, queue=queue,
+                                     size_hint=size_hint,
+                                     durability=durability)
         else:
             raise IOError("invalid mode: %s" % mode)
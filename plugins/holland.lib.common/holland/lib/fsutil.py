@@ -0,0 +1,324 @@
+"""
+Low level filesystem helpers for backup output files
+"""
+
+import os
+import errno
+import shutil
+import logging
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+LOG = logging.getLogger(__name__)
+
+# from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+
+# from linux/fs.h
+SYNC_FILE_RANGE_WRITE = 0x02
+
+#: valid durability levels for output files
+#: none   - leave writeback entirely to the kernel
+#: batch  - start writeback of each file as it is closed
+#: strict - fsync each file as it is closed
+DURABILITY_LEVELS = ('none', 'batch', 'strict')
+
+_libc_cache = {}
+
+def _libc_function(names, argtypes, restype=None):
+    """Lookup the first available function in ``names`` from libc
+
+    Returns None if ctypes or all of the functions are unavailable
+    """
+    key = names[0]
+    if key in _libc_cache:
+        return _libc_cache[key]
+    _libc_cache[key] = None
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+    for name in names:
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = restype or ctypes.c_int
+            _libc_cache[key] = func
+            break
+    return _libc_cache[key]
+
+def _load_fallocate():
+    """Lookup fallocate(2) from libc or return None if it is unavailable"""
+    if ctypes is None:
+        return None
+    return _libc_function(('fallocate64', 'fallocate'),
+                          [ctypes.c_int, ctypes.c_int,
+                           ctypes.c_int64, ctypes.c_int64])
+
+def _load_sync_file_range():
+    """Lookup sync_file_range(2) from libc or return None if it is
+    unavailable"""
+    if ctypes is None:
+        return None
+    return _libc_function(('sync_file_range',),
+                          [ctypes.c_int, ctypes.c_int64,
+                           ctypes.c_int64, ctypes.c_uint])
+
+def _load_copy_file_range():
+    """Lookup copy_file_range(2) from libc or return None if it is
+    unavailable"""
+    if ctypes is None:
+        return None
+    return _libc_function(('copy_file_range',),
+                          [ctypes.c_int, ctypes.c_void_p,
+                           ctypes.c_int, ctypes.c_void_p,
+                           ctypes.c_size_t, ctypes.c_uint],
+                          ctypes.c_ssize_t)
+
+def _load_sendfile():
+    """Lookup sendfile(2) from libc or return None if it is unavailable"""
+    if ctypes is None:
+        return None
+    return _libc_function(('sendfile64', 'sendfile'),
+                          [ctypes.c_int, ctypes.c_int,
+                           ctypes.c_void_p, ctypes.c_size_t],
+                          ctypes.c_ssize_t)
+
+def preallocate(fd, size):
+    """
+    Reserve ``size`` bytes of disk space for the file open on ``fd``
+
+    Space is allocated with fallocate(FALLOC_FL_KEEP_SIZE), rounded up to
+    the filesystem block size, so the apparent file size is unchanged and
+    the filesystem can lay out the file in as few extents as possible.
+    Blocks past the end of the file once writing has finished should be
+    released with trim_preallocation().
+
+    Arguments:
+
+    fd      -- file descriptor open for writing
+    size    -- number of bytes expected to be written
+
+    Returns True if space was reserved and False if preallocation is not
+    supported here.  Raises IOError(ENOSPC) if the filesystem does not
+    have ``size`` bytes available.
+    """
+    size = int(size or 0)
+    if size <= 0:
+        return False
+    fallocate = _load_fallocate()
+    if fallocate is None:
+        LOG.debug("fallocate() not available. Not preallocating space.")
+        return False
+    try:
+        block_size = os.fstatvfs(fd).f_bsize or 4096
+    except OSError:
+        block_size = 4096
+    size = ((size + block_size - 1) // block_size) * block_size
+    if fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EDQUOT, errno.EFBIG):
+        raise IOError(err, "Unable to reserve %d bytes: %s" %
+                           (size, os.strerror(err)))
+    LOG.debug("fallocate(%d) failed: %s. Not preallocating space.",
+              size, os.strerror(err))
+    return False
+
+def trim_preallocation(fd):
+    """
+    Release any preallocated blocks past the end of the file open on ``fd``
+    """
+    try:
+        os.ftruncate(fd, os.fstat(fd).st_size)
+    except OSError, exc:
+        LOG.debug("Failed to trim preallocated space: %s", exc)
+
+def start_writeback(fd):
+    """
+    Ask the kernel to start writing out dirty pages for the file open on
+    ``fd`` without waiting for the writes to complete.
+
+    This is a no-op where sync_file_range() is not available.
+    """
+    sync_file_range = _load_sync_file_range()
+    if sync_file_range is None:
+        return
+    if sync_file_range(fd, 0, 0, SYNC_FILE_RANGE_WRITE) != 0:
+        LOG.debug("sync_file_range() failed: %s",
+                  os.strerror(ctypes.get_errno()))
+
+def sync_file(fd, durability):
+    """
+    Apply the requested durability level to the file open on ``fd``
+
+    Arguments:
+
+    fd          -- file descriptor to sync
+    durability  -- one of DURABILITY_LEVELS.  None is the same as 'none'
+    """
+    if durability == 'strict':
+        os.fsync(fd)
+    elif durability == 'batch':
+        start_writeback(fd)
+    elif durability not in (None, 'none'):
+        raise ValueError("Invalid durability level %r" % durability)
+
+class OutputFile(file):
+    """
+    A file opened for writing that optionally has space reserved up front
+    via preallocate() and is synced per ``durability`` on close.
+
+    Unused preallocated space is released when the file is closed.
+    """
+    def __init__(self, path, mode, size_hint=None, durability=None):
+        file.__init__(self, path, mode)
+        self.durability = durability
+        self.preallocated = False
+        try:
+            self.preallocated = preallocate(self.fileno(), size_hint)
+        except IOError:
+            file.close(self)
+            raise
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            if self.preallocated:
+                trim_preallocation(self.fileno())
+            sync_file(self.fileno(), self.durability)
+        file.close(self)
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+#: errors that mean a copy method is unsupported for a pair of files
+#: rather than that the copy failed
+_UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                       errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                       errno.EPERM)
+
+#: order copy_file() tries each method in
+COPY_METHODS = ('reflink', 'copy-file-range', 'sendfile', 'read-write')
+
+def _clone_fd(src_fd, dst_fd):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError, exc:
+        LOG.debug("FICLONE failed: %s", exc)
+        return False
+    return True
+
+def _copy_syscall(func, name, src_fd, dst_fd, size):
+    """Copy from the current offset of src_fd until EOF using one of the
+    copy_file_range or sendfile system calls
+
+    Returns the number of bytes copied.  Stops early if the call is not
+    supported for these files.
+    """
+    if func is None:
+        return 0
+    copied = 0
+    while True:
+        # copy in chunks of at most 1GB to stay within ssize_t everywhere
+        count = min(max(size - copied, 0), 1 << 30) or (1 << 20)
+        if name == 'sendfile':
+            result = func(dst_fd, src_fd, None, count)
+        else:
+            result = func(src_fd, None, dst_fd, None, count, 0)
+        if result < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in _UNSUPPORTED_ERRNOS:
+                LOG.debug("%s() not usable: %s", name, os.strerror(err))
+                return copied
+            raise IOError(err, "%s() failed: %s" % (name, os.strerror(err)))
+        if result == 0:
+            return copied
+        copied += result
+
+def _copy_read_write(src_fd, dst_fd):
+    copied = 0
+    while True:
+        data = os.read(src_fd, 1024*1024)
+        if not data:
+            return copied
+        while data:
+            written = os.write(dst_fd, data)
+            copied += written
+            data = data[written:]
+
+def copy_file(src, dst):
+    """
+    Copy ``src`` to ``dst`` like shutil.copy2, avoiding copying data
+    through userspace where possible
+
+    Methods are tried in the order of COPY_METHODS: a FICLONE reflink,
+    copy_file_range(2), sendfile(2) and finally a plain read/write loop.
+    Each method continues from wherever the previous one stopped.
+
+    :returns: dict mapping each method used to the number of bytes it
+              copied
+    """
+    stats = {}
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+        try:
+            if size and _clone_fd(src_fd, dst_fd):
+                stats['reflink'] = size
+            else:
+                copied = 0
+                for name, func in (('copy-file-range',
+                                    _load_copy_file_range()),
+                                   ('sendfile', _load_sendfile())):
+                    if copied >= size:
+                        break
+                    nbytes = _copy_syscall(func, name, src_fd, dst_fd,
+                                           size - copied)
+                    if nbytes:
+                        stats[name] = nbytes
+                        copied += nbytes
+                # the file may have grown, always finish with read/write
+                nbytes = _copy_read_write(src_fd, dst_fd)
+                if nbytes or not stats:
+                    stats['read-write'] = nbytes
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+    return stats
+
+def clone_file(src, dst):
+    """
+    Create ``dst`` as a reflink (copy-on-write clone) of ``src``
+
+    Returns True if the clone was created and False if the filesystem or
+    platform does not support reflinks, in which case ``dst`` is left
+    untouched.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0600)
+        try:
+            cloned = _clone_fd(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+        if not cloned:
+            os.unlink(dst)
+    finally:
+        os.close(src_fd)
+    return cloned
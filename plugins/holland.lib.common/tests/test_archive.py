@@ -58,3 +58,121 @@ def test_zip_archive():
 
     for name in axv.list():
         ok_(name in name_list)
+
+@with_setup(setup_func, teardown_func)
+def test_dir_archive_reference():
+    global tmpdir
+    from holland.lib.archive.dir_archive import read_manifest
+    src = os.path.join(tmpdir, 'src')
+    os.mkdir(src)
+    for name in ('a.MYD', 'b.MYD', 'c.MYD'):
+        open(os.path.join(src, name), 'w').write(name * 1024)
+        # whole seconds, so utime() can restore the mtime exactly
+        os.utime(os.path.join(src, name), (1388534400, 1388534400))
+
+    first = DirArchive(os.path.join(tmpdir, 'first'))
+    for name in os.listdir(src):
+        first.add_file(os.path.join(src, name), 'db/' + name)
+    first.close()
+    assert_equal(first.stats['copied-files'], 3)
+    manifest = read_manifest(first.path)
+    assert_equal(manifest['db/a.MYD'][0], 'db/a.MYD.gz')
+    ok_('.manifest' not in first.list())
+
+    # change c.MYD; a.MYD and b.MYD should be linked
+    fileobj = open(os.path.join(src, 'c.MYD'), 'w')
+    fileobj.write('changed')
+    fileobj.close()
+    second = DirArchive(os.path.join(tmpdir, 'second'), reference=first.path)
+    for name in os.listdir(src):
+        second.add_file(os.path.join(src, name), 'db/' + name)
+    second.close()
+    assert_equal(second.stats['linked-files'], 2)
+    assert_equal(second.stats['copied-files'], 1)
+    assert_equal(os.stat(os.path.join(first.path, 'db/a.MYD.gz')).st_ino,
+                 os.stat(os.path.join(second.path, 'db/a.MYD.gz')).st_ino)
+    ok_(os.path.exists(os.path.join(second.path, 'db/c.MYD.gz')))
+    assert_equal(sorted(read_manifest(second.path).keys()),
+                 ['db/a.MYD', 'db/b.MYD', 'db/c.MYD'])
+
+    # b.MYD changes without a new size or mtime.  It is linked, and
+    # close() fails once it finds the checksum differs.
+    from holland.lib.archive.dir_archive import VerifyError
+    path = os.path.join(src, 'b.MYD')
+    info = os.stat(path)
+    open(path, 'w').write('x' * info.st_size)
+    os.utime(path, (info.st_atime, info.st_mtime))
+    third = DirArchive(os.path.join(tmpdir, 'third'), reference=second.path)
+    for name in os.listdir(src):
+        third.add_file(os.path.join(src, name), 'db/' + name)
+    assert_equal(third.stats['linked-files'], 3)
+    assert_raises(VerifyError, third.close)
+    assert_equal(third.stats['verify-failed-files'], 1)
+    assert_equal(third.stats['copied-files'], 0)
+
+@with_setup(setup_func, teardown_func)
+def test_copy_file():
+    global tmpdir
+    from holland.lib.fsutil import copy_file
+    src = os.path.join(tmpdir, 'src')
+    data = os.urandom(3*1024*1024 + 17)
+    for name, contents in (('dst', data), ('empty', '')):
+        open(src, 'wb').write(contents)
+        os.utime(src, (1388534400, 1388534400))
+        dst = os.path.join(tmpdir, name)
+        stats = copy_file(src, dst)
+        ok_(stats)
+        assert_equal(sum(stats.values()), len(contents))
+        assert_equal(open(dst, 'rb').read(), contents)
+        assert_equal(os.stat(dst).st_mtime, 1388534400)
+
+@with_setup(setup_func, teardown_func)
+def test_dir_archive_threads():
+    global tmpdir
+    import threading
+    axv = DirArchive(os.path.join(tmpdir, 'dir'))
+    src = os.path.join(tmpdir, 'src')
+    open(src, 'w').write('x' * 4096)
+    def add(idx):
+        for num in xrange(20):
+            axv.add_file(src, 'db%d/%d' % (num % 3, idx*20 + num))
+    threads = [threading.Thread(target=add, args=(idx,)) for idx in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(axv.stats['copied-files'], 80)
+    assert_equal(axv.stats['copied-bytes'], 80*4096)
+    assert_equal(len(axv.manifest), 80)
+
+@with_setup(setup_func, teardown_func)
+def test_parallel_archives():
+    global tmpdir
+    import tarfile
+    import zipfile
+    import subprocess
+    src = os.path.join(tmpdir, 'src')
+    data = ''.join(['%d %r\n' % (num, os.urandom(8))
+                    for num in xrange(100000)])
+    open(src, 'wb').write(data)
+
+    axv = TarArchive(os.path.join(tmpdir, 'parallel.tgz'), workers=4)
+    axv.add_file(src, 'db/table.MYD')
+    axv.add_string('partial', 'db/table.MYI')
+    axv.close()
+    assert_equal(subprocess.call(['gzip', '-t', axv.path]), 0)
+    archive = tarfile.open(axv.path, 'r:gz')
+    assert_equal(archive.extractfile('db/table.MYD').read(), data)
+    assert_equal(archive.extractfile('db/table.MYI').read(), 'partial')
+    archive.close()
+
+    axv = ZipArchive(os.path.join(tmpdir, 'parallel.zip'), workers=4)
+    axv.add_file(src, 'db/table.MYD')
+    axv.add_string('partial', 'db/table.MYI')
+    axv.close()
+    archive = zipfile.ZipFile(axv.path)
+    assert_equal(archive.testzip(), None)
+    assert_equal(archive.read('db/table.MYD'), data)
+    info = archive.getinfo('db/table.MYD')
+    ok_(info.compress_size < info.file_size)
+    archive.close()
@@ -103,5 +103,136 @@ def test_compression_bad_mode():
     f = compression.open_stream(os.path.join(tmpdir, 'foo'), 'bad', 'gzip')
     f.write('foo')
     f.close()
-    
-    
\ No newline at end of file
+
+@with_setup(setup_func, teardown_func)
+def test_compression_queue():
+    global tmpdir
+
+    queue = compression.CompressionQueue(workers=2, watermark=1)
+    for name in ('foo', 'bar', 'baz'):
+        path = os.path.join(tmpdir, name + '.gz')
+        f = compression.open_stream(path, 'w', 'gzip', inline=False,
+                                    queue=queue)
+        f.write(name)
+        f.close()
+    queue.join()
+
+    assert_equal(queue.pending_bytes, 0)
+    for name in ('foo', 'bar', 'baz'):
+        ok_(not os.path.exists(os.path.join(tmpdir, name)))
+        f = compression.open_stream(os.path.join(tmpdir, name + '.gz'), 'r',
+                                    'gzip')
+        data = f.read(3)
+        f.close()
+        assert_equal(data, name)
+
+@raises(IOError)
+@with_setup(setup_func, teardown_func)
+def test_compression_queue_error():
+    global tmpdir
+
+    queue = compression.CompressionQueue(workers=1)
+    path = os.path.join(tmpdir, 'foo')
+    f = open(path, 'w')
+    f.write('foo')
+    f.close()
+    queue.submit(path, os.path.join(tmpdir, 'missing', 'foo.gz'), ['gzip'])
+    queue.join()
+
+@with_setup(setup_func, teardown_func)
+def test_compression_size_hint():
+    global tmpdir
+
+    path = os.path.join(tmpdir, 'foo')
+    f = compression.open_stream(path, 'w', 'none', size_hint=32*1024*1024)
+    if f.preallocated:
+        ok_(os.fstat(f.fileno()).st_blocks*512 >= 32*1024*1024)
+    f.write('foo')
+    f.close()
+    assert_equal(os.stat(path).st_size, 3)
+    ok_(os.stat(path).st_blocks*512 < 1024*1024)
+
+    f = compression.open_stream(path + '.gz', 'w', 'gzip', size_hint=1024*1024)
+    f.write('foo')
+    f.close()
+    f = compression.open_stream(path + '.gz', 'r', 'gzip')
+    assert_equal(f.read(3), 'foo')
+    f.close()
+
+@with_setup(setup_func, teardown_func)
+def test_compression_durability():
+    global tmpdir
+
+    for durability in ('none', 'batch', 'strict'):
+        path = os.path.join(tmpdir, 'foo_' + durability + '.gz')
+        f = compression.open_stream(path, 'w', 'gzip', durability=durability)
+        f.write('foo')
+        f.close()
+        f = compression.open_stream(path, 'r', 'gzip')
+        assert_equal(f.read(3), 'foo')
+        f.close()
+
+        path = os.path.join(tmpdir, 'foo_' + durability)
+        f = compression.open_stream(path, 'w', 'none', durability=durability)
+        f.write('foo')
+        f.close()
+        assert_equal(open(path).read(), 'foo')
+
+@with_setup(setup_func, teardown_func)
+def test_compression_split():
+    global tmpdir
+    import subprocess
+
+    data = os.urandom(2*1024*1024)
+
+    # raw volumes are split exactly
+    path = os.path.join(tmpdir, 'raw')
+    f = compression.open_stream(path, 'w', 'none', split_size=768*1024)
+    f.write(data)
+    f.close()
+    volumes = compression.read_split_index(path)
+    assert_equal([v[0] for v in volumes],
+                 [path + '.000', path + '.001', path + '.002'])
+    assert_equal([v[1] for v in volumes], [0, 768*1024, 1536*1024])
+    for name, offset, size, digest in volumes:
+        compression.verify_split_volume(name, size, digest)
+    assert_equal(''.join([open(v[0]).read() for v in volumes]), data)
+
+    # compressed volumes are each a complete gzip member
+    path = os.path.join(tmpdir, 'foo')
+    f = compression.open_stream(path, 'w', 'gzip', level=1,
+                                split_size=256*1024)
+    proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=f)
+    proc.communicate(data)
+    f.close()
+    volumes = compression.read_split_index(path + '.gz')
+    ok_(len(volumes) > 1)
+    result = ''
+    for name, offset, size, digest in volumes:
+        compression.verify_split_volume(name, size, digest)
+        proc = subprocess.Popen(['gzip', '-dc', name], stdout=subprocess.PIPE)
+        result += proc.communicate()[0]
+        assert_equal(proc.returncode, 0)
+    assert_equal(result, data)
+
+@with_setup(setup_func, teardown_func)
+def test_compression_chunk_store():
+    import subprocess
+    from StringIO import StringIO
+    from holland.core.dedup import ChunkStore, reassemble
+    global tmpdir
+
+    store = ChunkStore(os.path.join(tmpdir, '.chunks'))
+    data = 'foo bar baz\n' * 200000
+    path = os.path.join(tmpdir, 'foo.sql')
+    f = compression.open_stream(path, 'w', 'gzip', level=1,
+                                chunk_store=store)
+    proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=f)
+    proc.communicate(data)
+    f.close()
+    ok_(not os.path.exists(path))
+    ok_(not os.path.exists(path + '.gz'))
+    result = StringIO()
+    reassemble(path + '.recipe', result)
+    assert_equal(result.getvalue(), data)
+    assert_equal(store.stats["logical-bytes"], len(data))
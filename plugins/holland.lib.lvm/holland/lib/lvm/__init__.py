@@ -4,7 +4,8 @@ from holland.lib.lvm.errors import LVMCommandError
 from holland.lib.lvm.util import relpath, getmount, getdevice, parse_bytes
 from holland.lib.lvm.raw import pvs, vgs, lvs, blkid, mount, umount
 from holland.lib.lvm.base import PhysicalVolume, VolumeGroup, LogicalVolume
-from holland.lib.lvm.snapshot import Snapshot, CallbackFailuresError
+from holland.lib.lvm.snapshot import Snapshot, SnapshotMonitor, \
+                                     CallbackFailuresError
 
 __all__ = [
     'relpath',
@@ -23,5 +24,6 @@ __all__ = [
     'VolumeGroup',
     'LogicalVolume',
     'Snapshot',
+    'SnapshotMonitor',
     'CallbackFailuresError',
 ]
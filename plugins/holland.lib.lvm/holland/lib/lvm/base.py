@@ -3,9 +3,10 @@
 import os
 import signal
 import logging
-from holland.lib.lvm.raw import pvs, vgs, lvs, lvsnapshot, lvremove, \
+from holland.lib.lvm.raw import lvsnapshot, lvremove, lvextend, \
                                 mount, umount, blkid
-from holland.lib.lvm.util import getdevice, SignalManager
+from holland.lib.lvm.util import getdevice, SignalManager, MountIndex
+from holland.lib.lvm.cache import CACHE
 from holland.lib.lvm.errors import LVMCommandError
 
 LOG = logging.getLogger(__name__)
@@ -68,7 +69,7 @@ class PhysicalVolume(Volume):
 
     def reload(self):
         """Reload this PhysicalVolume"""
-        self.attributes, = pvs(self.pv_name)
+        self.attributes, = CACHE.lookup('pvs', self.pv_name, refresh=True)
 
     def lookup(cls, pathspec):
         """Lookup a physical volume for the pathspec given
@@ -79,7 +80,7 @@ class PhysicalVolume(Volume):
         :returns: PhysicalVolume instance
         """
         try:
-            volume, = pvs(pathspec)
+            volume, = CACHE.lookup('pvs', pathspec)
             return cls(volume)
         except (ValueError, LVMCommandError):
             raise LookupError("No PhysicalVolume could be found for "
@@ -96,7 +97,7 @@ class PhysicalVolume(Volume):
         :returns: iterable of PhysicalVolume instances
         """
 
-        for volume in pvs(pathspec):
+        for volume in CACHE.lookup('pvs', pathspec):
             yield cls(volume)
     search = classmethod(search)
 
@@ -108,7 +109,7 @@ class VolumeGroup(Volume):
 
     def reload(self):
         """Reload this VolumeGroup"""
-        self.attributes, = vgs(self.vg_name)
+        self.attributes, = CACHE.lookup('vgs', self.vg_name, refresh=True)
 
     def lookup(cls, pathspec):
         """Lookup a volume group for ``pathspec``
@@ -119,7 +120,7 @@ class VolumeGroup(Volume):
         :returns: VolumeGroup instance
         """
         try:
-            volume, = vgs(pathspec)
+            volume, = CACHE.lookup('vgs', pathspec)
             return cls(volume)
         except (LVMCommandError, ValueError):
             raise LookupError("No VolumeGroup could be found for pathspec %r" %
@@ -135,7 +136,7 @@ class VolumeGroup(Volume):
         :returns: iterable of VolumeGroup instances
         """
 
-        for volume in vgs(pathspec):
+        for volume in CACHE.lookup('vgs', pathspec):
             yield cls(volume)
     search = classmethod(search)
 
@@ -154,7 +155,7 @@ class LogicalVolume(Volume):
         :returns: LogicalVolume instance
         """
         try:
-            volume, = lvs(pathspec)
+            volume, = CACHE.lookup('lvs', pathspec)
             return cls(volume)
         except (LVMCommandError, ValueError):
             #XX: Perhaps we should be more specific :)
@@ -181,13 +182,14 @@ class LogicalVolume(Volume):
         :returns: iterable of LogicalVolume instances
         """
 
-        for volume in lvs(pathspec):
+        for volume in CACHE.lookup('lvs', pathspec):
             yield cls(volume)
     search = classmethod(search)
 
     def reload(self):
         """Reload the data for this LogicalVolume"""
-        self.attributes, = lvs(self.device_name())
+        self.attributes, = CACHE.lookup('lvs', self.device_name(),
+                                        refresh=True)
 
     def snapshot(self, name, size):
         """Snapshot the current LogicalVolume instance and create a snapshot
@@ -200,18 +202,45 @@ class LogicalVolume(Volume):
         """
 
         try:
-            lvsnapshot(self.device_name(), name, size)
-        except LVMCommandError, exc:
-            for line in exc.error.splitlines():
-                LOG.error("%s", line)
-            raise
+            try:
+                lvsnapshot(self.device_name(), name, size)
+            except LVMCommandError, exc:
+                for line in exc.error.splitlines():
+                    LOG.error("%s", line)
+                raise
+        finally:
+            CACHE.invalidate()
         return LogicalVolume.lookup(self.vg_name + '/' + name)
 
+    def extend(self, extents):
+        """Grow this LogicalVolume by ``extents`` extents
+
+        :param extents: number of extents to add
+        :raises: LVMCommandError on error
+        """
+        try:
+            try:
+                lvextend(self.device_name(), extents)
+            except LVMCommandError, exc:
+                for line in exc.error.splitlines():
+                    LOG.error("%s", line)
+                raise
+        finally:
+            CACHE.invalidate()
+        self.reload()
+
     def is_mounted(self):
         """Check if this logical volume is mounted
 
         :returns: True if mounted and false otherwise
         """
+        try:
+            return len(MountIndex.load().mounts(self.device_name())) > 0
+        except IOError:
+            pass
+        except OSError:
+            # device node is missing
+            return False
         real_device_path = os.path.realpath(self.device_name())
         for line in open('/proc/mounts', 'r'):
             dev = line.split()[0]
@@ -251,11 +280,14 @@ class LogicalVolume(Volume):
         :raises: LVMCommandError on error
         """
         try:
-            lvremove(self.device_name())
-        except LVMCommandError, exc:
-            for line in exc.error.splitlines():
-                LOG.error("%s", line)
-            raise
+            try:
+                lvremove(self.device_name())
+            except LVMCommandError, exc:
+                for line in exc.error.splitlines():
+                    LOG.error("%s", line)
+                raise
+        finally:
+            CACHE.invalidate()
 
     def exists(self):
         """Check whether the volume currently exists
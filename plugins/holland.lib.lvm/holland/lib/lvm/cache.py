@@ -0,0 +1,133 @@
+"""Short-lived cache of LVM reports
+
+Looking up volumes one at a time forks an lvs, vgs or pvs process per
+lookup, and each LVM command has to take the LVM metadata lock, which can
+take seconds on a busy system.  A ReportCache instead runs one report
+covering every volume of a kind and answers lookups from it until the
+report expires or is invalidated after a volume is created, extended or
+removed.
+"""
+
+import os
+import time
+import logging
+import threading
+from holland.lib.lvm.raw import pvs, vgs, lvs
+
+LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'ReportCache',
+    'CACHE',
+]
+
+def _match_pv(row, pathspec):
+    """Check whether a pvs row matches pathspec"""
+    if row.get('pv_name') == pathspec:
+        return True
+    return os.path.realpath(pathspec) == os.path.realpath(row['pv_name'])
+
+def _match_vg(row, pathspec):
+    """Check whether a vgs row matches pathspec"""
+    return row.get('vg_name') == pathspec
+
+def _match_lv(row, pathspec):
+    """Check whether an lvs row matches pathspec
+
+    pathspec may be a volume group name, vg/lv, /dev/vg/lv or any device
+    node for the logical volume such as /dev/mapper/vg-lv
+    """
+    vg_name = row.get('vg_name')
+    if pathspec == vg_name:
+        return True
+    lv_path = '%s/%s' % (vg_name, row.get('lv_name'))
+    if pathspec.rstrip('/') in (lv_path, '/dev/' + lv_path):
+        return True
+    if not pathspec.startswith('/'):
+        return False
+    try:
+        rdev = os.stat(pathspec).st_rdev
+    except OSError:
+        return False
+    try:
+        return (int(row['lv_kernel_major']), int(row['lv_kernel_minor'])) == \
+               (os.major(rdev), os.minor(rdev))
+    except (KeyError, ValueError):
+        return False
+
+class ReportCache(object):
+    """Cache of the full pvs, vgs and lvs reports
+
+    :param ttl: seconds a report is used before it is run again
+    """
+    REPORTS = {
+        'pvs' : (pvs, _match_pv),
+        'vgs' : (vgs, _match_vg),
+        'lvs' : (lvs, _match_lv),
+    }
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self._reports = {}
+        self._lock = threading.Lock()
+
+    def report(self, kind):
+        """Return every row of the ``kind`` report, running it if there is
+        no current copy
+
+        :param kind: one of 'pvs', 'vgs' or 'lvs'
+        """
+        self._lock.acquire()
+        try:
+            entry = self._reports.get(kind)
+            if entry and time.time() - entry[0] < self.ttl:
+                return entry[1]
+        finally:
+            self._lock.release()
+        return self.refresh(kind)
+
+    def refresh(self, kind):
+        """Run the ``kind`` report again and return its rows"""
+        command = self.REPORTS[kind][0]
+        rows = command()
+        self._lock.acquire()
+        try:
+            self._reports[kind] = (time.time(), rows)
+        finally:
+            self._lock.release()
+        return rows
+
+    def invalidate(self, kind=None):
+        """Discard the cached ``kind`` report or all reports"""
+        self._lock.acquire()
+        try:
+            if kind is None:
+                self._reports.clear()
+            else:
+                self._reports.pop(kind, None)
+        finally:
+            self._lock.release()
+
+    def lookup(self, kind, pathspec=None, refresh=False):
+        """Return the rows of the ``kind`` report matching pathspec
+
+        If nothing cached matches, the report is run for pathspec alone so
+        pathspecs the cache does not understand behave as before.
+
+        :raises: LVMCommandError if that report fails
+        """
+        if refresh:
+            rows = self.refresh(kind)
+        else:
+            rows = self.report(kind)
+        if pathspec is None:
+            return list(rows)
+        command, match = self.REPORTS[kind]
+        result = [row for row in rows if match(row, pathspec)]
+        if not result:
+            LOG.debug("%s not found in cached %s report", pathspec, kind)
+            result = command(pathspec)
+        return result
+
+#: cache shared by the holland.lib.lvm volume classes
+CACHE = ReportCache()
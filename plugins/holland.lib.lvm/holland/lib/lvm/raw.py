@@ -12,33 +12,76 @@ from holland.lib.lvm.errors import LVMCommandError
 
 LOG = logging.getLogger(__name__)
 
-def pvs(*physical_volumes):
-    """Report information about physical volumes
-
-    :param volume_groups: volume groups to report on
-    :returns: list of dicts of pvs parameters
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+# Whether the installed LVM tools support --reportformat json
+# (lvm2 >= 2.02.158).  None until the first report is run.
+_JSON_REPORTS = None
+
+def _report(command, attributes, report_key, args):
+    """Run one of the lvm reporting commands (pvs, vgs or lvs)
+
+    JSON reports are used where LVM supports them, since the CSV format
+    cannot represent values such as tag lists that contain the separator.
+    Older LVM versions fall back to CSV.
+
+    :returns: list of dicts mapping ``attributes`` to their values
     """
-    pvs_args = [
-        'pvs',
+    global _JSON_REPORTS
+    report_args = [
+        command,
         '--unbuffered',
         '--noheadings',
         '--nosuffix',
         '--units=b',
-        '--separator=,',
-        '--options=%s' % ','.join(PVS_ATTR),
+        '--options=%s' % ','.join(attributes),
     ]
-    pvs_args.extend(list(physical_volumes))
-    process = Popen(pvs_args,
+    if json is not None and _JSON_REPORTS is not False:
+        stdout, stderr, status = _run(report_args + ['--reportformat=json'] +
+                                      list(args))
+        if status == 0:
+            try:
+                rows = parse_lvm_json(attributes, report_key, stdout)
+                _JSON_REPORTS = True
+                return rows
+            except (ValueError, KeyError, IndexError, TypeError), exc:
+                LOG.debug("Unable to parse %s JSON report: %s", command, exc)
+                _JSON_REPORTS = False
+        elif _JSON_REPORTS:
+            raise LVMCommandError(command, status, stderr)
+    stdout, stderr, status = _run(report_args + ['--separator=,'] +
+                                  list(args))
+    if status != 0:
+        raise LVMCommandError(command, status, stderr)
+    if _JSON_REPORTS is None and json is not None:
+        # the CSV report worked where the JSON one did not
+        LOG.debug("%s does not support JSON reports. Using CSV.", command)
+        _JSON_REPORTS = False
+    return list(parse_lvm_format(attributes, stdout))
+
+def _run(args):
+    """Run an lvm command and return its (stdout, stderr, exit status)"""
+    process = Popen(args,
                     stdout=PIPE,
                     stderr=PIPE,
                     preexec_fn=os.setsid,
                     close_fds=True)
     stdout, stderr = process.communicate()
+    return stdout, stderr, process.returncode
 
-    if process.returncode != 0:
-        raise LVMCommandError('pvs', process.returncode, stderr)
+def pvs(*physical_volumes):
+    """Report information about physical volumes
 
-    return parse_lvm_format(PVS_ATTR, stdout)
+    :param volume_groups: volume groups to report on
+    :returns: list of dicts of pvs parameters
+    """
+    return _report('pvs', PVS_ATTR, 'pv', physical_volumes)
 
 def vgs(*volume_groups):
     """Report information about volume groups
@@ -46,27 +89,7 @@ def vgs(*volume_groups):
     :param volume_groups: volume groups to report on
     :returns: list of dicts of vgs parameters
     """
-    vgs_args = [
-        'vgs',
-        '--unbuffered',
-        '--noheadings',
-        '--nosuffix',
-        '--units=b',
-        '--separator=,',
-        '--options=%s' % ','.join(VGS_ATTR),
-    ]
-    vgs_args.extend(list(volume_groups))
-    process = Popen(vgs_args,
-                    stdout=PIPE,
-                    stderr=PIPE,
-                    preexec_fn=os.setsid,
-                    close_fds=True)
-    stdout, stderr = process.communicate()
-
-    if process.returncode != 0:
-        raise LVMCommandError('vgs', process.returncode, stderr)
-
-    return parse_lvm_format(VGS_ATTR, stdout)
+    return _report('vgs', VGS_ATTR, 'vg', volume_groups)
 
 def lvs(*volume_groups):
     """Report information about logical volumes
@@ -77,27 +100,7 @@ def lvs(*volume_groups):
     :param volume_groups: volumes to report on
     :returns: list of dicts of lvs parameters
     """
-    lvs_args = [
-        'lvs',
-        '--unbuffered',
-        '--noheadings',
-        '--nosuffix',
-        '--units=b',
-        '--separator=,',
-        '--options=%s' % ','.join(LVS_ATTR),
-    ]
-    lvs_args.extend(list(volume_groups))
-    process = Popen(lvs_args,
-                    stdout=PIPE,
-                    stderr=PIPE,
-                    preexec_fn=os.setsid,
-                    close_fds=True)
-    stdout, stderr = process.communicate()
-
-    if process.returncode != 0:
-        raise LVMCommandError('lvs', process.returncode, stderr)
-
-    return parse_lvm_format(LVS_ATTR, stdout)
+    return _report('lvs', LVS_ATTR, 'lv', volume_groups)
 
 
 def parse_lvm_format(keys, values):
@@ -106,6 +109,30 @@ def parse_lvm_format(keys, values):
     for row in csv.reader(stream, delimiter=',', skipinitialspace=True):
         yield dict(zip(keys, row))
 
+def parse_lvm_json(keys, report_key, text):
+    """Convert an LVM JSON report into a list of dictionaries
+
+    Values are taken in column order, so fields LVM reports under a
+    different name than the one requested (such as snap_percent) still map
+    to the requested key.
+    """
+    report = json.loads(text, object_pairs_hook=list)
+    rows = []
+    for name, sections in report:
+        if name != 'report':
+            continue
+        for section in sections:
+            for key, items in section:
+                if key != report_key:
+                    continue
+                for row in items:
+                    values = [value for field, value in row]
+                    if len(values) != len(keys):
+                        raise ValueError("Expected %d fields but found %d" %
+                                         (len(keys), len(values)))
+                    rows.append(dict(zip(keys, values)))
+    return rows
+
 def lvsnapshot(orig_lv_path, snapshot_name, snapshot_extents, chunksize=None):
     """Create a snapshot of an existing logical volume
 
@@ -176,6 +203,39 @@ def lvremove(lv_path):
                               str(stderr).strip())
 
 
+def lvextend(lv_path, extents):
+    """Grow a logical volume
+
+    :param lv_path: logical volume to extend
+    :param extents: number of extents to add to the volume
+    :raises: LVMCommandError if lvextend returns with non-zero status
+    """
+    lvextend_args = [
+        'lvextend',
+        '--extents', '+%d' % extents,
+        lv_path,
+    ]
+
+    LOG.debug("%s", list2cmdline(lvextend_args))
+    process = Popen(lvextend_args,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    preexec_fn=os.setsid,
+                    close_fds=True)
+
+    stdout, stderr = process.communicate()
+
+    for line in str(stdout).splitlines():
+        if not line:
+            continue
+        LOG.debug("lvextend: %s", line)
+
+    if process.returncode != 0:
+        raise LVMCommandError(list2cmdline(lvextend_args),
+                              process.returncode,
+                              str(stderr).strip())
+
+
 ## Filesystem utility functions
 def blkid(*devices):
     """Locate/print block device attributes
@@ -1,8 +1,10 @@
 """LVM Snapshot state machine"""
 
 import sys
+import time
 import signal
 import logging
+import threading
 from holland.lib.lvm.errors import LVMCommandError
 from holland.lib.lvm.util import SignalManager, format_bytes
 
@@ -10,15 +12,17 @@ LOG = logging.getLogger(__name__)
 
 __all__ = [
     'Snapshot',
+    'SnapshotMonitor',
     'CallbackFailuresError',
 ]
 
 class Snapshot(object):
     """Snapshot state machine"""
-    def __init__(self, name, size, mountpoint):
+    def __init__(self, name, size, mountpoint, monitor=None):
         self.name = name
         self.size = size
         self.mountpoint = mountpoint
+        self.monitor = monitor
         self.callbacks = {}
         self.sigmgr = SignalManager()
 
@@ -67,7 +71,13 @@ class Snapshot(object):
             snapshot.mount(self.mountpoint, options)
             LOG.info("Mounted %s on %s",
                      snapshot.device_name(), self.mountpoint)
-            self._apply_callbacks('post-mount', self, snapshot)
+            if self.monitor:
+                self.monitor.start(snapshot)
+            try:
+                self._apply_callbacks('post-mount', self, snapshot)
+            finally:
+                if self.monitor:
+                    self.monitor.stop()
         except (CallbackFailuresError, LVMCommandError), exc:
             return self.error(snapshot, exc)
 
@@ -174,6 +184,130 @@ class Snapshot(object):
                 raise CallbackFailuresError([(callback, exc)])
 
 
+class SnapshotMonitor(object):
+    """Watch the copy-on-write usage of a mounted snapshot
+
+    While the snapshot is mounted its snap_percent is polled from a
+    background thread.  Once usage reaches ``threshold`` percent the
+    snapshot is grown with lvextend by ``extend_extents`` extents (by
+    default 20% of its current size), as far as the free extents in the
+    volume group allow.  A threshold of None only records usage.
+
+    The peak usage and growth rate seen are kept in ``stats``.
+    """
+
+    def __init__(self, threshold=None, extend_extents=None, interval=5):
+        self.threshold = threshold
+        self.extend_extents = extend_extents
+        self.interval = interval
+        self.stats = {}
+        self.invalid = False
+        self._volume = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._first = None
+        self._warned = False
+
+    def start(self, volume):
+        """Start monitoring the snapshot LogicalVolume ``volume``"""
+        self._volume = volume
+        self._first = None
+        self._warned = False
+        self.invalid = False
+        self.stats = {
+            'initial-size'      : int(volume.lv_size),
+            'final-size'        : int(volume.lv_size),
+            'peak-percent'      : 0.0,
+            'peak-bytes'        : 0,
+            'growth-rate'       : 0.0,
+            'extend-count'      : 0,
+            'extended-extents'  : 0,
+        }
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop monitoring and take a final usage sample"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if not self.invalid:
+            try:
+                self.poll(extend=False)
+            except LVMCommandError, exc:
+                LOG.debug("Failed to check snapshot usage: %s", exc)
+        LOG.info("Peak usage of snapshot %s was %.2f%% (%s), "
+                 "growing %s/s",
+                 self._volume.device_name(),
+                 self.stats['peak-percent'],
+                 format_bytes(self.stats['peak-bytes']),
+                 format_bytes(int(self.stats['growth-rate'])))
+
+    def _run(self):
+        while not self._stop.isSet() and not self.invalid:
+            try:
+                self.poll()
+            except (LVMCommandError, ValueError), exc:
+                LOG.warning("Failed to check snapshot usage: %s", exc)
+            self._stop.wait(self.interval)
+
+    def poll(self, extend=True):
+        """Sample the snapshot's usage, extending it if it passed the
+        threshold
+
+        :returns: percentage of the snapshot in use
+        """
+        volume = self._volume
+        volume.reload()
+        if volume.lv_attr[4:5] in ('I', 'S'):
+            self.invalid = True
+            LOG.error("Snapshot %s has overflowed and is no longer valid",
+                      volume.device_name())
+            return 100.0
+        percent = float(volume.snap_percent or 0)
+        size = int(volume.lv_size)
+        used = int(size*percent/100)
+        now = time.time()
+        if self._first is None:
+            self._first = (now, used)
+        elapsed = now - self._first[0]
+        if elapsed > 0:
+            self.stats['growth-rate'] = (used - self._first[1]) / elapsed
+        self.stats['peak-percent'] = max(self.stats['peak-percent'], percent)
+        self.stats['peak-bytes'] = max(self.stats['peak-bytes'], used)
+        self.stats['final-size'] = size
+        if extend and self.threshold is not None and \
+            percent >= self.threshold:
+            self._extend(volume, percent)
+        return percent
+
+    def _extend(self, volume, percent):
+        """Grow the snapshot by up to extend_extents"""
+        extent_size = int(volume.vg_extent_size)
+        extents = self.extend_extents
+        if not extents:
+            extents = max(1, int(int(volume.lv_size) / extent_size * 0.2))
+        extents = min(extents, int(volume.vg_free_count))
+        if extents < 1:
+            if not self._warned:
+                LOG.warning("Snapshot %s is %.2f%% full but volume group %s "
+                            "has no free extents to extend it",
+                            volume.device_name(), percent, volume.vg_name)
+                self._warned = True
+            return
+        LOG.info("Snapshot %s is %.2f%% full. Extending it by %d extents (%s)",
+                 volume.device_name(), percent, extents,
+                 format_bytes(extents*extent_size))
+        volume.extend(extents)
+        self.stats['extend-count'] += 1
+        self.stats['extended-extents'] += extents
+        self.stats['final-size'] = int(volume.lv_size)
+
+
 class CallbackFailuresError(Exception):
     """Error running callbacks"""
 
@@ -12,6 +12,7 @@ __all__ = [
     'format_bytes',
     'parse_bytes',
     'SignalManager',
+    'MountIndex',
 ]
 
 def getmount(path):
@@ -47,6 +48,11 @@ def getdevice(mountpoint):
 
     mountpoint = getmount(mountpoint)
 
+    try:
+        return MountIndex.load().device(mountpoint)
+    except IOError:
+        pass
+
     # Read /proc/mounts in reverse order to get the right mountpoint
     # for a stacked mount, as these should be appended to the end
 
@@ -63,6 +69,66 @@ def getdevice(mountpoint):
         if mount == mountpoint:
             return device
 
+class MountIndex(object):
+    """Index of the mounted filesystems listed in /proc/self/mountinfo
+
+    Mounts are indexed both by mountpoint and by the major:minor device
+    number of the mounted device, so a device can be checked without
+    resolving the device names in the mount table.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.mountpoints = {}
+        self.devices = {}
+        for entry in entries:
+            # later mounts are stacked on top of earlier ones
+            self.mountpoints[entry['mountpoint']] = entry
+            self.devices.setdefault((entry['major'], entry['minor']),
+                                    []).append(entry)
+
+    def load(cls, path='/proc/self/mountinfo'):
+        """Read a mountinfo file
+
+        :raises: IOError if path cannot be read
+        """
+        entries = []
+        fileobj = open(path, 'r')
+        try:
+            for line in fileobj:
+                fields = line.split()
+                try:
+                    separator = fields.index('-', 6)
+                    major, minor = fields[2].split(':')
+                    entries.append({
+                        'major'      : int(major),
+                        'minor'      : int(minor),
+                        'root'       : fields[3].decode('string_escape'),
+                        'mountpoint' : os.path.normpath(
+                                        fields[4].decode('string_escape')),
+                        'fstype'     : fields[separator + 1],
+                        'source'     : fields[separator + 2].decode(
+                                                            'string_escape'),
+                    })
+                except (ValueError, IndexError):
+                    continue
+        finally:
+            fileobj.close()
+        return cls(entries)
+    load = classmethod(load)
+
+    def device(self, mountpoint):
+        """Return the device mounted on mountpoint or None"""
+        entry = self.mountpoints.get(os.path.normpath(mountpoint))
+        if entry is None:
+            return None
+        return entry['source']
+
+    def mounts(self, device):
+        """List the mounts of the block device ``device``"""
+        rdev = os.stat(device).st_rdev
+        return self.devices.get((os.major(rdev), os.minor(rdev)), [])
+
 # Taken from posixpath in Python2.6
 def relpath(path, start=os.curdir):
     """Return a relative version of a path"""
@@ -0,0 +1,71 @@
+from nose.tools import *
+from holland.lib.lvm.raw import parse_lvm_json
+from holland.lib.lvm.cache import ReportCache
+from holland.lib.lvm.errors import LVMCommandError
+
+LVS_JSON = """
+  {
+      "report": [
+          {
+              "lv": [
+                  {"lv_name":"mysql", "lv_tags":"a,b", "data_percent":"", "vg_name":"vg"},
+                  {"lv_name":"mysql_snapshot", "lv_tags":"", "data_percent":"12.50", "vg_name":"vg"}
+              ]
+          }
+      ]
+  }
+"""
+
+def test_parse_lvm_json():
+    keys = ['lv_name', 'lv_tags', 'snap_percent', 'vg_name']
+    rows = parse_lvm_json(keys, 'lv', LVS_JSON)
+    assert_equals(len(rows), 2)
+    # tags containing the separator are kept intact
+    assert_equals(rows[0]['lv_tags'], 'a,b')
+    # values map to the requested keys by position
+    assert_equals(rows[1]['snap_percent'], '12.50')
+    assert_equals(parse_lvm_json(keys, 'vg', LVS_JSON), [])
+    assert_raises(ValueError, parse_lvm_json, keys[:2], 'lv', LVS_JSON)
+
+class FakeReport(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        if not args:
+            return list(self.rows)
+        result = [row for row in self.rows
+                  if args[0] == row['vg_name'] + '/' + row['lv_name']]
+        if not result:
+            raise LVMCommandError('lvs', 5, 'not found')
+        return result
+
+def test_report_cache():
+    report = FakeReport([
+        {'vg_name' : 'vg', 'lv_name' : 'mysql', 'lv_kernel_major' : '253',
+         'lv_kernel_minor' : '3'},
+        {'vg_name' : 'vg', 'lv_name' : 'logs', 'lv_kernel_major' : '253',
+         'lv_kernel_minor' : '4'},
+    ])
+    cache = ReportCache(ttl=3600)
+    cache.REPORTS = {'lvs' : (report, ReportCache.REPORTS['lvs'][1])}
+    assert_equals(len(cache.lookup('lvs', 'vg')), 2)
+    row, = cache.lookup('lvs', 'vg/mysql')
+    assert_equals(row['lv_name'], 'mysql')
+    row, = cache.lookup('lvs', '/dev/vg/logs')
+    assert_equals(row['lv_name'], 'logs')
+    # one batched report answered every lookup
+    assert_equals(report.calls, [()])
+
+    # volumes missing from the cache are looked up directly
+    report.rows.append({'vg_name' : 'vg', 'lv_name' : 'mysql_snapshot'})
+    row, = cache.lookup('lvs', 'vg/mysql_snapshot')
+    assert_equals(report.calls, [(), ('vg/mysql_snapshot',)])
+    assert_raises(LVMCommandError, cache.lookup, 'lvs', 'vg/missing')
+
+    cache.invalidate()
+    assert_equals(len(cache.lookup('lvs')), 3)
+    cache.lookup('lvs', 'vg/mysql', refresh=True)
+    assert_equals(report.calls.count(()), 3)
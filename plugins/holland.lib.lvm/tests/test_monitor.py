@@ -0,0 +1,63 @@
+from nose.tools import *
+from holland.lib.lvm.snapshot import SnapshotMonitor
+
+class FakeSnapshotVolume(object):
+    """Snapshot volume whose usage follows a list of snap_percent samples"""
+    def __init__(self, samples, free_extents=10):
+        self.samples = list(samples)
+        self.vg_name = 'vg'
+        self.lv_attr = 'swi-ao'
+        self.lv_size = str(100*4096)
+        self.vg_extent_size = '4096'
+        self.vg_free_count = str(free_extents)
+        self.snap_percent = '0.00'
+        self.extended = []
+
+    def reload(self):
+        if self.samples:
+            self.snap_percent = self.samples.pop(0)
+
+    def extend(self, extents):
+        self.extended.append(extents)
+        self.lv_size = str(int(self.lv_size) + extents*4096)
+        self.vg_free_count = str(int(self.vg_free_count) - extents)
+
+    def device_name(self):
+        return '/dev/vg/test_snapshot'
+
+def test_monitor_extends():
+    volume = FakeSnapshotVolume(['10.00'])
+    monitor = SnapshotMonitor(threshold=80, interval=3600)
+    monitor.start(volume)
+    monitor.stop()
+    assert_equals(monitor.stats['peak-percent'], 10.0)
+    volume.samples = ['85.00', '50.00', '90.00']
+    monitor.poll()
+    # 20% of 100 extents
+    assert_equals(volume.extended, [10])
+    monitor.poll()
+    monitor.poll()
+    # no more than the remaining free extents are used
+    assert_equals(volume.extended, [10])
+    assert_equals(monitor.stats['extend-count'], 1)
+    assert_equals(monitor.stats['peak-percent'], 90.0)
+    assert_equals(monitor.stats['final-size'], 110*4096)
+    ok_(monitor.stats['peak-bytes'] >= 85*4096)
+
+def test_monitor_no_free_extents():
+    volume = FakeSnapshotVolume(['95.00'], free_extents=0)
+    monitor = SnapshotMonitor(threshold=80, extend_extents=5, interval=3600)
+    monitor.start(volume)
+    monitor.stop()
+    assert_equals(volume.extended, [])
+    assert_equals(monitor.stats['extend-count'], 0)
+    assert_equals(monitor.stats['peak-percent'], 95.0)
+
+def test_monitor_invalid_snapshot():
+    volume = FakeSnapshotVolume(['100.00'])
+    volume.lv_attr = 'swi-Io'
+    monitor = SnapshotMonitor(threshold=80, interval=3600)
+    monitor.start(volume)
+    monitor.stop()
+    ok_(monitor.invalid)
+    assert_equals(volume.extended, [])
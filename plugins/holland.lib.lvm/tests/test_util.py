@@ -41,3 +41,24 @@ def test_parsebytes():
    
     bytes = parse_bytes('1024G')
     assert_equals(bytes, 1024**4)
+
+def test_mountindex():
+    import tempfile
+    fd, path = tempfile.mkstemp()
+    os.write(fd, "22 1 253:0 / / rw,relatime shared:1 - ext4 /dev/mapper/vg-root rw\n"
+                 "40 22 253:3 / /var/lib/mysql rw - xfs /dev/mapper/vg-mysql rw\n"
+                 "41 40 253:4 / /var/lib/mysql rw - xfs /dev/mapper/vg-other rw\n"
+                 "42 22 0:40 / /mnt/with\\040space rw - tmpfs tmpfs rw\n")
+    os.close(fd)
+    try:
+        index = MountIndex.load(path)
+    finally:
+        os.unlink(path)
+    assert_equals(len(index.entries), 4)
+    assert_equals(index.device('/'), '/dev/mapper/vg-root')
+    # the last of several stacked mounts wins
+    assert_equals(index.device('/var/lib/mysql/'), '/dev/mapper/vg-other')
+    assert_equals(index.device('/mnt/with space'), 'tmpfs')
+    assert_equals(index.device('/missing'), None)
+    assert_equals([entry['mountpoint'] for entry in index.devices[(253, 3)]],
+                  ['/var/lib/mysql'])
@@ -92,6 +92,71 @@ class MySQLClient(object):
         cursor.execute('UNLOCK TABLES')
         cursor.close()
 
+    def backup_lock_type(self):
+        """Find which kind of backup lock the server supports
+
+        Percona Server 5.6+ provides LOCK TABLES FOR BACKUP.  Only
+        Percona Server before 8.0 also provides LOCK BINLOG FOR BACKUP.
+
+        :returns: 'tables' or None
+        """
+        if self.show_variable('have_backup_locks') == 'YES':
+            return 'tables'
+        return None
+
+    def lock_tables_for_backup(self):
+        """Block DDL and writes to non-transactional tables
+
+        Runs LOCK TABLES FOR BACKUP
+        """
+        cursor = self.cursor()
+        cursor.execute('LOCK TABLES FOR BACKUP')
+        cursor.close()
+
+    def lock_binlog_for_backup(self):
+        """Block changes to the binary log position
+
+        Runs LOCK BINLOG FOR BACKUP
+        """
+        cursor = self.cursor()
+        cursor.execute('LOCK BINLOG FOR BACKUP')
+        cursor.close()
+
+    def unlock_binlog(self):
+        """Release a LOCK BINLOG FOR BACKUP
+
+        Runs UNLOCK BINLOG
+        """
+        cursor = self.cursor()
+        cursor.execute('UNLOCK BINLOG')
+        cursor.close()
+
+    def show_processlist(self):
+        """List the threads running on the server
+
+        Runs SHOW FULL PROCESSLIST
+
+        :returns: list of dicts keyed by lower-cased column name
+        """
+        cursor = self.cursor()
+        try:
+            cursor.execute('SHOW FULL PROCESSLIST')
+            names = [info[0].lower() for info in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def kill_query(self, thread_id):
+        """Abort the statement a thread is running
+
+        Runs KILL QUERY ``thread_id``
+        """
+        cursor = self.cursor()
+        try:
+            cursor.execute('KILL QUERY %d' % int(thread_id))
+        finally:
+            cursor.close()
+
     def show_databases(self):
         """List available databases
 
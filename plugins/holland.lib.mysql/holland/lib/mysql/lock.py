@@ -0,0 +1,248 @@
+"""Global read lock with a guard against long running queries
+
+FLUSH TABLES WITH READ LOCK has to wait for every running statement to
+finish before it is granted, and every write on the server queues behind
+it in the meantime.  A single long SELECT can therefore stall all writes
+for as long as it runs.  GlobalReadLock checks the processlist first and
+waits for, kills or refuses to lock behind statements that have already
+run for a long time.  It also bounds the time FLUSH TABLES WITH READ LOCK
+may wait with lock_wait_timeout, and measures how long the lock was
+waited for and held.
+
+BackupLock takes the lighter backup locks instead where the server
+supports them, so DML on InnoDB tables keeps running while it is held.
+"""
+
+import time
+import logging
+from holland.lib.mysql.client.base import MySQLError
+
+LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'BackupLock',
+    'GlobalReadLock',
+    'LockError',
+    'find_long_queries',
+]
+
+class LockError(Exception):
+    """Raised when the global read lock could not be taken safely"""
+
+def find_long_queries(client, long_query_time):
+    """List other sessions that have been running a statement for at least
+    ``long_query_time`` seconds
+
+    Replication threads and idle connections are ignored.
+
+    :returns: list of processlist dicts
+    """
+    own_id = client.thread_id()
+    result = []
+    for process in client.show_processlist():
+        if process['id'] == own_id:
+            continue
+        if process['command'] != 'Query' or \
+            process['user'] == 'system user':
+            continue
+        if (process['time'] or 0) < long_query_time:
+            continue
+        result.append(process)
+    return result
+
+class GlobalReadLock(object):
+    """FLUSH TABLES WITH READ LOCK guarded against long running queries
+
+    :param client: MySQLClient connection to lock through
+    :param long_query_time: statements running at least this many seconds
+                            are long queries.  0 disables the check.
+    :param action: what to do about long queries: 'wait' for them to
+                   finish, 'kill' them or 'abort'
+    :param timeout: seconds to wait for long queries to finish, and for
+                    FLUSH TABLES WITH READ LOCK itself
+    :param interval: seconds between checks of the processlist
+    """
+    method = 'FLUSH TABLES WITH READ LOCK'
+
+    def __init__(self, client, long_query_time=60, action='wait',
+                 timeout=300, interval=1):
+        self.client = client
+        self.long_query_time = long_query_time
+        self.action = action
+        self.timeout = timeout
+        self.interval = interval
+        self._locked_at = None
+        # wait-time and hold-time are added once a lock is taken
+        self.stats = {
+            'guard-time'     : 0.0,
+            'long-queries'   : 0,
+            'killed-queries' : 0,
+        }
+
+    def check(self):
+        """Deal with long running queries before taking a lock
+
+        :raises: LockError if long queries are still running when the
+                 timeout expires, or immediately with action = abort
+        """
+        if not self.long_query_time:
+            return
+        start = time.time()
+        seen = {}
+        killed = {}
+        try:
+            while True:
+                queries = find_long_queries(self.client, self.long_query_time)
+                if not queries:
+                    return
+                for query in queries:
+                    if query['id'] not in seen:
+                        seen[query['id']] = True
+                        LOG.warning("Thread %s (%s@%s) has been running a "
+                                    "statement for %ss: %s",
+                                    query['id'], query['user'],
+                                    query['host'], query['time'],
+                                    (query['info'] or '')[:200])
+                if self.action == 'abort':
+                    raise LockError("Not locking while %d long running "
+                                    "queries are active" % len(queries))
+                if time.time() - start >= self.timeout:
+                    raise LockError("%d long running queries were still "
+                                    "active after waiting %d seconds" %
+                                    (len(queries), self.timeout))
+                if self.action == 'kill':
+                    for query in queries:
+                        if query['id'] in killed:
+                            continue
+                        LOG.warning("Killing query on thread %s",
+                                    query['id'])
+                        try:
+                            self.client.kill_query(query['id'])
+                            killed[query['id']] = True
+                        except MySQLError, exc:
+                            # the query may have finished in the meantime
+                            LOG.debug("KILL QUERY %s failed: %s",
+                                      query['id'], exc)
+                else:
+                    LOG.info("Waiting for %d long running queries to "
+                             "finish before locking", len(queries))
+                time.sleep(self.interval)
+        finally:
+            self.stats['guard-time'] += time.time() - start
+            self.stats['long-queries'] += len(seen)
+            self.stats['killed-queries'] += len(killed)
+
+    def acquire(self, extra_flush=False):
+        """Check for long queries and take the lock
+
+        :param extra_flush: run a non-locking FLUSH TABLES first
+        :raises: LockError or MySQLError
+        """
+        self.check()
+        if extra_flush:
+            LOG.debug("Executing FLUSH TABLES")
+            self.client.flush_tables()
+        previous_timeout = self.client.show_variable('lock_wait_timeout',
+                                                     session=True)
+        if previous_timeout is not None:
+            self.client.set_variable('lock_wait_timeout', int(self.timeout))
+        start = time.time()
+        try:
+            try:
+                self._lock()
+            except MySQLError, exc:
+                if exc.args and exc.args[0] == 1205:
+                    raise LockError("Timed out after %d seconds waiting for "
+                                    "%s" % (self.timeout, self.method))
+                raise
+        finally:
+            self.stats['wait-time'] = time.time() - start
+            if previous_timeout is not None:
+                self.client.set_variable('lock_wait_timeout',
+                                         int(previous_timeout))
+        self._locked_at = time.time()
+        self.stats['method'] = self.method
+        LOG.info("Acquired %s after %.3f seconds", self.method,
+                 self.stats['guard-time'] + self.stats['wait-time'])
+
+    def release(self):
+        """Release the lock"""
+        self._unlock()
+        if self._locked_at is not None:
+            self.stats['hold-time'] = time.time() - self._locked_at
+            self._locked_at = None
+            LOG.info("%s was held for %.3f seconds", self.method,
+                     self.stats['hold-time'])
+
+    def _lock(self):
+        """Take the lock itself"""
+        LOG.debug("Executing FLUSH TABLES WITH READ LOCK")
+        self.client.flush_tables_with_read_lock()
+
+    def _unlock(self):
+        """Release the lock itself"""
+        self.client.unlock_tables()
+
+    def record_metrics(self, config):
+        """Record lock timings in the [holland:metrics] section of a backup
+        config"""
+        metrics = config.setdefault('holland:metrics', {})
+        for key, value in self.stats.items():
+            if isinstance(value, float):
+                value = '%.3f' % value
+            metrics['lock-' + key] = value
+
+class BackupLock(GlobalReadLock):
+    """Backup lock guarded against long running queries
+
+    On Percona Server this is LOCK TABLES FOR BACKUP, which blocks DDL and
+    writes to non-transactional tables, followed by LOCK BINLOG FOR BACKUP
+    if ``binlog`` is set so the binary log position is consistent.
+    Percona Server 8.0 has no LOCK BINLOG FOR BACKUP, so it only takes
+    the backup lock when ``binlog`` is not set.  Other servers fall back
+    to FLUSH TABLES WITH READ LOCK.
+
+    :param binlog: also lock the binary log position
+
+    The remaining parameters are those of GlobalReadLock.
+    """
+
+    def __init__(self, client, long_query_time=60, action='wait',
+                 timeout=300, interval=1, binlog=True):
+        GlobalReadLock.__init__(self, client, long_query_time, action,
+                                timeout, interval)
+        self.binlog = binlog
+        self.kind = None
+
+    def _lock(self):
+        kind = self.client.backup_lock_type()
+        if kind == 'tables' and self.binlog and \
+            self.client.server_version() >= (8, 0, 0):
+            LOG.warning("LOCK BINLOG FOR BACKUP is not supported by this "
+                        "server. Using FLUSH TABLES WITH READ LOCK instead.")
+            kind = None
+        elif kind is None:
+            LOG.warning("Backup locks are not supported by this server. "
+                        "Using FLUSH TABLES WITH READ LOCK instead.")
+        self.kind = kind
+        if kind == 'tables':
+            self.method = 'LOCK TABLES FOR BACKUP'
+            LOG.debug("Executing LOCK TABLES FOR BACKUP")
+            self.client.lock_tables_for_backup()
+            if self.binlog:
+                LOG.debug("Executing LOCK BINLOG FOR BACKUP")
+                try:
+                    self.client.lock_binlog_for_backup()
+                except:
+                    self.client.unlock_tables()
+                    raise
+        else:
+            GlobalReadLock._lock(self)
+
+    def _unlock(self):
+        if self.kind == 'tables':
+            if self.binlog:
+                self.client.unlock_binlog()
+            self.client.unlock_tables()
+        else:
+            GlobalReadLock._unlock(self)
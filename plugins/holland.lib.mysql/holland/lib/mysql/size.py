@@ -0,0 +1,152 @@
+"""Estimate the size of a MySQL datadir without walking every file
+
+Walking a multi-terabyte datadir just to estimate the size of a backup can
+take longer than it should.  estimate_datadir_size() tries cheaper sources
+first:
+
+* the used blocks of the filesystem, when the datadir has a volume to
+  itself
+* the data and index lengths in INFORMATION_SCHEMA.TABLES, with the file
+  sizes of InnoDB file-per-table tablespaces taken from
+  INNODB_SYS_TABLESPACES (5.7) or INNODB_TABLESPACES (8.0) where
+  available, plus the files at the top level of the datadir such as the
+  system tablespace and redo logs
+
+and only walks the datadir when neither is available.
+"""
+
+import os
+import logging
+from holland.core.util.path import getmount, directory_size
+from holland.lib.mysql.client.base import MySQLError
+
+LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'estimate_datadir_size',
+    'is_dedicated_volume',
+]
+
+# schemas and engines whose tables do not occupy files in the datadir
+SKIP_SCHEMAS = ('information_schema', 'performance_schema', 'sys')
+SKIP_ENGINES = ('MEMORY', 'PERFORMANCE_SCHEMA', 'BLACKHOLE', 'FEDERATED')
+
+TABLESPACE_QUERIES = [
+    # file-per-table tablespaces are named db/table
+    "SELECT SUM(FILE_SIZE) FROM INFORMATION_SCHEMA.INNODB_TABLESPACES "
+    "WHERE NAME LIKE '%/%'",
+    "SELECT SUM(FILE_SIZE) FROM INFORMATION_SCHEMA.INNODB_SYS_TABLESPACES "
+    "WHERE NAME LIKE '%/%'",
+]
+
+def is_dedicated_volume(path):
+    """Check whether path is the only thing stored on its filesystem
+
+    This is the case if path is a mount point, or the only entry besides
+    lost+found directly below one.
+    """
+    path = os.path.realpath(path)
+    mount = getmount(path)
+    if mount == path:
+        return True
+    if os.path.dirname(path) != mount:
+        return False
+    entries = [name for name in os.listdir(mount) if name != 'lost+found']
+    return entries == [os.path.basename(path)]
+
+def volume_used_size(path):
+    """Bytes used on the filesystem path is stored on"""
+    info = os.statvfs(path)
+    return (info.f_blocks - info.f_bfree)*info.f_frsize
+
+def _scalar(client, sql):
+    cursor = client.cursor()
+    try:
+        cursor.execute(sql)
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+def tablespace_size(client):
+    """Total size of the InnoDB file-per-table tablespaces
+
+    :returns: bytes or None if the server does not report file sizes
+    """
+    for sql in TABLESPACE_QUERIES:
+        try:
+            return _scalar(client, sql)
+        except MySQLError, exc:
+            LOG.debug("%s failed: %s", sql, exc)
+    return None
+
+def table_sizes(client):
+    """Data and index lengths per storage engine
+
+    :returns: dict of engine name to bytes
+    """
+    sql = ("SELECT ENGINE, SUM(DATA_LENGTH + INDEX_LENGTH) "
+           "FROM INFORMATION_SCHEMA.TABLES "
+           "WHERE TABLE_TYPE = 'BASE TABLE' AND ENGINE IS NOT NULL "
+           "AND TABLE_SCHEMA NOT IN (%s) "
+           "GROUP BY ENGINE" % ','.join(["'%s'" % name
+                                         for name in SKIP_SCHEMAS]))
+    cursor = client.cursor()
+    try:
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    result = {}
+    for engine, size in rows:
+        if engine.upper() in SKIP_ENGINES:
+            continue
+        result[engine] = int(size or 0)
+    return result
+
+def top_level_size(datadir):
+    """Size of the regular files directly in datadir"""
+    result = 0
+    for name in os.listdir(datadir):
+        path = os.path.join(datadir, name)
+        try:
+            if os.path.isfile(path):
+                result += os.path.getsize(path)
+        except OSError:
+            pass
+    return result
+
+def estimate_datadir_size(client, datadir):
+    """Estimate the bytes stored in a MySQL datadir
+
+    :param client: connection with a DB-API cursor() method
+    :param datadir: datadir of the server client is connected to
+    :returns: estimated size in bytes
+    """
+    try:
+        if is_dedicated_volume(datadir):
+            size = volume_used_size(datadir)
+            LOG.info("Estimated datadir size from the used space of the "
+                     "volume %s is on", datadir)
+            return size
+    except OSError, exc:
+        LOG.debug("Failed to check the volume %s is on: %s", datadir, exc)
+
+    try:
+        sizes = table_sizes(client)
+        innodb = tablespace_size(client)
+        size = top_level_size(datadir)
+    except (MySQLError, OSError), exc:
+        LOG.info("Failed to estimate the datadir size from table metadata "
+                 "(%s). Calculating the size of every file in %s.",
+                 exc, datadir)
+        return directory_size(datadir)
+    if innodb is not None:
+        for engine in sizes.keys():
+            if engine.lower() == 'innodb':
+                del sizes[engine]
+        size += innodb
+    LOG.info("Estimated datadir size from table metadata")
+    return size + sum(sizes.values())
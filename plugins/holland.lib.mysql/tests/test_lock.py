@@ -0,0 +1,141 @@
+"""
+Test the long running query guard of GlobalReadLock and BackupLock
+"""
+
+from nose.tools import *
+from holland.lib.mysql.lock import GlobalReadLock, BackupLock, LockError, \
+                                   find_long_queries
+
+class FakeClient(object):
+    """Records statements and replays a scripted processlist"""
+    def __init__(self, processlists, backup_locks=None, version=(5, 7, 30)):
+        self.processlists = processlists
+        self.backup_locks = backup_locks
+        self.version = version
+        self.statements = []
+        self.variables = {'lock_wait_timeout' : '31536000'}
+
+    def thread_id(self):
+        return 1
+
+    def show_processlist(self):
+        if len(self.processlists) > 1:
+            return self.processlists.pop(0)
+        return self.processlists[0]
+
+    def kill_query(self, thread_id):
+        self.statements.append('KILL QUERY %d' % thread_id)
+        self.processlists = [[]]
+
+    def show_variable(self, key, session=False):
+        return self.variables.get(key)
+
+    def set_variable(self, key, value, session=True):
+        self.statements.append('SET %s = %s' % (key, value))
+
+    def flush_tables(self):
+        self.statements.append('FLUSH TABLES')
+
+    def flush_tables_with_read_lock(self):
+        self.statements.append('FLUSH TABLES WITH READ LOCK')
+
+    def unlock_tables(self):
+        self.statements.append('UNLOCK TABLES')
+
+    def server_version(self):
+        return self.version
+
+    def backup_lock_type(self):
+        return self.backup_locks
+
+    def lock_tables_for_backup(self):
+        self.statements.append('LOCK TABLES FOR BACKUP')
+
+    def lock_binlog_for_backup(self):
+        self.statements.append('LOCK BINLOG FOR BACKUP')
+
+    def unlock_binlog(self):
+        self.statements.append('UNLOCK BINLOG')
+
+def _process(thread_id, seconds, command='Query', user='app'):
+    return {
+        'id' : thread_id, 'user' : user, 'host' : 'localhost', 'db' : 'test',
+        'command' : command, 'time' : seconds, 'state' : 'Sending data',
+        'info' : 'SELECT SLEEP(%d)' % seconds,
+    }
+
+PROCESSLIST = [
+    _process(1, 500),
+    _process(2, 500, command='Sleep'),
+    _process(3, 500, user='system user'),
+    _process(4, 5),
+    _process(5, 120),
+]
+
+def test_find_long_queries():
+    client = FakeClient([PROCESSLIST])
+    eq_([process['id'] for process in find_long_queries(client, 60)], [5])
+
+def test_lock_waits():
+    client = FakeClient([PROCESSLIST, PROCESSLIST, []])
+    lock = GlobalReadLock(client, long_query_time=60, interval=0)
+    lock.acquire(extra_flush=True)
+    lock.release()
+    eq_(client.statements, ['FLUSH TABLES',
+                            'SET lock_wait_timeout = 300',
+                            'FLUSH TABLES WITH READ LOCK',
+                            'SET lock_wait_timeout = 31536000',
+                            'UNLOCK TABLES'])
+    eq_(lock.stats['long-queries'], 1)
+    config = {}
+    lock.record_metrics(config)
+    ok_('lock-hold-time' in config['holland:metrics'])
+    ok_('lock-wait-time' in config['holland:metrics'])
+
+def test_lock_wait_timeout():
+    client = FakeClient([PROCESSLIST])
+    lock = GlobalReadLock(client, long_query_time=60, timeout=0, interval=0)
+    assert_raises(LockError, lock.acquire)
+    eq_(client.statements, [])
+
+def test_lock_abort():
+    client = FakeClient([PROCESSLIST])
+    lock = GlobalReadLock(client, long_query_time=60, action='abort')
+    assert_raises(LockError, lock.check)
+
+def test_lock_kill():
+    client = FakeClient([PROCESSLIST])
+    lock = GlobalReadLock(client, long_query_time=60, action='kill',
+                          interval=0)
+    lock.check()
+    eq_(client.statements, ['KILL QUERY 5'])
+    eq_(lock.stats['killed-queries'], 1)
+
+def _backup_lock_statements(backup_locks, version=(5, 7, 30), **kwargs):
+    client = FakeClient([[]], backup_locks, version)
+    lock = BackupLock(client, **kwargs)
+    lock.acquire()
+    lock.release()
+    return [stmt for stmt in client.statements
+            if not stmt.startswith('SET')], lock
+
+def test_backup_lock_tables():
+    statements, lock = _backup_lock_statements('tables')
+    eq_(statements, ['LOCK TABLES FOR BACKUP', 'LOCK BINLOG FOR BACKUP',
+                     'UNLOCK BINLOG', 'UNLOCK TABLES'])
+    eq_(lock.stats['method'], 'LOCK TABLES FOR BACKUP')
+    statements, lock = _backup_lock_statements('tables', binlog=False)
+    eq_(statements, ['LOCK TABLES FOR BACKUP', 'UNLOCK TABLES'])
+
+def test_backup_lock_percona80():
+    # Percona Server 8.0 has no LOCK BINLOG FOR BACKUP
+    statements, lock = _backup_lock_statements('tables', (8, 0, 20))
+    eq_(statements, ['FLUSH TABLES WITH READ LOCK', 'UNLOCK TABLES'])
+    statements, lock = _backup_lock_statements('tables', (8, 0, 20),
+                                               binlog=False)
+    eq_(statements, ['LOCK TABLES FOR BACKUP', 'UNLOCK TABLES'])
+
+def test_backup_lock_fallback():
+    statements, lock = _backup_lock_statements(None)
+    eq_(statements, ['FLUSH TABLES WITH READ LOCK', 'UNLOCK TABLES'])
+    eq_(lock.stats['method'], 'FLUSH TABLES WITH READ LOCK')
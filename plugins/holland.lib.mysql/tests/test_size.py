@@ -0,0 +1,76 @@
+"""
+Test the datadir size estimate of holland.lib.mysql.size
+"""
+
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from holland.lib.mysql.client.base import MySQLError
+from holland.lib.mysql.size import estimate_datadir_size, is_dedicated_volume
+
+class FakeCursor(object):
+    def __init__(self, results):
+        self.results = results
+        self.rows = []
+
+    def execute(self, sql, args=None):
+        for key, rows in self.results.items():
+            if key in sql:
+                if isinstance(rows, Exception):
+                    raise rows
+                self.rows = rows
+                return len(rows)
+        raise MySQLError(1109, "Unknown table")
+
+    def fetchone(self):
+        return self.rows and self.rows[0] or None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+class FakeClient(object):
+    """Answers queries from a dict of sql fragment to result rows"""
+    def __init__(self, results):
+        self.results = results
+
+    def cursor(self):
+        return FakeCursor(self.results)
+
+def setup_func():
+    global tmpdir, datadir
+    tmpdir = tempfile.mkdtemp()
+    datadir = os.path.join(tmpdir, 'mysql')
+    os.mkdir(datadir)
+    os.mkdir(os.path.join(tmpdir, 'other'))
+    open(os.path.join(datadir, 'ibdata1'), 'w').write('x'*1000)
+    os.mkdir(os.path.join(datadir, 'test'))
+    open(os.path.join(datadir, 'test', 't1.ibd'), 'w').write('x'*5000)
+
+def teardown_func():
+    shutil.rmtree(tmpdir)
+
+TABLES = [('InnoDB', 4000), ('MyISAM', 300), ('MEMORY', 50000)]
+
+@with_setup(setup_func, teardown_func)
+def test_estimate_from_tablespaces():
+    ok_(not is_dedicated_volume(datadir))
+    client = FakeClient({
+        'INFORMATION_SCHEMA.TABLES' : TABLES,
+        'INNODB_SYS_TABLESPACES' : [(5000,)],
+    })
+    # ibdata1 + tablespaces + MyISAM
+    eq_(estimate_datadir_size(client, datadir), 1000 + 5000 + 300)
+
+@with_setup(setup_func, teardown_func)
+def test_estimate_from_tables():
+    client = FakeClient({'INFORMATION_SCHEMA.TABLES' : TABLES})
+    eq_(estimate_datadir_size(client, datadir), 1000 + 4000 + 300)
+
+@with_setup(setup_func, teardown_func)
+def test_estimate_fallback():
+    client = FakeClient({})
+    eq_(estimate_datadir_size(client, datadir), 6000)
@@ -35,7 +35,7 @@ setup(name="holland",
       backup = holland.commands.backup:Backup
       mk-config = holland.commands.mk_config:MkConfig
       purge = holland.commands.purge:Purge
-      #restore = holland.commands.restore:Restore
+      restore = holland.commands.restore:Restore
       """,
       namespace_packages=['holland', 'holland.backup', 'holland.lib', 'holland.commands'],
       )
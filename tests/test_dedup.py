@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from holland.core.spool import Spool
+from holland.core.dedup import Chunker, ChunkStore, read_recipe, \
+                               reassemble, find_recipes
+
+def _sample_data(count, seed=0):
+    return ''.join(["INSERT INTO t VALUES (%d, 'row %d');\n" % (i, i*7 + seed)
+                    for i in xrange(count)])
+
+class TestChunker(unittest.TestCase):
+    def _chunk(self, data, feed_size):
+        chunker = Chunker(min_size=1024, avg_size=4096, max_size=16384)
+        chunks = []
+        for offset in xrange(0, len(data), feed_size):
+            chunks.extend(chunker.feed(data[offset:offset + feed_size]))
+        last = chunker.finish()
+        if last is not None:
+            chunks.append(last)
+        return chunks
+
+    def test_boundaries(self):
+        data = _sample_data(5000)
+        chunks = self._chunk(data, 1000)
+        self.assertEqual(''.join(chunks), data)
+        self.assert_(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assert_(1024 <= len(chunk) <= 16384)
+            self.assert_(chunk.endswith('\n'))
+        # boundaries do not depend on how the data is fed
+        self.assertEqual(self._chunk(data, 777), chunks)
+
+    def test_long_lines(self):
+        data = 'x' * 40000
+        chunks = self._chunk(data, 4096)
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual([len(chunk) for chunk in chunks],
+                         [16384, 16384, 7232])
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = Spool(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, backup, name, data):
+        store = backup.chunk_store()
+        stream = store.open_output(os.path.join(backup.path, name))
+        stream.chunker = Chunker(min_size=1024, avg_size=4096,
+                                 max_size=16384)
+        stream.write(data)
+        stream.close()
+        backup.config['holland:backup']['dedup'] = True
+        store.record_metrics(backup.config)
+        backup.flush()
+        return stream.name
+
+    def test_roundtrip(self):
+        backup = self.spool.add_backup('default')
+        data = _sample_data(5000)
+        recipe = self._write(backup, 'test.sql', data)
+        self.assertEqual(recipe, os.path.join(backup.path, 'test.sql.recipe'))
+        result = StringIO()
+        self.assertEqual(reassemble(recipe, result), len(data))
+        self.assertEqual(result.getvalue(), data)
+
+        metrics = backup.config['holland:metrics']
+        self.assertEqual(int(metrics['dedup-logical-bytes']), len(data))
+        self.assertEqual(float(metrics['dedup-ratio']), 1.0)
+
+    def _make_backup(self, name, start):
+        os.makedirs(os.path.join(self.tmpdir, 'default', name))
+        backup = self.spool.find_backup('default/' + name)
+        backup.config['holland:backup']['start-time'] = start
+        return backup
+
+    def test_dedup_and_purge(self):
+        first = self._make_backup('20140101_000000', 1388534400)
+        self._write(first, 'test.sql', _sample_data(5000))
+
+        second = self._make_backup('20140102_000000', 1388620800)
+        # change a single row; most chunks are shared with the first backup
+        data = _sample_data(5000).replace("'row 7000'", "'row x'")
+        recipe = self._write(second, 'test.sql', data)
+        self.assert_(float(second.config['holland:metrics']['dedup-ratio'])
+                     > 5)
+
+        backupset = self.spool.find_backupset('default')
+        store = second.chunk_store()
+        self.assertEqual(len(backupset.list_backups()), 2)
+        self.assertEqual(len(find_recipes(backupset.path)), 2)
+
+        # chunks are kept within the grace period
+        nchunks = len(os.listdir(store.path))
+        purged = [backup.name for backup in backupset.purge(1)]
+        self.assertEqual(purged, ['default/20140101_000000'])
+        self.assertEqual(find_recipes(backupset.path), [recipe])
+        self.assertEqual(len(os.listdir(store.path)), nchunks)
+
+        removed, freed = store.collect_garbage(find_recipes(backupset.path),
+                                               grace_period=-1)
+        self.assert_(removed >= 1)
+        self.assert_(freed > 0)
+        result = StringIO()
+        reassemble(recipe, result)
+        self.assertEqual(result.getvalue(), data)
+        self.assertEqual(store.collect_garbage([recipe], grace_period=-1),
+                         (0, 0))
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+from holland.core.spool import spool
+from holland.commands.purge import purge_backup
+
+class TestPurgeBackup(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved_paths = spool.paths
+        spool.path = self.tmpdir
+        # full b0 <- incremental b1
+        for idx, parent in enumerate([None, 'default/b0']):
+            os.makedirs(os.path.join(self.tmpdir, 'default', 'b%d' % idx))
+            backup = spool.find_backup('default/b%d' % idx)
+            backup.config['holland:backup']['start-time'] = 1388534400 + idx
+            if parent:
+                backup.config['holland:backup']['parent'] = parent
+            backup.flush()
+
+    def tearDown(self):
+        spool.path = self.saved_paths
+        shutil.rmtree(self.tmpdir)
+
+    def test_purge_with_dependents(self):
+        backup = spool.find_backup('default/b0')
+        self.assertEqual(purge_backup(backup, force=True), 1)
+        self.assert_(backup.exists())
+
+    def test_purge_without_dependents(self):
+        backup = spool.find_backup('default/b1')
+        self.assertEqual(purge_backup(backup, force=True), 0)
+        self.failIf(backup.exists())
+        backup = spool.find_backup('default/b0')
+        self.assertEqual(purge_backup(backup, force=True), 0)
+        self.failIf(backup.exists())
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+import unittest
+from holland.core.spool import Spool
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = Spool(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_historic_size_factor(self):
+        backupset = self.spool.add_backupset('default')
+        for start, estimated, on_disk in ((1388534400, 100, 50),
+                                          (1388620800, 100, 25),
+                                          (1388707200, 0, 0)):
+            name = str(start)
+            path = os.path.join(backupset.path, name)
+            os.makedirs(path)
+            backup = backupset.find_backup(name)
+            backup.config['holland:backup']['start-time'] = start
+            backup.config['holland:backup']['estimated-size'] = estimated
+            backup.config['holland:backup']['on-disk-size'] = on_disk
+            backup.flush()
+        self.assertEqual(backupset.historic_size_factor(), 0.5)
+        self.assertEqual(backupset.historic_size_factor(count=1), 0.25)
+
+    def _chain(self, parents):
+        backupset = self.spool.add_backupset('default')
+        for idx, parent in enumerate(parents):
+            name = 'b%d' % idx
+            os.makedirs(os.path.join(backupset.path, name))
+            backup = backupset.find_backup(name)
+            backup.config['holland:backup']['start-time'] = 1388534400 + idx
+            if parent is not None:
+                backup.config['holland:backup']['parent'] = 'default/b%d' % \
+                                                            parent
+            backup.flush()
+        return backupset
+
+    def test_purge_retains_parents(self):
+        # full b0 <- b1 <- b2, full b3 <- b4
+        backupset = self._chain([None, 0, 1, None, 3])
+        names = [backup.name for backup in backupset.purge_list(1)]
+        self.assertEqual(names, ['default/b2', 'default/b1', 'default/b0'])
+        names = [backup.name for backup in backupset.purge_list(3)]
+        self.assertEqual(names, [])
+        backup = backupset.find_backup('b0')
+        self.assertEqual([other.name for other in
+                          backupset.dependents(backup)],
+                         ['default/b1', 'default/b2'])
+        purged = [backup.name for backup in backupset.purge(1)]
+        self.assertEqual(purged, ['default/b2', 'default/b1', 'default/b0'])
+        self.assertEqual([backup.name for backup in backupset.list_backups()],
+                         ['default/b3', 'default/b4'])
+
+    def test_flush_sync(self):
+        backup = self.spool.add_backup('default')
+        backup.flush(sync=True)
+        self.failIf('holland:metrics' in backup.config)
+
+        backup.config['holland:backup']['durability'] = 'batch'
+        open(os.path.join(backup.path, 'data'), 'w').write('foo')
+        backup.flush(sync=True)
+        backup.load_config()
+        metrics = backup.config['holland:metrics']
+        self.assert_(float(metrics['durability-sync-time']) >= 0)
+
+class TestMultiRootSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.roots = [os.path.join(self.tmpdir, 'spool%d' % idx)
+                      for idx in range(3)]
+        for root in self.roots:
+            os.mkdir(root)
+        self.spool = Spool(self.roots)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_backup(self, root, name, start):
+        path = os.path.join(root, 'default', name)
+        os.makedirs(path)
+        backup = self.spool.find_backup('default/' + name)
+        backup.config['holland:backup']['start-time'] = start
+        backup.flush()
+        return backup
+
+    def test_path(self):
+        self.assertEqual(self.spool.path, self.roots[0])
+        self.assertEqual(self.spool.paths, self.roots)
+        spool = Spool(self.roots[1])
+        self.assertEqual(spool.paths, [self.roots[1]])
+
+    def test_list_across_roots(self):
+        self._make_backup(self.roots[1], '20140101_000000', 1388534400)
+        self._make_backup(self.roots[0], '20140102_000000', 1388620800)
+        self._make_backup(self.roots[2], '20140103_000000', 1388707200)
+
+        backupset = self.spool.find_backupset('default')
+        self.assertEqual(backupset.path,
+                         os.path.join(self.roots[0], 'default'))
+        names = [backup.name for backup in backupset.list_backups()]
+        self.assertEqual(names, ['default/20140101_000000',
+                                 'default/20140102_000000',
+                                 'default/20140103_000000'])
+        self.assertEqual([x.name for x in self.spool.list_backupsets()],
+                         ['default'])
+        backup = self.spool.find_backup('default/20140103_000000')
+        self.assertEqual(backup.path,
+                         os.path.join(self.roots[2], 'default',
+                                      '20140103_000000'))
+
+        backupset.update_symlinks()
+        newest = os.path.join(backupset.path, 'newest')
+        oldest = os.path.join(backupset.path, 'oldest')
+        self.assertEqual(os.readlink(newest), backup.path)
+        self.assertEqual(os.readlink(oldest),
+                         os.path.join(self.roots[1], 'default',
+                                      '20140101_000000'))
+
+        purged = [x.name for x in backupset.purge(1)]
+        self.assertEqual(purged, ['default/20140102_000000',
+                                  'default/20140101_000000'])
+        self.assertEqual(len(backupset.list_backups()), 1)
+
+    def test_stripes(self):
+        backup = self._make_backup(self.roots[1], '20140101_000000',
+                                   1388534400)
+        stripes = backup.add_stripes(self.spool.paths)
+        self.assertEqual(stripes,
+                         [os.path.join(self.roots[0], 'default',
+                                       '20140101_000000.stripe'),
+                          os.path.join(self.roots[2], 'default',
+                                       '20140101_000000.stripe')])
+        backup.flush()
+        backupset = self.spool.find_backupset('default')
+        self.assertEqual(len(backupset.list_backups()), 1)
+        backup = backupset.list_backups()[0]
+        backup.purge()
+        for path in [backup.path] + stripes:
+            self.failIf(os.path.exists(path))
+
+    def test_choose_root(self):
+        self.assert_(self.spool.choose_root() in self.roots)
+        for root, name, rate in ((self.roots[0], '20140101_000000', 10),
+                                 (self.roots[1], '20140102_000000', 1000),
+                                 (self.roots[2], '20140103_000000', 10)):
+            backup = self._make_backup(root, name, 1388534400)
+            config = backup.config['holland:backup']
+            config['stop-time'] = config['start-time'] + 100
+            config['on-disk-size'] = rate*100
+            backup.flush()
+        self.assertEqual(self.spool.root_throughput(self.roots[1]), 1000)
+        self.assertEqual(self.spool.choose_root(), self.roots[1])
+        backup = self.spool.add_backup('default')
+        self.assert_(os.path.dirname(os.path.dirname(backup.path))
+                     in self.roots)
+
+    def test_backupset_of(self):
+        self._make_backup(self.roots[1], '20140101_000000', 1388534400)
+        current = os.path.join(self.roots[2], 'default', '20140102_000000')
+        backupset = self.spool.backupset_of(current)
+        self.assertEqual(backupset.paths,
+                         [os.path.join(root, 'default')
+                          for root in self.roots])
+        self.assertEqual([x.name for x in backupset.list_backups()],
+                         ['default/20140101_000000'])
+        # backups outside the spool only see their own directory
+        other = os.path.join(self.tmpdir, 'other', 'default', 'x')
+        self.assertEqual(self.spool.backupset_of(other).paths,
+                         [os.path.dirname(other)])
+
+    def test_expected_throughput(self):
+        backup = self._make_backup(self.roots[1], '20140101_000000',
+                                   1388534400)
+        config = backup.config['holland:backup']
+        config['stop-time'] = config['start-time'] + 100
+        config['on-disk-size'] = 1000*100
+        backup.flush()
+        self.assertEqual(self.spool.root_throughput(self.roots[0]), None)
+        self.assertEqual(self.spool.expected_throughput(self.roots[0]), 1000)
+        self.assertEqual(self.spool.expected_throughput(self.roots[1]), 1000)
@@ -0,0 +1,46 @@
+import os
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import threading
+from subprocess import Popen
+from holland.core.util.supervise import Supervisor
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = Supervisor()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.supervisor.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_process_exit(self):
+        process = Popen(['sleep', '0.2'])
+        self.supervisor.watch(process)
+        self.assertEqual(self.supervisor.wait_process(process), 0)
+
+    def test_interrupted(self):
+        process = Popen(['sleep', '30'])
+        self.supervisor.watch(process)
+        flag = []
+        timer = threading.Timer(0.2, lambda: (flag.append(True),
+                                              self.supervisor.wakeup()))
+        timer.start()
+        start = time.time()
+        status = self.supervisor.wait_process(process, lambda: flag)
+        self.assertEqual(status, -signal.SIGKILL)
+        self.assert_(time.time() - start < 10)
+
+    def test_directory(self):
+        path = os.path.join(self.tmpdir, 'ready')
+        self.supervisor.watch_directory(self.tmpdir)
+        timer = threading.Timer(0.2, lambda: open(path, 'w').close())
+        timer.start()
+        self.assert_(self.supervisor.wait(lambda: os.path.exists(path),
+                                          timeout=10))
+
+    def test_timeout(self):
+        self.failIf(self.supervisor.wait(lambda: False, timeout=0.1))
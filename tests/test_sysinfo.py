@@ -0,0 +1,10 @@
+import unittest
+from holland.core.util.sysinfo import cpu_count, available_memory
+
+class TestSysinfo(unittest.TestCase):
+    def test_cpu_count(self):
+        self.assert_(cpu_count() >= 1)
+
+    def test_available_memory(self):
+        memory = available_memory()
+        self.assert_(memory is None or memory > 0)